@@ -1,13 +1,43 @@
+import os
+import copy
 import shutil
+import itertools
 import json
 from pathlib import Path
-from typing import Union, List, Literal
+from typing import Union, List, Literal, Dict, Iterator, Callable, Tuple, AsyncIterator
 from collections import OrderedDict
 import subprocess
+import tempfile
 import asyncio
+import signal
+import time
 import pprint
 from loguru import logger
 
+from code_executor.fork_server import AsyncForkedProcess, ForkRequest, ForkServer
+from code_executor.history import CommandHistory
+from code_executor.limits import apply_rlimits
+from code_executor.metrics import MetricsRegistry
+from code_executor.output import (
+    ConsoleSink,
+    OutputBudget,
+    OutputBuffer,
+    OutputChunk,
+    read_output,
+    iter_output,
+    release_spilled,
+)
+from code_executor.protocol import (
+    FRAME_FD_ENV,
+    READ_CHUNK_SIZE,
+    STREAM_END,
+    STREAM_NAMES,
+    INTERNAL_CMD_ID_BASE,
+    FrameParser,
+    interrupt_path,
+    is_incomplete,
+)
+
 
 class AsyncCodeExecutor(object):
     def __init__(
@@ -18,24 +48,106 @@ class AsyncCodeExecutor(object):
         work_dir: str = None,
         is_save_obj: bool = False,
         save_obj_cmd: str = None,
-        load_obj_cmd: str = None
+        load_obj_cmd: str = None,
+        use_fork_server: bool = False,
+        exec_cmd: str = None,
+        bg_save_obj_cmd: str = None,
+        flush_obj_cmd: str = None,
+        fork_cmd: str = None,
+        checkpoint_mode: Literal["sync", "background"] = "sync",
+        max_inflight_checkpoints: int = 2,
+        snapshot_compression: int = None,
+        output_limit: int = 1 << 20,
+        output_keep: int = 1 << 15,
+        session_output_limit: int = 1 << 26,
+        echo: bool = True,
+        report_metrics: bool = True,
+        cell_cache: bool = False,
+        cell_cache_size: int = 1 << 30,
+        timeout: float = None,
+        interrupt_grace: float = 5.0,
+        cpu_limit: int = None,
+        memory_limit: int = None,
     ):
         self.base_command = base_command
         self.print_cmd = print_cmd + "\n"
         self.__process = None
-        self.__cmd_event = asyncio.Event()  # 用于通知process前一个输入的command是否执行完成
-        self._cmd_space = OrderedDict()  # cmd_id: {cmd, stddout, stderr}
+        self.__io_tasks = set()  # 读取会话进程输出的任务, 需要持有引用以免被垃圾回收
+        self.__pending = OrderedDict()  # cmd_id: Future, 已发送但尚未执行完成的cmd
+        self.__submit_lock = asyncio.Lock()
+        self.__sentinel_output = None  # 行哨兵模式下当前cmd的(cmd_id, 输出缓冲区)
+        self.__output_dir = None  # 未设置work_dir时输出溢出文件所在的临时目录
+        self.__startup_cmd = ""  # 进程启动后首先发送的命令, 如load()时恢复全局作用域对象
+        self.__internal_ids = itertools.count(INTERNAL_CMD_ID_BASE)  # 内部命令的cmd_id
+        self._cmd_space = CommandHistory()  # cmd_id: {cmd, stddout, stderr}
         # 下面是为了磁盘保存对象而设置
         self.work_dir = work_dir
         self.is_save_obj = is_save_obj
         self.load_obj_cmd = load_obj_cmd
         self.save_obj_cmd = save_obj_cmd
+        # background模式下快照由会话进程fork出的子进程在后台写入, cmd执行完成后立即返回,
+        # 同时进行的后台快照超过max_inflight_checkpoints时会话进程会等待最早的快照完成
+        self.bg_save_obj_cmd = bg_save_obj_cmd
+        self.flush_obj_cmd = flush_obj_cmd
+        self.checkpoint_mode = checkpoint_mode
+        self.max_inflight_checkpoints = max_inflight_checkpoints
+        # 快照对象的压缩级别(1-9), None为不压缩; numpy数组始终不压缩以便恢复时内存映射
+        self.snapshot_compression = snapshot_compression
+        # 是否由fork server派生会话进程, 以跳过init_code的重复执行
+        self.use_fork_server = use_fork_server
+        # 分帧结果协议的执行命令模板, 为None时退回到END_OF_EXECUTION行哨兵
+        self.exec_cmd = exec_cmd
+        # 会话fork自身的命令模板, 见fork()
+        self.fork_cmd = fork_cmd
+        # 单个cmd的输出超过output_limit字节或会话输出额度用尽后溢出到磁盘, 内存中只保留首尾各output_keep字节
+        self.output_limit = output_limit
+        self.output_keep = output_keep
+        self.session_output_limit = session_output_limit
+        self.__output_budget = OutputBudget(session_output_limit)
+        self.__retained: Dict[str, List[OutputBuffer]] = {}  # cmd_id: 输出文本仍保留在cmd_space内存中的缓冲区
+        # 会话的所有输出都会交给sink处理, echo为True时默认把输出打印到控制台
+        self.echo = echo
+        self.__sinks: List[Callable[[OutputChunk], None]] = [ConsoleSink()] if echo else []
+        self.__listeners: Dict[str, Callable[[OutputChunk], None]] = {}  # cmd_id: 该cmd的输出订阅者
+        # 每个cmd完成时其指标写入cmd_space记录的metrics字段并交给已注册的hook,
+        # report_metrics为True时同时汇总到进程内共享的MetricsRegistry
+        self.report_metrics = report_metrics
+        self.__metrics_hooks: List[Callable[[str, dict], None]] = []
+        if report_metrics:
+            registry = MetricsRegistry.shared()
+            self.__metrics_hooks.append(lambda cmd_id, metrics: registry.observe(metrics, type(self).__name__))
+        self.__submitted: Dict[str, float] = {}  # cmd_id: 提交时间
+        # cell结果缓存: 代码和其读取的全局变量都未变化时跳过执行, 回放输出并恢复cell写入的变量,
+        # 缓存保存在work_dir/cell_cache中, 总大小超过cell_cache_size字节时淘汰最久未使用的条目
+        self.cell_cache = cell_cache
+        self.cell_cache_size = cell_cache_size
+        if self.cell_cache:
+            assert self.exec_cmd is not None, "cell_cache requires the framed protocol (exec_cmd)!"
+            assert self.work_dir is not None, "work_dir should be a path when cell_cache is True!"
+        self.__last_completed = 0.0  # 上一个cmd完成的时间
+        # cmd开始执行(成为最早未完成的cmd)后超过timeout秒(submit时可单独指定)仍未完成时, 先向会话发送SIGINT,
+        # 在cmd中抛出KeyboardInterrupt而保留会话; interrupt_grace秒后仍未完成则杀死会话进程并从最近的快照恢复
+        self.timeout = timeout
+        self.interrupt_grace = interrupt_grace
+        self.__timeouts: Dict[str, float] = {}  # cmd_id: 该cmd的超时秒数
+        self.__timers: Dict[str, asyncio.TimerHandle] = {}  # cmd_id: 已启动的超时计时器
+        self.__timed_out = set()  # 已超时的cmd_id
+        self.__escalations = set()  # 杀死并重启会话的任务, 需要持有引用以免被垃圾回收
+        # 会话进程的资源限制, 见code_executor.limits
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
         if self.is_save_obj:
             assert self.save_obj_cmd is not None, "save_obj_cmd should be string cmd when is_save_obj is True!"
             assert self.load_obj_cmd is not None, "load_obj_cmd should be string cmd when is_save_obj is True!"
             assert self.work_dir is not None, "work_dir should be a path when is_save_obj is True!"
+            if self.checkpoint_mode == "background":
+                assert self.bg_save_obj_cmd is not None, "bg_save_obj_cmd should be string cmd in background mode!"
+                assert self.flush_obj_cmd is not None, "flush_obj_cmd should be string cmd in background mode!"
+                assert self.max_inflight_checkpoints > 0, "max_inflight_checkpoints should be positive!"
+            assert self.snapshot_compression is None or 1 <= self.snapshot_compression <= 9, "level should be 1-9!"
             Path(self.work_dir).mkdir(parents=True, exist_ok=True)
         self._executor_save_path = str(Path(self.work_dir) / "executor.json") if self.work_dir else ""
+        self._history_path = str(Path(self.work_dir) / "history") if self.work_dir else ""
 
     def manage_work_dir(self, cmd: Literal["c", "d"] = "c"):
         """管理cmd变量的共享文件目录"""
@@ -51,20 +163,101 @@ class AsyncCodeExecutor(object):
                 shutil.rmtree(str(root))
 
     def obj_save_path(self, cmd_id: str) -> str:
-        """每段代码内全局作用域中对象的保存路径"""
-        return str(Path(self.work_dir) / cmd_id / "globals_object.pickle")
-
-    async def load_obj(self, cmd_id: str):
-        """在进程运行时载入每段代码内全局作用域的对象"""
-        assert self.__process and self.__process.poll() is not None, "load_obj时进程必须处于运行状态!"
+        """每段代码内全局作用域快照的manifest路径, 对象本身按内容哈希保存在work_dir/objects中"""
+        return str(Path(self.work_dir) / cmd_id / "manifest.json")
+
+    def obj_load_path(self, cmd_id: str) -> str:
+        """载入快照时的路径, 兼容旧版本保存的整体pickle快照"""
+        legacy_path = Path(self.work_dir) / cmd_id / "globals_object.pickle"
+        if not Path(self.obj_save_path(cmd_id)).exists() and legacy_path.exists():
+            return str(legacy_path)
+        return self.obj_save_path(cmd_id)
+
+    def output_path(self, cmd_id: str, stream: str) -> str:
+        """cmd输出溢出到磁盘时的保存路径, 未设置work_dir时位于临时目录中, stop_process()时删除"""
+        if self.work_dir:
+            root = Path(self.work_dir) / "outputs"
+        else:
+            if self.__output_dir is None:
+                self.__output_dir = tempfile.mkdtemp(prefix="code_executor_output_")
+            root = Path(self.__output_dir)
+        return str(root / f"{cmd_id}.{stream}.log")
+
+    def _new_output_buffers(self, cmd_id: str) -> Dict[str, OutputBuffer]:
+        return {
+            name: OutputBuffer(
+                self.output_path(cmd_id, name), self.output_limit, self.output_keep, self.__output_budget
+            )
+            for name in STREAM_NAMES.values()
+        }
+
+    def _close_output_buffers(self, cmd_id: str, buffers: Dict[str, OutputBuffer]) -> dict:
+        """结束cmd的输出缓冲区, 返回写入cmd_space的输出字段
+
+        输出保留在cmd_space中时继续占用会话的输出额度, 直到记录被持久化; 内部命令的输出则立即归还额度.
+        """
+        outputs = {}
+        for name, buffer in buffers.items():
+            outputs[name] = buffer.close().strip()
+            if buffer.spilled:
+                outputs[f"{name}_file"] = buffer.spill_path
+                outputs[f"{name}_bytes"] = buffer.size
+        if cmd_id in self._cmd_space:
+            self.__retained[cmd_id] = list(buffers.values())
+        else:
+            for buffer in buffers.values():
+                buffer.release()
+        return outputs
+
+    def _release_outputs(self, upto: int = None):
+        """cmd_id小于upto(默认全部)的记录已持久化, 其输出不再常驻内存, 归还占用的会话输出额度"""
+        for cmd_id in list(self.__retained):
+            if upto is None or int(cmd_id) < upto:
+                for buffer in self.__retained.pop(cmd_id, []):
+                    buffer.release()
+
+    def read_output(self, cmd_id: str, stream: str = "stdout", offset: int = 0, size: int = -1) -> str:
+        """按字节偏移分页读取cmd的完整输出, 包括已溢出到磁盘的部分"""
+        record = self._cmd_space[cmd_id]
+        if f"{stream}_file" in record:
+            data = read_output(record[f"{stream}_file"], offset, size)
+        else:
+            data = record.get(stream, "").encode()
+            data = data[offset:] if size < 0 else data[offset : offset + size]
+        return data.decode(errors="replace")
+
+    def iter_output(self, cmd_id: str, stream: str = "stdout", chunk_size: int = 1 << 16) -> Iterator[str]:
+        """惰性地逐块读取cmd的完整输出"""
+        record = self._cmd_space[cmd_id]
+        if f"{stream}_file" in record:
+            yield from iter_output(record[f"{stream}_file"], chunk_size)
+        elif record.get(stream):
+            yield record[stream]
+
+    async def load_obj(self, cmd_id: str, lazy: bool = False):
+        """在进程运行时载入每段代码内全局作用域的对象, lazy为True时对象在第一次被使用时才反序列化"""
+        assert self.is_alive(), "load_obj时进程必须处于运行状态!"
         logger.info(f"Start: load {cmd_id} objects ...")
-        filepath = self.obj_save_path(cmd_id)
-        load_obj_cmd = self.load_obj_cmd.format(filepath)
+        filepath = self.obj_load_path(cmd_id)
+        load_obj_cmd = self.load_obj_cmd.format(filepath, lazy, False)
         await self._run(load_obj_cmd)
         logger.info(f"Done: load {cmd_id} objects!")
 
-    def load(self) -> "AsyncCodeExecutor":
-        """载入Executor对象和全局作用域中所有对象"""
+    async def restore(self, cmd_id: str, lazy: bool = False) -> dict:
+        """把运行中的会话回退到cmd_id执行完成时的全局作用域, 不重启解释器
+
+        回退本身作为一条cmd记录到cmd_space中, 之后的快照和load()都以回退后的状态为准.
+        """
+        assert self.is_save_obj, "restore requires is_save_obj to be True!"
+        assert cmd_id in self._cmd_space, f"cmd {cmd_id} does not exist!"
+        await self.flush_checkpoints()
+        filepath = self.obj_load_path(cmd_id)
+        assert Path(filepath).exists(), f"snapshot of cmd {cmd_id} does not exist!"
+        logger.info(f"Restore session to cmd {cmd_id} ...")
+        return await self._run(self.load_obj_cmd.format(filepath, lazy, True))
+
+    def load(self, lazy: bool = False) -> "AsyncCodeExecutor":
+        """载入Executor对象和全局作用域中所有对象, lazy为True时会话启动后只安装占位符, 对象在第一次被使用时才反序列化"""
         # 保存第一优先级的is_save_obj
         is_save_obj = self.is_save_obj
         # 载入Executor对象
@@ -72,23 +265,36 @@ class AsyncCodeExecutor(object):
             executor_state = json.load(f)
 
         input_kwargs = {k: v for k, v in executor_state.items() if not k.startswith("_")}
+        # work_dir可能被整体移动或传输到其它节点, 以当前所在位置为准
+        input_kwargs["work_dir"] = self.work_dir
         self.__init__(**input_kwargs)
         # 恢复第一优先级的is_save_obj
         self.is_save_obj = is_save_obj
 
-        # 最后一个cmd的全局作用域保存路径
-        obj_path = self.obj_save_path(str(len(executor_state["_cmd_space"]) - 1))
-        self.base_command[-1] = self.base_command[-1] + self.load_obj_cmd.format(obj_path)
-
         for k, v in executor_state.items():
-            if k.startswith("_"):
+            if k.startswith("_") and k not in ("_cmd_space", "_executor_save_path", "_history_path"):
                 setattr(self, k, v)
+        # cmd_space保存在追加写的历史日志中, 只读取索引大小, 旧版本则整体保存在executor.json中
+        if "_cmd_space" in executor_state:
+            self._cmd_space = CommandHistory.from_records(executor_state["_cmd_space"])
+        else:
+            self._cmd_space = CommandHistory(self._history_path)
+
+        # 最后一个cmd的全局作用域保存路径
+        obj_path = self.obj_load_path(str(len(self._cmd_space) - 1))
+        if Path(obj_path).exists():
+            self.__startup_cmd = self.load_obj_cmd.format(obj_path, lazy, False)
         return self
 
     def save_executor(self):
-        """保存Executor对象"""
+        """保存Executor对象, background模式下会话运行时应先await flush_checkpoints()以保证与磁盘上的快照一致"""
         assert self.work_dir, "work_dir must be set a value, not None."
-        executor_state = {k: v for k, v in self.__dict__.items() if "__" not in k}
+        # 只追加写入新完成的cmd记录, 仍在执行的cmd及其之后的记录留到下次保存
+        pending = [int(cmd_id) for cmd_id in self.__pending if int(cmd_id) < INTERNAL_CMD_ID_BASE]
+        upto = min(pending, default=None)
+        self._cmd_space.flush(self._history_path, upto=upto)
+        self._release_outputs(upto)
+        executor_state = {k: v for k, v in self.__dict__.items() if "__" not in k and k != "_cmd_space"}
         with open(self._executor_save_path, "w") as f:
             json.dump(executor_state, f, sort_keys=True, indent=4)
 
@@ -97,18 +303,152 @@ class AsyncCodeExecutor(object):
             f.write("*\n")
 
     async def start_process(self):
-        self.__process = await asyncio.create_subprocess_exec(
-            *self.base_command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=0,
+        base_command = [self.base_command] if isinstance(self.base_command, str) else self.base_command
+        # 分帧协议下额外创建一个帧通道, 写端交给会话进程
+        frame_r, frame_w = os.pipe() if self.exec_cmd else (None, None)
+        pass_fds = {FRAME_FD_ENV: frame_w} if self.exec_cmd else {}
+        try:
+            if self.use_fork_server:
+                self.__process = await ForkServer.shared(base_command).async_spawn_process(pass_fds=pass_fds)
+            else:
+                self.__process = await asyncio.create_subprocess_exec(
+                    *base_command,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    bufsize=0,
+                    pass_fds=tuple(pass_fds.values()),
+                    env={**os.environ, **{k: str(v) for k, v in pass_fds.items()}},
+                )
+        finally:
+            if frame_w is not None:
+                os.close(frame_w)
+
+        apply_rlimits(self.__process.pid, self.cpu_limit, self.memory_limit)
+        self._attach_process(self.__process, frame_r)
+        if self.__startup_cmd:
+            self.__process.stdin.write(self.__startup_cmd.encode())
+            await self.__process.stdin.drain()
+
+    def _attach_process(self, process, frame_r: int = None):
+        """为会话进程的输出管道创建读取任务"""
+        self.__process = process
+        output_target = self.print_output if self.exec_cmd else self.save_and_print_output
+        readers = [
+            output_target(self.__process.stdout, "STDOUT: ", self.__process),
+            output_target(self.__process.stderr, "STDERR: ", self.__process),
+        ]
+        if self.exec_cmd:
+            readers.append(self.save_framed_output(frame_r, self.__process))
+        for reader in readers:
+            task = asyncio.create_task(reader)
+            self.__io_tasks.add(task)
+            task.add_done_callback(self.__io_tasks.discard)
+
+    def is_alive(self) -> bool:
+        """会话进程是否处于运行状态"""
+        return self.__process is not None and self.__process.returncode is None
+
+    @property
+    def pid(self) -> int:
+        """会话进程的pid, 未启动时为None"""
+        return self.__process.pid if self.__process is not None else None
+
+    async def _execute_internal(self, code: str) -> dict:
+        """执行不占用cmd_space的内部代码, 等待执行完成并返回其输出"""
+        cmd_id = str(next(self.__internal_ids))
+        if self.exec_cmd:
+            command = self.exec_cmd.format(int(cmd_id), code, "", None)
+        else:
+            command = code + self.print_cmd.format("END_OF_EXECUTION")
+        future = asyncio.get_running_loop().create_future()
+        async with self.__submit_lock:
+            if self.__process is None:
+                await self.start_process()
+            self.__pending[cmd_id] = future
+            await self._write(command, cmd_id)
+        return await future
+
+    async def warm_up(self):
+        """启动进程并等待初始化代码执行完成, 不占用cmd_space"""
+        await self._execute_internal("")
+
+    async def fork(self, work_dir: str = None) -> "AsyncCodeExecutor":
+        """以写时复制的方式克隆运行中的会话, 返回连接到新会话的Executor, 其cmd_space为当前cmd_space的副本
+
+        新会话由会话进程自身fork得到, 与当前会话共享内存页直到其中一方修改, 耗时与全局作用域的大小无关.
+        当前会话开启了is_save_obj时, 只有指定了新的work_dir, 新会话才会继续保存快照.
+        """
+        assert self.exec_cmd and self.fork_cmd, "fork requires the framed protocol and fork_cmd!"
+        assert self.is_alive(), "fork requires a running session!"
+        request = ForkRequest()
+        try:
+            cmd_id, future = str(next(self.__internal_ids)), asyncio.get_running_loop().create_future()
+            # fork完成前不能写入其它cmd, 否则可能被新会话从继承的stdin缓冲区中读到
+            async with self.__submit_lock:
+                self.__pending[cmd_id] = future
+                await self._write(
+                    self.exec_cmd.format(int(cmd_id), self.fork_cmd.format(request.path), "", None), cmd_id
+                )
+                try:
+                    pid = await asyncio.to_thread(request.serve)
+                finally:
+                    record = await future
+            if record["status"]:
+                raise RuntimeError(f"fork failed:\n{record['stderr']}")
+        except BaseException:
+            request.close(keep_local=False)
+            raise
+        request.close()
+
+        kwargs = {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+        kwargs.update(
+            print_cmd=self.print_cmd.removesuffix("\n"),
+            work_dir=work_dir,
+            is_save_obj=self.is_save_obj and work_dir is not None,
+            cell_cache=self.cell_cache and work_dir is not None,
         )
-        asyncio.create_task(self.save_and_print_output(self.__process.stdout, "STDOUT: "))
-        asyncio.create_task(self.save_and_print_output(self.__process.stderr, "STDERR: "))
+        clone = type(self)(**kwargs)
+        clone._cmd_space = CommandHistory.from_records(copy.deepcopy(self._cmd_space.to_dict()))
+        process = AsyncForkedProcess(pid)
+        await process.connect_pipes(request.stdin, request.stdout, request.stderr)
+        # 新会话完成fork命令时同样会发出该cmd_id的结束帧
+        forked = asyncio.get_running_loop().create_future()
+        clone.__pending[cmd_id] = forked
+        clone._attach_process(process, request.frame)
+        await forked
+        logger.info(f"Session forked as process {pid}.")
+        return clone
+
+    async def _append_record(self, record: dict) -> dict:
+        """把在其它会话(如fork出的会话)中执行的cmd记录到cmd_space, is_save_obj时为其保存当前全局作用域的快照"""
+        async with self.__submit_lock:
+            cmd_id = str(len(self._cmd_space))
+            self._cmd_space[cmd_id] = record
+            self.manage_work_dir()
+        if self.is_save_obj:
+            save_obj_cmd = self.save_obj_cmd.format(self.obj_save_path(cmd_id), self.snapshot_compression)
+            outputs = await self._execute_internal(save_obj_cmd)
+            if outputs["status"]:
+                logger.warning(f"Snapshot of cmd {cmd_id} failed:\n{outputs['stderr']}")
+        return self._cmd_space[cmd_id]
+
+    async def flush_checkpoints(self) -> int:
+        """等待所有已提交cmd的后台快照都写入磁盘, 返回写入失败的快照数量"""
+        if not (self.is_save_obj and self.checkpoint_mode == "background" and self.is_alive()):
+            return 0
+        outputs = await self._execute_internal(self.flush_obj_cmd)
+        failures = int(outputs.get("stdout") or 0)
+        if failures:
+            logger.warning(f"{failures} background checkpoints failed.")
+        return failures
 
     async def stop_process(self):
         if self.__process:
+            try:
+                await self.flush_checkpoints()
+            except RuntimeError as e:
+                logger.warning(f"Flush checkpoints failed: {e}")
             logger.info("Attempting to terminate the process...")
             self.__process.terminate()
             try:
@@ -119,77 +459,358 @@ class AsyncCodeExecutor(object):
         logger.info("Process terminate successfully!")
 
         logger.info("Attempting to terminate the stderr and stdout tasks ...")
-        if self.__cmd_event:
-            self.__cmd_event.set()
-
         # set process is None
+        if self.__process:
+            self._remove_interrupt_file(self.__process.pid)
         self.__process = None
+        self._fail_pending()
         logger.info("Stderr and stdout tasks terminate successfully!")
+        # 未设置work_dir时溢出的输出文件保存在临时目录中, 随会话一起删除
+        if self.__output_dir is not None:
+            release_spilled(self._cmd_space.values(), self.__output_dir)
+            shutil.rmtree(self.__output_dir, ignore_errors=True)
+            self.__output_dir = None
         if self.is_save_obj:
             self.save_executor()
 
-    async def save_and_print_output(self, pipe: asyncio.StreamReader, prefix: str = ""):
-        stdout, stderr = "", ""
+    def add_sink(self, sink: Callable[[OutputChunk], None]):
+        """注册输出sink, 会话的每一段输出都会依次交给已注册的sink处理"""
+        self.__sinks.append(sink)
+
+    def remove_sink(self, sink: Callable[[OutputChunk], None]):
+        self.__sinks.remove(sink)
+
+    def _dispatch(self, chunk: OutputChunk):
+        listener = self.__listeners.get(chunk.cmd_id)
+        if listener is not None:
+            listener(chunk)
+        for sink in self.__sinks:
+            try:
+                sink(chunk)
+            except Exception as e:
+                logger.warning(f"Output sink {sink} failed: {e}")
+
+    def add_metrics_hook(self, hook: Callable[[str, dict], None]):
+        """注册指标hook, 每个cmd完成时以(cmd_id, metrics)调用"""
+        self.__metrics_hooks.append(hook)
+
+    def remove_metrics_hook(self, hook: Callable[[str, dict], None]):
+        self.__metrics_hooks.remove(hook)
+
+    def _command_metrics(self, submitted: float, completed: float, status: int, metrics: dict) -> dict:
+        """补全会话端测得的指标, 行哨兵模式下没有会话端计时, 以上一个cmd完成的时间近似开始执行的时间"""
+        started = metrics.pop("started", None)
+        if started is None:
+            started = max(submitted, self.__last_completed)
+            metrics["wall_time"] = completed - started
+        metrics["queue_time"] = max(0.0, started - submitted)
+        metrics["total_time"] = completed - submitted
+        metrics["status"] = status
+        self.__last_completed = completed
+        return metrics
+
+    def _complete(self, cmd_id: str = None, outputs: dict = None, status: int = None, metrics: dict = None):
+        """记录cmd的执行结果并完成其Future, cmd_id为None时按发送顺序取最早未完成的cmd"""
+        completed = time.time()
+        if cmd_id is None:
+            if not self.__pending:
+                return
+            cmd_id, future = self.__pending.popitem(last=False)
+        else:
+            future = self.__pending.pop(cmd_id, None)
+        submitted = self.__submitted.pop(cmd_id, None)
+        timed_out = self._disarm(cmd_id) is not None
+        self._arm_timeout()
+
+        self.__listeners.pop(cmd_id, None)
+        record = self._cmd_space.get(cmd_id)
+        if record is not None:
+            record.update(outputs or {})
+            if status is not None:
+                record["status"] = status
+            if timed_out:  # 超时后被中断的cmd
+                record["timed_out"] = True
+            if submitted is not None:
+                record["metrics"] = self._command_metrics(submitted, completed, status, metrics or {})
+                for hook in self.__metrics_hooks:
+                    try:
+                        hook(cmd_id, record["metrics"])
+                    except Exception as e:
+                        logger.warning(f"Metrics hook {hook} failed: {e}")
+        if record is None:  # 内部命令不记录到cmd_space, 直接返回其输出
+            record = {**(outputs or {}), "status": status}
+        if future is not None and not future.done():
+            future.set_result(record)
+
+    def _fail_pending(self, exclude: str = None):
+        """会话进程退出后不会再有执行结果, 让所有未完成的Future抛出异常, 因超时被杀死的cmd则得到超时记录"""
+        pending = [(k, f) for k, f in self.__pending.items() if k != exclude]
+        for cmd_id, _ in pending:
+            del self.__pending[cmd_id]
+        for cmd_id, future in pending:
+            self.__submitted.pop(cmd_id, None)
+            timeout = self._disarm(cmd_id)
+            if future.done():
+                continue
+            record = self._cmd_space.get(cmd_id)
+            if timeout is None or record is None:
+                future.set_exception(RuntimeError(f"Process exited before cmd {cmd_id} completed."))
+                continue
+            message = f"TimeoutError: cmd {cmd_id} did not finish within {timeout} seconds, session restarted.\n"
+            record.update(stdout="", stderr=message, status=1, timed_out=True)
+            future.set_result(record)
+        self._arm_timeout()
+
+    def _disarm(self, cmd_id: str) -> float:
+        """取消cmd的超时计时器, cmd已超时时返回其超时秒数, 否则返回None"""
+        timer = self.__timers.pop(cmd_id, None)
+        if timer is not None:
+            timer.cancel()
+        timeout = self.__timeouts.pop(cmd_id, None)
+        if cmd_id in self.__timed_out:
+            self.__timed_out.discard(cmd_id)
+            return timeout
+        return None
+
+    def _arm_timeout(self):
+        """会话按发送顺序逐个执行cmd, 最早未完成的cmd成为正在执行的cmd时才开始计时"""
+        cmd_id = next(iter(self.__pending), None)
+        if cmd_id in self.__timeouts and cmd_id not in self.__timers:
+            loop = asyncio.get_running_loop()
+            self.__timers[cmd_id] = loop.call_later(self.__timeouts[cmd_id], self._on_timeout, cmd_id)
+
+    def _on_timeout(self, cmd_id: str):
+        if cmd_id not in self.__pending:
+            return
+        self.__timed_out.add(cmd_id)
+        logger.warning(f"Cmd {cmd_id} timed out after {self.__timeouts.get(cmd_id)} seconds, interrupting ...")
+        if self.exec_cmd and self.interrupt(cmd_id):
+            loop = asyncio.get_running_loop()
+            self.__timers[cmd_id] = loop.call_later(self.interrupt_grace, self._start_escalation, cmd_id)
+        else:
+            self._start_escalation(cmd_id)
+
+    def _start_escalation(self, cmd_id: str):
+        self.__timers.pop(cmd_id, None)
+        task = asyncio.create_task(self._escalate(cmd_id))
+        self.__escalations.add(task)
+        task.add_done_callback(self.__escalations.discard)
+
+    async def _escalate(self, cmd_id: str):
+        """中断无效时杀死会话进程, 重启后恢复该cmd之前最近的快照, 之后已发送的cmd随旧进程一起失败"""
+        async with self.__submit_lock:
+            if cmd_id not in self.__pending:
+                return
+            process = self.__process
+            logger.warning(f"Cmd {cmd_id} did not respond to interrupt, killing process {process.pid} ...")
+            process.kill()
+            await process.wait()
+            self._fail_pending()
+            self._remove_interrupt_file(process.pid)
+
+            self.__process = None
+            self.__startup_cmd = self._restore_cmd(cmd_id)
+            await self.start_process()
+
+    def _restore_cmd(self, cmd_id: str) -> str:
+        """恢复cmd_id之前最近一次快照的启动命令, 没有快照时会话以空的全局作用域重启"""
+        if self.is_save_obj:
+            for k in range(int(cmd_id) - 1, -1, -1):
+                obj_path = self.obj_load_path(str(k))
+                if Path(obj_path).exists():
+                    logger.info(f"Restarting session from the snapshot of cmd {k} ...")
+                    return self.load_obj_cmd.format(obj_path, False, False)
+        logger.warning(f"No snapshot before cmd {cmd_id}, the global scope of the session is lost.")
+        return ""
+
+    @staticmethod
+    def _remove_interrupt_file(pid: int):
+        try:
+            os.remove(interrupt_path(pid))
+        except FileNotFoundError:
+            pass
+
+    def interrupt(self, cmd_id: str = None) -> bool:
+        """在正在执行的cmd中抛出KeyboardInterrupt而不结束会话, cmd_id默认为最早未完成的cmd, 需要分帧协议
+
+        返回是否向会话发送了中断; 会话只中断正在执行的cmd_id, cmd已完成或尚未开始执行时中断被忽略.
+        """
+        assert self.exec_cmd, "interrupt requires the framed protocol (exec_cmd)!"
+        cmd_id = next(iter(self.__pending), None) if cmd_id is None else cmd_id
+        if cmd_id not in self.__pending or not self.is_alive():
+            return False
+        with open(interrupt_path(self.pid), "w") as f:
+            f.write(cmd_id)
+        self.__process.send_signal(signal.SIGINT)
+        return True
+
+    def _sentinel_buffers(self) -> Tuple[str, Dict[str, OutputBuffer]]:
+        """行哨兵模式下的输出属于最早发送且未完成的cmd"""
+        if self.__sentinel_output is None:
+            cmd_id = next(iter(self.__pending), None)
+            self.__sentinel_output = (cmd_id, self._new_output_buffers(cmd_id or "unknown"))
+        return self.__sentinel_output
+
+    async def save_and_print_output(self, pipe: asyncio.StreamReader, prefix: str = "", process=None):
+        name = "stderr" if prefix.startswith("STDERR:") else "stdout"
         while True:
             line = await pipe.readline()
             if not line:
                 break
             line = line.decode().strip()
             if line:
-                if prefix.startswith("STDERR:"):
-                    stderr += "\n" + line.strip()
-
-                if prefix.startswith("STDOUT:"):
-                    stdout += "\n" + line.strip() if "END_OF_EXECUTION" not in line else "\n"
-
-                if "END_OF_EXECUTION" not in line:
-                    print(f"{prefix}{line}")
-
                 if "END_OF_EXECUTION" in line:
-                    cmd_id = list(self._cmd_space)[-1]
-                    self._cmd_space[cmd_id]["stderr"] = stderr.strip()
-                    self._cmd_space[cmd_id]["stdout"] = stdout.strip()
-                    stdout, stderr = "", ""
-
-                if "END_OF_EXECUTION" in line or prefix.startswith("STDERR:"):
-                    self.__cmd_event.set()
-
-    async def _run(self, cmds):
-        if self.__process is None:
+                    cmd_id, buffers = self._sentinel_buffers()
+                    metrics = {"output_bytes": sum(buffer.size for buffer in buffers.values())}
+                    outputs = self._close_output_buffers(cmd_id, buffers)
+                    self.__sentinel_output = None
+                    self._complete(outputs=outputs, metrics=metrics)
+                    continue
+
+                cmd_id, buffers = self._sentinel_buffers()
+                buffers[name].append((line + "\n").encode())
+                self._dispatch(OutputChunk.now(cmd_id, name, line + "\n"))
+
+        if name == "stdout" and process is self.__process:
+            self._fail_pending()
+
+    async def print_output(self, pipe: asyncio.StreamReader, prefix: str = "", process=None):
+        """分帧协议下会话进程的stdout/stderr只剩C层面的输出, 只交给sink不参与cmd结果"""
+        name = "stderr" if prefix.startswith("STDERR:") else "stdout"
+        while True:
+            line = await pipe.readline()
+            if not line:
+                break
+            line = line.decode().strip()
+            if line:
+                self._dispatch(OutputChunk.now(None, name, line + "\n"))
+
+    async def save_framed_output(self, fd: int, process=None):
+        """按块读取帧通道, 按cmd_id归集输出, 收到结束帧时精确地完成对应cmd的Future"""
+        loop = asyncio.get_running_loop()
+        pipe = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(pipe), open(fd, "rb", buffering=0))
+        parser = FrameParser()
+        outputs = {}  # cmd_id: {stream: OutputBuffer}
+        while True:
+            data = await pipe.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            for frame in parser.feed(data):
+                if frame.cmd_id not in outputs:
+                    outputs[frame.cmd_id] = self._new_output_buffers(str(frame.cmd_id))
+                if frame.stream != STREAM_END:
+                    name = STREAM_NAMES[frame.stream]
+                    outputs[frame.cmd_id][name].append(frame.payload)
+                    self._dispatch(OutputChunk.now(str(frame.cmd_id), name, frame.payload.decode(errors="replace")))
+                    continue
+
+                buffers = outputs.pop(frame.cmd_id)
+                metrics = json.loads(frame.payload) if frame.payload else {}
+                metrics["output_bytes"] = sum(buffer.size for buffer in buffers.values())
+                cmd_id = str(frame.cmd_id)
+                self._complete(cmd_id, self._close_output_buffers(cmd_id, buffers), frame.status, metrics)
+        # 会话进程退出时不再会有结束帧
+        if process is self.__process:
+            self._fail_pending()
+
+    async def _write(self, command: str, cmd_id: str = None):
+        try:
+            self.__process.stdin.write(command.encode())
+            await self.__process.stdin.drain()  # 确保代码被发送
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("Process has terminated. Restarting...")
+            self._fail_pending(exclude=cmd_id)
             await self.start_process()
+            self.__process.stdin.write(command.encode())
+            await self.__process.stdin.drain()
 
-        self.__cmd_event.clear()
+    async def submit(
+        self, cmds: Union[str, List[str]], on_output: Callable[[OutputChunk], None] = None, timeout: float = None
+    ) -> asyncio.Future:
+        """发送cmd后立即返回, 不等待前一个cmd执行完成
 
-        full_command = " ".join(cmds) + "\n\n"
-        cmd_id = str(len(self._cmd_space))
-        # 添加cmd到cmd_space
-        self._cmd_space[cmd_id] = {}
-        self._cmd_space[cmd_id]["cmd"] = full_command
+        返回的Future在该cmd执行完成时得到其cmd_space记录, 多个cmd可以连续写入会话的stdin流水执行.
+        on_output会在该cmd的每一段输出到达时被调用.
+        timeout为None时使用self.timeout, 超时的cmd的记录中timed_out为True.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if isinstance(cmds, str):
+            cmds = [cmds]
 
-        if self.is_save_obj:
-            self.manage_work_dir()
-            full_command += self.save_obj_cmd.format(self.obj_save_path(cmd_id))
-
-        full_command += self.print_cmd.format("END_OF_EXECUTION")
-        logger.info(f"Sending command: {full_command.strip()}")
+        future = asyncio.get_running_loop().create_future()
+        full_command = " ".join(cmds) + "\n\n"
+        # 分配cmd_id与写入stdin必须保持相同的顺序
+        async with self.__submit_lock:
+            if self.__process is None:
+                await self.start_process()
+
+            cmd_id = str(len(self._cmd_space))
+            # 添加cmd到cmd_space
+            self._cmd_space[cmd_id] = {}
+            self._cmd_space[cmd_id]["cmd"] = full_command
+            if not self.exec_cmd and self.print_cmd.startswith("print(") and is_incomplete(full_command):
+                # 不完整的Python语句不发送给REPL, 否则该cmd和之后的cmd都不会完成
+                self.__pending[cmd_id] = future
+                self._complete(cmd_id, outputs={"stdout": "", "stderr": "SyntaxError: incomplete input"})
+                return future
+
+            save_obj_cmd = ""
+            if self.is_save_obj:
+                self.manage_work_dir()
+                if self.checkpoint_mode == "background":
+                    save_obj_cmd = self.bg_save_obj_cmd.format(
+                        self.obj_save_path(cmd_id), self.max_inflight_checkpoints, self.snapshot_compression
+                    )
+                else:
+                    save_obj_cmd = self.save_obj_cmd.format(self.obj_save_path(cmd_id), self.snapshot_compression)
+
+            if self.exec_cmd:
+                cache = (str(Path(self.work_dir) / "cell_cache"), self.cell_cache_size) if self.cell_cache else None
+                full_command = self.exec_cmd.format(int(cmd_id), full_command, save_obj_cmd, cache)
+            else:
+                full_command += save_obj_cmd + self.print_cmd.format("END_OF_EXECUTION")
+            logger.info(f"Sending command: {full_command.strip()}")
+
+            self.__pending[cmd_id] = future
+            self.__submitted[cmd_id] = time.time()
+            if on_output is not None:
+                self.__listeners[cmd_id] = on_output
+            if timeout is not None:
+                self.__timeouts[cmd_id] = timeout
+                self._arm_timeout()
+            await self._write(full_command, cmd_id)
+        return future
+
+    async def run_many(self, batch: List[Union[str, List[str]]]) -> List[dict]:
+        """流水发送一批cmd, 全部执行完成后按顺序返回它们的cmd_space记录"""
+        futures = [await self.submit(cmds) for cmds in batch]
+        return list(await asyncio.gather(*futures))
+
+    async def stream(self, cmds: Union[str, List[str]], timeout: float = None) -> AsyncIterator[OutputChunk]:
+        """执行cmd并在输出到达时逐段产出, 每段带有所属的流和到达时间"""
+        chunks = asyncio.Queue()
+        future = await self.submit(cmds, on_output=chunks.put_nowait, timeout=timeout)
+        future.add_done_callback(lambda _: chunks.put_nowait(None))
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        await future
 
+    async def _run(self, cmds, timeout: float = None):
         try:
-            self.__process.stdin.write(full_command.encode())
-            await self.__process.stdin.drain()  # 确保代码被发送
-        except BrokenPipeError:
-            logger.warning("Process has terminated. Restarting...")
-            await self.start_process()
-            self.__process.stdin.write(full_command.encode())
-            await self.__process.stdin.drain()
+            future = await self.submit(cmds, timeout=timeout)
+            # Wait until execution completes
+            return await future
         except KeyboardInterrupt:
             logger.warning("\nReceived keyboard interrupt. Terminating...")
             await self.stop_process()
             raise KeyboardInterrupt()
-        # Wait until execution completes
-        await self.__cmd_event.wait()
 
     def print_cmd_space(self):
-        pprint.pprint(self._cmd_space)
+        pprint.pprint(self._cmd_space.to_dict())
 
     async def run(self):
         while True:
@@ -0,0 +1,239 @@
+"""执行器性能基准, 结果为JSON, 可以与之前的结果比较以发现性能回退
+
+python -m code_executor.benchmark --output benchmark.json --baseline last.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import platform
+import statistics
+import tempfile
+from typing import Callable, Dict, List, Sequence
+import fire
+from loguru import logger
+
+from code_executor.constant import INIT_PROFILES, PyExeConfig
+from code_executor.fork_server import ForkServer
+from code_executor.pyexe import AsyncPyExecutor, InProcessPyExecutor, PyExecutor
+from code_executor.sync_executor import SyncCodeExecutor
+
+# 指标名以单位结尾: _seconds越小越好, _per_second越大越好, 其余只作记录
+LOWER_IS_BETTER = "_seconds"
+HIGHER_IS_BETTER = "_per_second"
+
+QUICK = {
+    "startup_repeat": 2,
+    "latency_cmds": 20,
+    "output_mb": 1,
+    "snapshot_sizes_mb": (1, 4),
+    "scaling_sessions": (1, 2),
+    "scaling_cmds": 5,
+}
+FULL = {
+    "startup_repeat": 5,
+    "latency_cmds": 500,
+    "output_mb": 64,
+    "snapshot_sizes_mb": (1, 16, 128, 1024),
+    "scaling_sessions": (1, 4, 16),
+    "scaling_cmds": 50,
+}
+
+
+def _summary(samples: Sequence[float], name: str) -> Dict[str, float]:
+    return {
+        f"{name}_median_seconds": statistics.median(samples),
+        f"{name}_min_seconds": min(samples),
+        f"{name}_max_seconds": max(samples),
+    }
+
+
+def _timed(fn: Callable) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench_startup(repeat: int) -> dict:
+    """冷启动(每次执行init_code) vs 由fork server派生的热启动, 计时到初始化代码执行完成
+
+    另外记录其它init profile的冷启动, 以及默认profile中init_code和导入最慢的模块的耗时.
+    """
+    results = {}
+    for mode, use_fork_server in (("cold", False), ("warm", True)):
+        # 热启动前先派生一个会话以预先启动fork server, 计时结束后停止
+        primer = PyExecutor(use_fork_server=True, echo=False, report_metrics=False) if use_fork_server else None
+        try:
+            if primer is not None:
+                primer.warm_up()
+            samples = []
+            for _ in range(repeat):
+                pyer = PyExecutor(use_fork_server=use_fork_server, echo=False, report_metrics=False)
+                samples.append(_timed(pyer.warm_up))
+                if not use_fork_server:
+                    trace = pyer.startup_trace()
+                pyer.stop_process()
+        finally:
+            if primer is not None:
+                primer.stop_process()
+        results.update(_summary(samples, mode))
+    results["init_code_seconds"] = trace["init_seconds"]
+    for name, _, cumulative in sorted(trace["modules"], key=lambda module: -module[2])[:5]:
+        results[f"import_{name}_seconds"] = cumulative
+
+    for profile in INIT_PROFILES:
+        if profile == PyExeConfig.init_profile:
+            continue
+        samples = []
+        for _ in range(repeat):
+            pyer = PyExecutor(init_profile=profile, echo=False, report_metrics=False)
+            samples.append(_timed(pyer.warm_up))
+            pyer.stop_process()
+        results.update(_summary(samples, f"cold_{profile.replace('-', '_')}"))
+    return results
+
+
+def bench_latency(n_cmds: int) -> dict:
+    """平凡cmd的往返延迟, 以及流水提交时的吞吐; 同时测量inprocess后端, 与会话进程后端对比"""
+    results = {}
+    for prefix, executor in (("", PyExecutor), ("inprocess_", InProcessPyExecutor)):
+        pyer = executor(echo=False, report_metrics=False)
+        pyer.warm_up()
+        samples = [_timed(lambda: pyer._run("pass")) for _ in range(n_cmds)]
+        pipelined = _timed(lambda: pyer.run_many(["pass"] * n_cmds))
+        pyer.stop_process()
+        results.update(_summary(samples, f"{prefix}round_trip"))
+        results[f"{prefix}pipelined_cmds_per_second"] = n_cmds / pipelined
+    return results
+
+
+def bench_output(size_mb: int) -> dict:
+    """大量输出的吞吐: 分帧协议(PyExecutor)与行哨兵协议(bash, 经由save_and_print_output)"""
+    size = size_mb << 20
+    pyer = PyExecutor(echo=False, report_metrics=False)
+    pyer.warm_up()
+    framed = _timed(lambda: pyer._run(f"for _ in range({size >> 16}): print('a' * 65535)"))
+    pyer.stop_process()
+    bash = SyncCodeExecutor(echo=False, report_metrics=False)
+    bash._run("true")
+    sentinel = _timed(lambda: bash._run(f"head -c {size} /dev/zero | tr '\\0' 'a' | fold -w 1023"))
+    bash.stop_process()
+    return {"framed_mb_per_second": size_mb / framed, "sentinel_mb_per_second": size_mb / sentinel}
+
+
+def bench_snapshot(sizes_mb: Sequence[int]) -> dict:
+    """全局作用域从1MB增长时save_object与load()的开销, 一半为numpy数组, 一半为DataFrame"""
+    results = {}
+    for size_mb in sizes_mb:
+        work_dir = tempfile.mkdtemp(prefix="code_executor_benchmark_")
+        try:
+            n = (size_mb << 20) // 16  # 两个float64对象各占一半
+            pyer = PyExecutor(work_dir, True, echo=False, report_metrics=False)
+            metrics = pyer._run(f"x = np.random.rand({n}); df = pd.DataFrame({{'a': np.random.rand({n})}})")["metrics"]
+            results[f"{size_mb}mb_save_seconds"] = metrics["snapshot_time"]
+            results[f"{size_mb}mb_snapshot_bytes"] = metrics["snapshot_bytes"]
+            # 在已启动的会话中恢复快照, 不计入解释器启动的时间
+            results[f"{size_mb}mb_load_seconds"] = _timed(lambda: pyer.restore("0"))
+            results[f"{size_mb}mb_lazy_load_seconds"] = _timed(lambda: pyer.restore("0", lazy=True))
+            results[f"{size_mb}mb_lazy_first_access_seconds"] = _timed(lambda: pyer._run("x.sum(); df.shape"))
+            pyer.stop_process()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def bench_scaling(sessions: Sequence[int], n_cmds: int) -> dict:
+    """多个会话并发执行时sync与async执行器的总吞吐, 每个cmd占用少量CPU"""
+    code = "sum(range(100000))"
+    results = {}
+    for n in sessions:
+        executors = [PyExecutor(use_fork_server=True, echo=False, report_metrics=False) for _ in range(n)]
+        for pyer in executors:
+            pyer.warm_up()
+        start = time.perf_counter()
+        futures = [pyer.submit(code) for _ in range(n_cmds) for pyer in executors]
+        for future in futures:
+            future.result()
+        results[f"sync_{n}_sessions_cmds_per_second"] = n * n_cmds / (time.perf_counter() - start)
+        for pyer in executors:
+            pyer.stop_process()
+
+        async def run_async():
+            executors = [AsyncPyExecutor(use_fork_server=True, echo=False, report_metrics=False) for _ in range(n)]
+            await asyncio.gather(*(pyer.warm_up() for pyer in executors))
+            start = time.perf_counter()
+            futures = [await pyer.submit(code) for _ in range(n_cmds) for pyer in executors]
+            await asyncio.gather(*futures)
+            elapsed = time.perf_counter() - start
+            for pyer in executors:
+                await pyer.stop_process()
+            return elapsed
+
+        results[f"async_{n}_sessions_cmds_per_second"] = n * n_cmds / asyncio.run(run_async())
+    return results
+
+
+def run_benchmarks(quick: bool = False, **overrides) -> dict:
+    """执行所有基准, overrides可以覆盖QUICK/FULL中的规模参数"""
+    params = {**(QUICK if quick else FULL), **overrides}
+    results = {
+        "meta": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+            "params": params,
+        },
+        "results": {},
+    }
+    benchmarks = {
+        "startup": lambda: bench_startup(params["startup_repeat"]),
+        "latency": lambda: bench_latency(params["latency_cmds"]),
+        "output": lambda: bench_output(params["output_mb"]),
+        "snapshot": lambda: bench_snapshot(params["snapshot_sizes_mb"]),
+        "scaling": lambda: bench_scaling(params["scaling_sessions"], params["scaling_cmds"]),
+    }
+    for name, bench in benchmarks.items():
+        logger.info(f"Running benchmark {name} ...")
+        results["results"][name] = bench()
+    return results
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.2) -> List[str]:
+    """返回相比baseline变差超过tolerance比例的指标"""
+    regressions = []
+    for group, metrics in current["results"].items():
+        for name, value in metrics.items():
+            old = baseline["results"].get(group, {}).get(name)
+            if not old:
+                continue
+            if name.endswith(LOWER_IS_BETTER) and value > old * (1 + tolerance):
+                regressions.append(f"{group}.{name}: {old:.6g} -> {value:.6g}")
+            elif name.endswith(HIGHER_IS_BETTER) and value < old * (1 - tolerance):
+                regressions.append(f"{group}.{name}: {old:.6g} -> {value:.6g}")
+    return regressions
+
+
+def main(output: str = "benchmark.json", quick: bool = False, baseline: str = None, tolerance: float = 0.2):
+    """执行基准并把结果写入output, 指定baseline时有性能回退则以非0状态退出"""
+    try:
+        results = run_benchmarks(quick)
+    finally:
+        ForkServer.close_all()
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    logger.info(f"Benchmark results saved to {output}")
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            regressions = compare(json.load(f), results, tolerance)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,40 +1,1057 @@
 from textwrap import dedent
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 
 
 @dataclass(frozen=True)
 class ExeConfig:
     session_command: list   # 启动一个 Python 或者 bash 交互式会话
     print_cmd: str
-    save_obj_cmd: str = None
-    load_obj_cmd: str = None
+    save_obj_cmd: str = None  # 格式参数依次为保存路径, 压缩级别
+    load_obj_cmd: str = None  # 格式参数依次为快照路径, 是否延迟恢复, 是否先清空全局作用域
     init_code: str = None
+    init_prelude: str = ""  # 在init profile之前执行的代码, 如启动追踪
+    init_profiles: dict = None  # init profile名: 在init_code之前执行的导入代码
+    init_profile: str = None  # 使用的init profile, 见with_profile()
+    exec_cmd: str = None  # 不为None时使用分帧结果协议, 格式参数依次为cmd_id, 代码, 代码执行后的收尾代码, cell缓存配置
+    bg_save_obj_cmd: str = None  # 后台保存快照, 格式参数依次为保存路径, 最多同时进行的后台快照数, 压缩级别
+    flush_obj_cmd: str = None  # 等待所有后台快照完成, 输出失败的快照数量
+    fork_cmd: str = None  # 以写时复制的方式fork出新会话, 格式参数为传递新会话管道的unix socket路径
+    backend: str = "subprocess"  # 执行后端, 见BACKENDS
+    inprocess_prelude: str = ""  # inprocess后端在init profile之前执行的代码
+    inprocess_init_code: str = None  # inprocess后端在init profile之后执行的代码
 
     def __post_init__(self):
+        assert self.backend in BACKENDS, f"unknown backend {self.backend!r}!"
         if self.init_code is not None:
-            self.session_command.append(self.init_code)
+            self.session_command.append(self.init_prelude + self._profile_code() + self.init_code)
+
+    def _profile_code(self) -> str:
+        return self.init_profiles[self.init_profile] if self.init_profile is not None else ""
+
+    def _replace(self, **changes) -> "ExeConfig":
+        # __post_init__会把init_code追加到会话命令, 需要先去掉
+        session_command = self.session_command[:-1] if self.init_code is not None else list(self.session_command)
+        return replace(self, session_command=session_command, **changes)
+
+    def with_profile(self, name: str) -> "ExeConfig":
+        """使用另一个init profile的配置, 不同profile的会话命令不同, 因此也由不同的fork server派生"""
+        assert self.init_profiles and name in self.init_profiles, f"unknown init profile {name!r}!"
+        return self._replace(init_profile=name)
+
+    def with_backend(self, name: str) -> "ExeConfig":
+        """使用另一个执行后端的配置"""
+        assert name in BACKENDS, f"unknown backend {name!r}!"
+        return self._replace(backend=name)
+
+    @property
+    def inprocess_code(self) -> str:
+        """inprocess后端在命名空间中执行的初始化代码"""
+        assert self.inprocess_init_code is not None, "the config does not support the inprocess backend!"
+        return self.inprocess_prelude + self._profile_code() + self.inprocess_init_code
+
+
+# subprocess: 每个会话是一个独立的解释器进程, 经由管道通信;
+# inprocess: 在宿主进程内以compile/exec执行, 没有进程间通信的开销, 但与宿主进程共享内存和模块, 只用于可信代码
+BACKENDS = ("subprocess", "inprocess")
+
+
+# 分帧结果协议的会话端实现, 帧格式见code_executor.protocol
+FRAMED_RUNTIME_CODE = dedent("""
+    def __cx_framed_runtime__():
+        import io, os, sys, ast, json, time, signal, struct, tempfile, resource, functools, linecache, traceback
+
+        header = struct.Struct("!IBBI")
+        channel = {"fd": None, "cmd_id": 0, "capture": None, "running": False}
+
+        def write_frame(stream, payload=b"", status=0):
+            if channel["fd"] is None:
+                channel["fd"] = int(os.environ["CODE_EXECUTOR_FRAME_FD"])
+            data = memoryview(header.pack(channel["cmd_id"], stream, status, len(payload)) + payload)
+            # 帧只写入一部分时抛出的KeyboardInterrupt会使之后所有的帧错位, 写入期间屏蔽SIGINT, 之后再处理
+            mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+            try:
+                while data:
+                    data = data[os.write(channel["fd"], data):]
+            finally:
+                signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+        class FrameStream(io.TextIOBase):
+            encoding = "utf-8"
+
+            def __init__(self, stream):
+                self.stream = stream
+
+            def writable(self):
+                return True
+
+            def write(self, text):
+                if text:
+                    write_frame(self.stream, text.encode("utf-8", "backslashreplace"))
+                    if channel["capture"] is not None:
+                        channel["capture"].append((self.stream, text))
+                return len(text)
+
+        streams = (FrameStream(1), FrameStream(2))
+
+        def run_source(source, filename, namespace):
+            # 以交互模式执行源码, 表达式语句的值会被打印, 返回非0表示抛出了异常
+            try:
+                # 中断在cmd开始执行之前到达, 见on_interrupt
+                if channel["running"] and take_interrupt():
+                    raise KeyboardInterrupt
+                linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+                tree = ast.parse(source, filename)
+                prepare = namespace.get("__cx_prepare__")
+                if prepare is not None:
+                    prepare(tree)
+                exec(compile(ast.Interactive(tree.body), filename, "single"), namespace)
+            except SystemExit:
+                raise
+            except BaseException as e:
+                tb = None if isinstance(e, SyntaxError) else e.__traceback__.tb_next
+                traceback.print_exception(type(e), e, tb)
+                return 1
+            return 0
+
+        def run_captured(source, filename, namespace):
+            channel["capture"] = captured = []
+            try:
+                return run_source(source, filename, namespace), captured
+            finally:
+                channel["capture"] = None
+
+        def take_interrupt():
+            # 执行器先把要中断的cmd_id写入中断文件再发送SIGINT, 见code_executor.protocol.interrupt_path;
+            # 中断文件指向当前cmd时删除并返回True; 指向其它cmd时保留, 该cmd可能尚未开始执行,
+            # 过期的中断文件会被执行器的下一次中断覆盖
+            path = os.path.join(tempfile.gettempdir(), f"code_executor_{os.getpid()}.interrupt")
+            try:
+                with open(path) as f:
+                    if int(f.read()) != channel["cmd_id"]:
+                        return False
+                os.remove(path)
+            except (OSError, ValueError):
+                return False
+            return True
+
+        def on_interrupt(signum, frame):
+            # 只在该cmd的代码正在执行时抛出KeyboardInterrupt, 迟到的中断不会打断之后的cmd或快照;
+            # 目标cmd尚未开始执行时由run_source在开始执行该cmd时处理
+            if channel["running"] and take_interrupt():
+                raise KeyboardInterrupt
+
+        def cx_exec(cmd_id, source, post="", cache=None):
+            # 结束帧的负载为本cmd在会话端测得的指标(JSON), 见code_executor.metrics
+            # cache不为None时为(缓存目录, 最大字节数), 经由cell结果缓存执行
+            channel["cmd_id"] = cmd_id
+            namespace = sys.modules["__main__"].__dict__
+            status = 1
+            metrics = {"started": time.time()}
+            peak_rss, cpu, wall = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, time.process_time(), time.perf_counter()
+            sys.stdout, sys.stderr = streams
+            try:
+                cell_cache = namespace.get("__cx_cell_cache__") if cache else None
+                channel["running"] = True
+                try:
+                    if cell_cache is None:
+                        status = run_source(source, f"<cell-{cmd_id}>", namespace)
+                    else:
+                        execute = functools.partial(run_captured, source, f"<cell-{cmd_id}>", namespace)
+                        status, metrics["cell_cache"] = cell_cache(*cache).run(source, execute)
+                finally:
+                    channel["running"] = False
+                metrics["wall_time"] = time.perf_counter() - wall
+                metrics["cpu_time"] = time.process_time() - cpu
+                metrics["rss_peak_delta"] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss) * 1024
+                if post:
+                    namespace.pop("__cx_snapshot_stats__", None)
+                    wall = time.perf_counter()
+                    run_source(post, f"<post-{cmd_id}>", namespace)
+                    metrics["snapshot_time"] = time.perf_counter() - wall
+                    stats = namespace.pop("__cx_snapshot_stats__", None)
+                    if stats is not None:  # 后台快照在子进程中序列化, 这里只计入fork的耗时
+                        metrics["snapshot_bytes"], metrics["snapshot_written_bytes"] = stats["bytes"], stats["written"]
+            finally:
+                sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+                write_frame(0, json.dumps(metrics).encode(), status=status)
+
+        sys.ps1, sys.ps2 = "", ""
+        signal.signal(signal.SIGINT, on_interrupt)
+        globals()["__cx_exec__"] = cx_exec
+
+    __cx_framed_runtime__()
+""")
+
+
+# 全局作用域快照的会话端实现: 每个变量单独序列化, 按内容哈希存入work_dir/objects,
+# 每个cmd的快照只是一个 变量名->对象文件名 的manifest, 未变化的对象在不同cmd之间去重
+SNAPSHOT_CODE = dedent("""
+    def __cx_snapshot_serializers__():
+        # 按类型选择的序列化方式, 保存时依次尝试, dill作为兜底
+        # 每一项为 (对象文件后缀, predicate(value), dump(value, compression) -> 字节块列表, load(path) -> value)
+        # numpy/pandas只在被用户代码真正导入后才参与类型判断, 以免init_code或保存快照时导入重型模块
+        import io, sys, zlib, importlib.util
+
+        def imported(name):
+            module = sys.modules.get(name)
+            return None if isinstance(module, importlib.util._LazyModule) else module
+
+        def available(name):
+            # 已在sys.modules中的模块可能是延迟导入的, find_spec会读取其__spec__而触发导入
+            return name in sys.modules or importlib.util.find_spec(name) is not None
+
+        serializers = []
+        if available("numpy"):
+
+            def is_array(value):
+                np = imported("numpy")
+                return np is not None and type(value) in (np.ndarray, np.memmap) and not value.dtype.hasobject
+
+            def dump_array(value, compression):
+                # 不压缩, 以便恢复时直接内存映射
+                import numpy as np
+
+                value = np.ascontiguousarray(value)
+                header = io.BytesIO()
+                np.lib.format.write_array_header_2_0(header, np.lib.format.header_data_from_array_1_0(value))
+                return [header.getvalue(), memoryview(value.reshape(-1).view(np.uint8))]
+
+            def load_array(path):
+                # 写时复制的内存映射, 恢复耗时与数据量无关; 转为ndarray视图, 以免np.memmap无法被pickle
+                import numpy as np
+
+                return np.load(path, mmap_mode="c").view(np.ndarray)
+
+            serializers.append(("npy", is_array, dump_array, load_array))
+
+        if available("pandas") and available("pyarrow"):
+
+            def is_frame(value):
+                pd = imported("pandas")
+                return pd is not None and type(value) is pd.DataFrame
+
+            def dump_frame(value, compression):
+                buffer = io.BytesIO()
+                value.to_parquet(buffer, compression="zstd" if compression else None, compression_level=compression)
+                return [buffer.getbuffer()]
+
+            def load_frame(path):
+                import pandas as pd
+
+                return pd.read_parquet(path)
+
+            serializers.append(("parquet", is_frame, dump_frame, load_frame))
+        elif available("pandas"):
+
+            def warn_frame(value):
+                # 不参与序列化, 只在第一次用dill保存DataFrame时提示安装pyarrow(code-executor[parquet])
+                pd = imported("pandas")
+                if pd is not None and type(value) is pd.DataFrame:
+                    import warnings
+
+                    warnings.warn("pyarrow is not installed, DataFrames are snapshotted with dill instead of parquet.")
+                return False
+
+            def load_frame(path):
+                # 快照由装有pyarrow的环境写出时, 由pandas给出缺少pyarrow的ImportError
+                import pandas as pd
+
+                return pd.read_parquet(path)
+
+            serializers.append(("parquet", warn_frame, None, load_frame))
+
+        def dump_dill(value, compression):
+            import dill
+
+            data = dill.dumps(value)
+            return [zlib.compress(data, compression) if compression else data]
+
+        def load_dill(path):
+            import dill
+
+            with open(path, "rb") as f:
+                data = f.read()
+            # pickle数据以0x80开头, zlib数据以0x78开头
+            return dill.loads(zlib.decompress(data) if data[:1] == b"x" else data)
+
+        serializers.append(("", lambda value: True, dump_dill, load_dill))
+        return serializers
+
+    __cx_serializers__ = __cx_snapshot_serializers__()
+
+    def register_serializer(suffix, predicate, dump, load):
+        # 注册自定义类型的序列化方式, 优先于内置方式
+        __cx_serializers__.insert(0, (suffix, predicate, dump, load))
+
+    class __cx_lazy_object__(object):
+        # 延迟恢复的对象占位符, 第一次被使用时才反序列化, 并把全局变量替换为真实对象
+        __slots__ = ("_cx_name", "_cx_key", "_cx_loader", "_cx_value")
+
+        def __init__(self, name, key, loader):
+            object.__setattr__(self, "_cx_name", name)
+            object.__setattr__(self, "_cx_key", key)
+            object.__setattr__(self, "_cx_loader", loader)
+
+        def _cx_resolve(self):
+            try:
+                return object.__getattribute__(self, "_cx_value")
+            except AttributeError:
+                pass
+            value = object.__getattribute__(self, "_cx_loader")()
+            object.__setattr__(self, "_cx_value", value)
+            name = object.__getattribute__(self, "_cx_name")
+            if globals().get(name) is self:
+                globals()[name] = value
+            if __cx_lazy__.get(name) is self:
+                del __cx_lazy__[name]
+            return value
+
+        def __getattr__(self, attr):
+            return getattr(self._cx_resolve(), attr)
+
+        def __setattr__(self, attr, value):
+            setattr(self._cx_resolve(), attr, value)
+
+        def __delattr__(self, attr):
+            delattr(self._cx_resolve(), attr)
+
+        @property
+        def __class__(self):
+            return type(self._cx_resolve())
+
+    def __cx_lazy_operators__():
+        # 隐式调用的特殊方法不经过__getattr__, 需要逐个转发给真实对象
+        import operator
+
+        operators = {
+            "__repr__": repr, "__str__": str, "__bool__": bool, "__hash__": hash, "__len__": len,
+            "__iter__": iter, "__next__": next, "__index__": operator.index, "__int__": int, "__float__": float,
+            "__getitem__": operator.getitem, "__setitem__": operator.setitem, "__delitem__": operator.delitem,
+            "__contains__": operator.contains, "__call__": lambda value, *args, **kwargs: value(*args, **kwargs),
+            "__enter__": lambda value: value.__enter__(), "__exit__": lambda value, *args: value.__exit__(*args),
+            "__array__": lambda value, dtype=None, copy=None: __import__("numpy").asarray(value, dtype=dtype),
+            "__neg__": operator.neg, "__pos__": operator.pos, "__abs__": abs, "__invert__": operator.invert,
+        }
+        for name in ("eq", "ne", "lt", "le", "gt", "ge"):
+            operators[f"__{name}__"] = getattr(operator, name)
+        for name in ("add", "sub", "mul", "truediv", "floordiv", "mod", "pow", "matmul", "and", "or", "xor"):
+            function = getattr(operator, f"{name}_" if name in ("and", "or") else name)
+            operators[f"__{name}__"] = function
+            operators[f"__r{name}__"] = (lambda function: lambda value, other: function(other, value))(function)
+        for name, function in operators.items():
+            method = (lambda function: lambda self, *args, **kwargs: function(self._cx_resolve(), *args, **kwargs))
+            setattr(__cx_lazy_object__, name, method(function))
+
+    __cx_lazy_operators__()
+    __cx_lazy__ = {}  # name: 尚未恢复的__cx_lazy_object__
+
+    def __cx_referenced_names__(tree, resolve=lambda key: True):
+        # cell读取的全局变量名, 包括被引用函数所使用的全局变量; 途经的延迟对象中resolve(对象文件名)为True的会被恢复
+        import ast, types
+
+        names = [
+            node.target.id if isinstance(node, ast.AugAssign) else node.id
+            for node in ast.walk(tree)
+            if (isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load))
+            or (isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name))
+        ]
+        seen = []
+        while names:
+            name = names.pop()
+            if name in seen:
+                continue
+            seen.append(name)
+            value = globals().get(name)
+            if type(value) is __cx_lazy_object__:
+                if not resolve(object.__getattribute__(value, "_cx_key")):
+                    continue
+                value = value._cx_resolve()
+            functions = [value] if isinstance(value, types.FunctionType) else []
+            # 会话中定义的类及其实例的方法同样会读取全局变量, 库中的类只读取其所在模块的全局变量
+            cls = value if isinstance(value, type) else type(value)
+            for base in cls.__mro__ if cls.__module__ == "__main__" else ():
+                for attr in vars(base).values():
+                    if isinstance(attr, (staticmethod, classmethod)):
+                        attr = attr.__func__
+                    if isinstance(attr, property):
+                        functions.extend(f for f in (attr.fget, attr.fset, attr.fdel) if f is not None)
+                    elif isinstance(attr, types.FunctionType):
+                        functions.append(attr)
+            for function in functions:
+                codes = [function.__code__]
+                while codes:
+                    code = codes.pop()
+                    names.extend(code.co_names)
+                    codes.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+        return seen
+
+    def __cx_prepare__(tree):
+        # cell执行前恢复其中引用到的延迟对象
+        if __cx_lazy__:
+            __cx_referenced_names__(tree)
+
+    def __cx_dump_object__(value, compression=None):
+        # 按类型序列化对象, 返回(对象文件名, 字节块列表), 对象文件名为内容哈希加序列化方式的后缀
+        import hashlib
+
+        error = None
+        for suffix, predicate, dump, _ in __cx_serializers__:
+            try:
+                if predicate(value):
+                    chunks = dump(value, compression)
+                    break
+            except Exception as e:
+                error = e
+        else:
+            raise error
+        digest = hashlib.blake2b(digest_size=20)
+        for chunk in chunks:
+            digest.update(chunk)
+        return digest.hexdigest() + (f".{suffix}" if suffix else ""), chunks
+
+    def __cx_write_object__(store, key, chunks):
+        # 把对象写入按内容寻址的对象仓库, 已存在时跳过, 返回新写入的字节数
+        import os
+
+        path = os.path.join(store, key[:2], key)
+        if os.path.exists(path):
+            return 0
+        written = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+            for chunk in chunks:
+                written += f.write(chunk)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+        return written
+
+    def __cx_read_object__(store, key):
+        import os
+
+        loaders = {suffix: load for suffix, _, _, load in reversed(__cx_serializers__)}
+        return loaders[key.partition(".")[2]](os.path.join(store, key[:2], key))
+
+    def save_object(filename, compression=None):
+        import os, sys, json, types
+
+        store = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(filename))), "objects")
+        init_globals = globals().get("__cx_init_globals__", {})
+        cache = globals().setdefault("__cx_snapshot_cache__", {})  # name: (不可变对象, 对象文件名)
+        immutable = (int, float, complex, str, bytes, bool, type(None), types.ModuleType)
+        manifest = {}
+        stats = {"bytes": 0, "written": 0}  # 本次序列化的字节数, 其中新写入对象仓库的字节数
+        for name, value in list(globals().items()):
+            if name.startswith("__") or (name in init_globals and init_globals[name] is value):
+                continue
+            if type(value) is __cx_lazy_object__:  # 未恢复的对象沿用原来的对象文件
+                manifest[name] = object.__getattribute__(value, "_cx_key")
+                continue
+            cached = cache.get(name)
+            if cached is not None and cached[0] is value:
+                manifest[name] = cached[1]
+                continue
+            try:
+                key, chunks = __cx_dump_object__(value, compression)
+            except Exception as e:
+                print(f"save_object: skip {name}: {e}", file=sys.stderr)
+                continue
+            stats["bytes"] += sum(len(chunk) for chunk in chunks)
+            stats["written"] += __cx_write_object__(store, key, chunks)
+            manifest[name] = key
+            if isinstance(value, immutable):
+                cache[name] = (value, key)
+        with open(f"{filename}.{os.getpid()}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{filename}.{os.getpid()}.tmp", filename)
+        globals()["__cx_snapshot_stats__"] = stats
+
+    def load_object(filename, lazy=False, reset=False):
+        # lazy为True时只安装占位符, reset为True时先清空当前全局作用域中init_code之外的对象
+        import os, json
+
+        if reset:
+            init_globals = globals().get("__cx_init_globals__", {})
+            for name in [name for name in globals() if not name.startswith("__")]:
+                del globals()[name]
+            globals().update({k: v for k, v in init_globals.items() if not k.startswith("__")})
+            __cx_lazy__.clear()
+        if filename.endswith(".pickle"):  # 旧版本保存的整体快照
+            import dill
+
+            with open(filename, "rb") as f:
+                globals().update(dill.load(f))
+            return
+        store = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(filename))), "objects")
+        loaders = {suffix: load for suffix, _, _, load in reversed(__cx_serializers__)}
+        with open(filename, "r") as f:
+            manifest = json.load(f)
+        for name, key in manifest.items():
+            load, path = loaders[key.partition(".")[2]], os.path.join(store, key[:2], key)
+            if lazy:
+                proxy = __cx_lazy_object__(name, key, lambda load=load, path=path: load(path))
+                globals()[name] = __cx_lazy__[name] = proxy
+            else:
+                globals()[name] = load(path)
+                __cx_lazy__.pop(name, None)
+
+    def save_object_async(filename, max_inflight=2, compression=None):
+        # fork出子进程在后台写快照, 子进程持有fork时刻全局作用域的写时复制副本, 当前cmd无需等待序列化和写盘
+        import os, sys, traceback
+
+        inflight = globals().setdefault("__cx_checkpoints__", [])
+        for pid in list(inflight):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                inflight.remove(pid)
+                globals()["__cx_checkpoint_failures__"] = globals().get("__cx_checkpoint_failures__", 0) + (status != 0)
+        while len(inflight) >= max_inflight:
+            _, status = os.waitpid(inflight.pop(0), 0)
+            globals()["__cx_checkpoint_failures__"] = globals().get("__cx_checkpoint_failures__", 0) + (status != 0)
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                sys.stdout = sys.stderr = sys.__stderr__  # 子进程不能向帧通道写入
+                if "CODE_EXECUTOR_FRAME_FD" in os.environ:
+                    os.close(int(os.environ["CODE_EXECUTOR_FRAME_FD"]))
+                save_object(filename, compression)
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        inflight.append(pid)
+
+    def flush_checkpoints():
+        # 等待所有后台快照写入完成, 返回自上次调用以来失败的快照数量
+        import os
+
+        inflight = globals().setdefault("__cx_checkpoints__", [])
+        failures = globals().get("__cx_checkpoint_failures__", 0)
+        while inflight:
+            _, status = os.waitpid(inflight.pop(0), 0)
+            failures += status != 0
+        globals()["__cx_checkpoint_failures__"] = 0
+        return failures
+""")
+
+# cell结果缓存的会话端实现: 以 代码 + 其读取的全局变量的内容哈希 为键, 命中时跳过执行,
+# 回放缓存的输出并从work_dir/cell_cache/objects恢复cell写入的变量.
+# 直接调用随机数, 时钟或外部I/O的cell不会被缓存; 只检查cell自身的调用, 经由函数间接依赖这些隐藏状态的cell
+# 需要在代码中加上 "# cx: nocache" 注释以跳过缓存
+CELL_CACHE_CODE = dedent("""
+    class __cx_cell_cache_store__(object):
+        # 条目按最近使用的顺序排列, 总大小超过max_bytes时淘汰最久未使用的条目及不再被引用的对象文件
+
+        # 调用的函数按导入后的完整名称匹配, 等于或以其中某一项加"."开头时cell不可缓存
+        uncacheable = (
+            "random", "secrets", "uuid", "numpy.random", "io", "socket", "subprocess", "urllib", "http", "requests",
+            "glob", "pathlib", "builtins.open", "builtins.input", "os.urandom", "os.getpid", "os.listdir", "os.scandir",
+            "os.walk", "os.stat", "os.path.exists", "os.path.getmtime", "os.path.getsize", "time.time", "time.time_ns",
+            "time.perf_counter", "time.perf_counter_ns", "time.monotonic", "time.monotonic_ns", "time.process_time",
+            "datetime.datetime.now", "datetime.datetime.today", "datetime.datetime.utcnow", "datetime.date.today",
+            "numpy.load", "numpy.loadtxt", "numpy.genfromtxt", "numpy.fromfile", "pandas.read_csv",
+            "pandas.read_parquet", "pandas.read_json", "pandas.read_excel", "pandas.read_sql", "pandas.read_pickle",
+        )
+        def __init__(self, root, max_bytes):
+            import os, json
+
+            self.root, self.max_bytes = root, max_bytes
+            self.store = os.path.join(root, "objects")
+            self.index_path = os.path.join(root, "index.json")
+            self.entries = {}  # key: {outputs, deleted, objects, size}
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r") as f:
+                    self.entries = dict(json.load(f))
+
+        def save_index(self):
+            import os, json
+
+            os.makedirs(self.root, exist_ok=True)
+            with open(f"{self.index_path}.tmp", "w") as f:
+                json.dump(list(self.entries.items()), f)
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+
+        @staticmethod
+        def cell_locals(tree):
+            # 在被读取之前就由cell顶层语句(赋值, import, def, class)绑定的变量名, 它们原来的值不影响执行结果
+            import ast
+
+            bound, reads = set(), set()
+            for stmt in tree.body:
+                for node in ast.walk(stmt):
+                    if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in bound:
+                        reads.add(node.id)
+                    elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+                        reads.add(node.target.id)
+                if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+                    bound.update((alias.asname or alias.name).partition(".")[0] for alias in stmt.names)
+                elif isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                    bound.add(stmt.name)
+                elif isinstance(stmt, (ast.Assign, ast.AnnAssign)) and getattr(stmt, "value", None) is not None:
+                    targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+                    bound.update(target.id for target in targets if isinstance(target, ast.Name))
+            return bound - reads
+
+        @staticmethod
+        def qualified_name(name, aliases):
+            # 变量名对应的模块或函数的完整名称, cell中的import优先于全局作用域
+            import types, builtins
+
+            if name in aliases:
+                return aliases[name]
+            if name not in globals():
+                return f"builtins.{name}" if hasattr(builtins, name) else None
+            value = globals()[name]
+            if type(value) is __cx_lazy_object__:
+                return None
+            if isinstance(value, types.ModuleType):
+                return value.__name__
+            module, qualname = getattr(value, "__module__", None), getattr(value, "__qualname__", None)
+            return f"{module}.{qualname}" if isinstance(module, str) and isinstance(qualname, str) else None
+
+        def calls_uncacheable(self, tree):
+            # cell是否直接调用了依赖随机数, 时钟或外部I/O的函数
+            import ast
+
+            aliases = {}
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    for alias in node.names:
+                        root = alias.name.partition(".")[0]
+                        aliases[alias.asname or root] = alias.name if alias.asname else root
+                elif isinstance(node, ast.ImportFrom) and node.module:
+                    for alias in node.names:
+                        aliases[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+            for node in ast.walk(tree):
+                if not isinstance(node, ast.Call):
+                    continue
+                attrs, func = [], node.func
+                while isinstance(func, ast.Attribute):
+                    attrs.append(func.attr)
+                    func = func.value
+                root = self.qualified_name(func.id, aliases) if isinstance(func, ast.Name) else None
+                if root is None:
+                    continue
+                name = ".".join([root] + attrs[::-1])
+                if any(name == prefix or name.startswith(prefix + ".") for prefix in self.uncacheable):
+                    return True
+            return False
+
+        def fingerprint(self, source, tree):
+            # 读取的变量中无法序列化, 带有nocache注释或直接调用了随机数/时钟/I/O的cell不可缓存, 返回None;
+            # 否则返回(键, 变量名->对象文件名)
+            import hashlib, types
+
+            if "# cx: nocache" in source or self.calls_uncacheable(tree):
+                return None
+            digest = hashlib.blake2b(source.encode(), digest_size=20)
+            keys, missing = {}, object()
+            # 延迟对象直接使用其对象文件名, 只恢复可能是函数的dill对象以追踪其读取的全局变量
+            cell_locals = self.cell_locals(tree)
+            for name in sorted(__cx_referenced_names__(tree, lambda key: "." not in key)):
+                if name in cell_locals:
+                    continue
+                value = globals().get(name, missing)
+                if value is missing:
+                    key = "missing"
+                elif type(value) is __cx_lazy_object__:
+                    key = object.__getattribute__(value, "_cx_key")
+                elif isinstance(value, types.ModuleType):
+                    key = f"module:{value.__name__}"
+                else:
+                    try:
+                        key = __cx_dump_object__(value)[0]
+                    except Exception:
+                        return None
+                keys[name] = key
+                digest.update(f"{name}={key};".encode())
+            return digest.hexdigest(), keys
+
+        def apply(self, entry):
+            # 恢复cell写入的变量并回放输出, 对象文件缺失时返回False
+            import sys, importlib
+
+            try:
+                values = {
+                    name: importlib.import_module(key[7:]) if key.startswith("module:")
+                    else __cx_read_object__(self.store, key)
+                    for name, key in entry["outputs"].items()
+                }
+            except Exception:
+                return False
+            for name in entry["deleted"]:
+                globals().pop(name, None)
+                __cx_lazy__.pop(name, None)
+            for name, value in values.items():
+                globals()[name] = value
+                __cx_lazy__.pop(name, None)
+            for stream, text in entry["output"]:
+                (sys.stdout if stream == 1 else sys.stderr).write(text)
+            return True
+
+        def record(self, key, inputs, before, captured):
+            # 记录cell执行后新建, 重新赋值或原地修改了的变量
+            import os, types
+
+            outputs, dumped, size = {}, {}, sum(len(text.encode()) for _, text in captured)
+            for name, value in list(globals().items()):
+                if name.startswith("__") or type(value) is __cx_lazy_object__:
+                    continue
+                unchanged = name in before and before[name] is value
+                if unchanged and (name not in inputs or isinstance(value, types.ModuleType)):
+                    continue
+                if isinstance(value, types.ModuleType):
+                    outputs[name] = f"module:{value.__name__}"
+                    continue
+                object_key, chunks = __cx_dump_object__(value)
+                if inputs.get(name) != object_key:
+                    outputs[name] = object_key
+                    dumped[object_key] = chunks
+            size += sum(len(chunk) for chunks in dumped.values() for chunk in chunks)
+            if size > self.max_bytes:
+                return
+            for object_key, chunks in dumped.items():
+                __cx_write_object__(self.store, object_key, chunks)
+            objects = list(dumped)
+            deleted = [name for name in before if name not in globals() and not name.startswith("__")]
+            self.entries[key] = {
+                "outputs": outputs, "deleted": deleted, "output": captured, "objects": objects, "size": size
+            }
+            total = sum(entry["size"] for entry in self.entries.values())
+            while total > self.max_bytes:
+                evicted = self.entries.pop(next(iter(self.entries)))
+                total -= evicted["size"]
+                referenced = {k for entry in self.entries.values() for k in entry["objects"]}
+                for object_key in set(evicted["objects"]) - referenced:
+                    try:
+                        os.remove(os.path.join(self.store, object_key[:2], object_key))
+                    except FileNotFoundError:
+                        pass
+
+        def run(self, source, execute):
+            # execute()执行cell并返回(状态, 捕获的输出[(流, 文本)]), 返回(状态, hit/miss/skip)
+            import ast
+
+            try:
+                fingerprint = self.fingerprint(source, ast.parse(source))
+            except SyntaxError:
+                fingerprint = None
+            if fingerprint is None:
+                return execute()[0], "skip"
+            key, inputs = fingerprint
+            entry = self.entries.pop(key, None)
+            if entry is not None and self.apply(entry):
+                self.entries[key] = entry
+                self.save_index()
+                return 0, "hit"
+            before = dict(globals())
+            status, captured = execute()
+            if status == 0:
+                try:
+                    self.record(key, inputs, before, captured)
+                except Exception:
+                    return status, "skip"
+                self.save_index()
+            return status, "miss"
+
+    def __cx_cell_cache__(root, max_bytes):
+        caches = globals().setdefault("__cx_cell_caches__", {})
+        if root not in caches:
+            caches[root] = __cx_cell_cache_store__(root, max_bytes)
+        caches[root].max_bytes = max_bytes
+        return caches[root]
+""")
+
+# 宿主进程与会话之间经由共享内存文件交换变量的会话端实现, 宿主进程端见code_executor.shared_memory
+SHARED_MEMORY_CODE = dedent("""
+    def __cx_shm_map__(path, descriptor):
+        # 把共享内存文件映射为ndarray, 字节缓冲区(descr为None)映射为memoryview, 不复制数据
+        import mmap
+        import numpy as np
+        from numpy.lib.format import descr_to_dtype
+
+        dtype = None if descriptor["descr"] is None else descr_to_dtype(descriptor["descr"])
+        size = descriptor["shape"][0] if dtype is None else int(np.prod(descriptor["shape"])) * dtype.itemsize
+        if size == 0:
+            return memoryview(bytearray()) if dtype is None else np.empty(descriptor["shape"], dtype)
+        with open(path, "r+b") as f:
+            buffer = mmap.mmap(f.fileno(), size)
+        return memoryview(buffer) if dtype is None else np.frombuffer(buffer, dtype).reshape(descriptor["shape"])
+
+    def __cx_shm_attach__(name, path, descriptor):
+        globals()[name] = __cx_shm_map__(path, descriptor)
+        __cx_lazy__.pop(name, None)
+
+    def __cx_shm_export__(name, path):
+        # 把变量写入宿主进程指定的共享内存文件, 输出其描述符
+        import numpy as np
+        from numpy.lib.format import dtype_to_descr
+
+        value = globals()[name]
+        if type(value) is __cx_lazy_object__:
+            value = value._cx_resolve()
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            value = np.ascontiguousarray(value)
+            descriptor = {"descr": dtype_to_descr(value.dtype), "shape": value.shape}
+            data = memoryview(value.reshape(-1).view(np.uint8))
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            data = memoryview(value).cast("B")
+            descriptor = {"descr": None, "shape": (data.nbytes,)}
+        else:
+            raise TypeError(f"get only supports numpy arrays and bytes-like objects, got {type(value).__name__}!")
+        with open(path, "wb") as f:
+            f.write(data)
+        print(repr(descriptor))
+""")
+
+# 会话自身fork的会话端实现, 宿主进程端见code_executor.fork_server.ForkRequest
+SESSION_FORK_CODE = dedent("""
+    def __cx_fork__(path):
+        # 从宿主进程监听的unix socket接收新会话的stdin/stdout/stderr/帧通道, 两次fork出与当前会话共享内存页的新会话,
+        # 中间进程立即退出, 新会话由init进程回收, 当前会话无需处理SIGCHLD
+        import os, json, socket
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(path)
+            _, fds, _, _ = socket.recv_fds(conn, 16, 4)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    child = os.fork()
+                    if child:
+                        conn.sendall(json.dumps({"pid": child}).encode())
+                        os._exit(0)
+                except BaseException:
+                    os._exit(1)
+                os.setsid()
+                targets = (0, 1, 2, int(os.environ["CODE_EXECUTOR_FRAME_FD"]))
+                for target, fd in zip(targets, fds):
+                    os.dup2(fd, target)
+                for fd in fds:
+                    os.close(fd)
+                globals()["__cx_checkpoints__"] = []  # 后台快照进程不是新会话的子进程
+                return
+            for fd in fds:
+                os.close(fd)
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            raise RuntimeError("fork session failed")
+""")
+
+# 启动追踪, 在init profile之前执行: 记录init_code中每个模块的导入耗时, 以及延迟导入的模块第一次被使用时的导入耗时
+STARTUP_TRACE_CODE = dedent("""
+    def __cx_startup_tracer__():
+        import os, sys, json, time, importlib.util, importlib.machinery
+
+        # modules中每项为 [模块名, 不含子模块的导入秒数, 含子模块的导入秒数], 按导入完成的顺序
+        trace = {"pid": os.getpid(), "init_seconds": None, "modules": [], "lazy": {}}
+        stack, start = [], time.perf_counter()
+
+        class TracedLoader(object):
+            # 计时exec_module, 完成后把模块的loader换回原loader
+            def __init__(self, loader, lazy=False):
+                self.loader, self.lazy = loader, lazy
+
+            def __getattr__(self, name):
+                return getattr(self.loader, name)
+
+            def create_module(self, spec):
+                return self.loader.create_module(spec)
+
+            def exec_module(self, module):
+                name = module.__spec__.name
+                stack.append(0.0)
+                begin = time.perf_counter()
+                try:
+                    self.loader.exec_module(module)
+                finally:
+                    elapsed = time.perf_counter() - begin
+                    children = stack.pop()
+                    if stack:
+                        stack[-1] += elapsed
+                    module.__spec__.loader = module.__loader__ = self.loader
+                    if self.lazy:
+                        trace["lazy"][name] = elapsed
+                    else:
+                        trace["modules"].append([name, elapsed - children, elapsed])
+
+        class TraceFinder(object):
+            @staticmethod
+            def find_spec(name, path=None, target=None):
+                for finder in sys.meta_path:
+                    if finder is TraceFinder or not hasattr(finder, "find_spec"):
+                        continue
+                    spec = finder.find_spec(name, path, target)
+                    if spec is not None:
+                        if hasattr(spec.loader, "exec_module"):
+                            spec.loader = TracedLoader(spec.loader)
+                        return spec
+                return None
+
+        def lazy_import(name):
+            # 返回第一次访问属性时才真正导入的模块对象, 已导入的模块直接返回; 子模块的父包同样延迟导入
+            if name in sys.modules:
+                return sys.modules[name]
+            parent, _, child = name.rpartition(".")
+            if parent:
+                # 读取延迟模块的属性会触发导入, 直接从__dict__中取父包的spec
+                parent_module = lazy_import(parent)
+                locations = object.__getattribute__(parent_module, "__spec__").submodule_search_locations
+                spec = importlib.machinery.PathFinder.find_spec(name, locations) if locations is not None else None
+            else:
+                spec = importlib.util.find_spec(name)
+            if spec is None:
+                raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+            if isinstance(spec.loader, TracedLoader):
+                spec.loader = spec.loader.loader
+            loader = importlib.util.LazyLoader(TracedLoader(spec.loader, lazy=True))
+            spec.loader = loader
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[name] = module
+            loader.exec_module(module)
+            if parent:
+                setattr(parent_module, child, module)
+            return module
+
+        def finish():
+            sys.meta_path.remove(TraceFinder)
+            trace["init_seconds"] = time.perf_counter() - start
+
+        def dump():
+            print(json.dumps({**trace, "inherited": trace["pid"] != os.getpid()}))
+
+        sys.meta_path.insert(0, TraceFinder)
+        globals().update(__cx_lazy_import__=lazy_import, __cx_finish_startup_trace__=finish)
+        globals()["__cx_dump_startup_trace__"] = dump
+
+    __cx_startup_tracer__()
+""")
+
+# inprocess后端的初始化代码: 宿主进程中没有启动追踪, 延迟导入的profile直接导入;
+# 快照代码与会话进程相同, 两种后端保存的快照可以互相载入
+INPROCESS_PRELUDE = dedent("""
+    from importlib import import_module as __cx_lazy_import__
+""")
+INPROCESS_DONE_CODE = dedent("""
+    __cx_init_globals__ = dict(globals())
+""")
+
+# init profile: 在运行时代码之前执行的导入代码, data-science-lazy绑定相同的名字, 但模块在第一次被使用时才导入
+INIT_PROFILES = {
+    "minimal": "",
+    "data-science": dedent("""
+        import numpy as np
+        import pandas as pd
+        import dill
+        import matplotlib.pyplot as plt
+    """),
+    "data-science-lazy": dedent("""
+        np = __cx_lazy_import__("numpy")
+        pd = __cx_lazy_import__("pandas")
+        dill = __cx_lazy_import__("dill")
+        plt = __cx_lazy_import__("matplotlib.pyplot")
+    """),
+}
+
+# init_code执行完成时的全局作用域, 其中的对象(导入的模块, 运行时函数)不会进入快照
+INIT_DONE_CODE = dedent("""
+    __cx_finish_startup_trace__()
+    __cx_init_globals__ = dict(globals())
+""")
 
 
 PyExeConfig = ExeConfig(
     session_command=["python3", "-i", "-q", "-u", "-c"],
     print_cmd='print("{}")',
-    save_obj_cmd="save_object('{}')\n",
-    load_obj_cmd="load_object('{}')\n",
-    init_code=dedent("""
-    import numpy as np
-    import pandas as pd
-    import dill
-    import matplotlib.pyplot as plt
-
-    def save_object(filename):
-        variables = globals().copy()
-        filtered_variables = {name: value for name, value in variables.items() if not name.startswith('__')}
-        with open(filename, 'wb') as f:
-            dill.dump(filtered_variables, f)
-
-    def load_object(filename):
-        with open(filename, "rb") as f:
-            vars = dill.load(f)
-            globals().update(vars)
-    """)
+    save_obj_cmd="save_object('{}', {})\n",
+    load_obj_cmd="load_object('{}', {}, {})\n",
+    bg_save_obj_cmd="save_object_async('{}', {}, {})\n",
+    flush_obj_cmd="flush_checkpoints()\n",
+    fork_cmd="__cx_fork__({!r})\n",
+    exec_cmd="__cx_exec__({}, {!r}, {!r}, {!r})\n",
+    init_prelude=STARTUP_TRACE_CODE,
+    init_profiles=INIT_PROFILES,
+    init_profile="data-science",
+    init_code=SNAPSHOT_CODE
+    + CELL_CACHE_CODE
+    + SHARED_MEMORY_CODE
+    + SESSION_FORK_CODE
+    + FRAMED_RUNTIME_CODE
+    + INIT_DONE_CODE,
+    inprocess_prelude=INPROCESS_PRELUDE,
+    inprocess_init_code=SNAPSHOT_CODE + INPROCESS_DONE_CODE,
 )
+
+# ParallelPyExecutor的worker会话在启动时执行的代码, 通过文件在宿主进程和worker之间传递对象;
+# 并行replay时也用于把fork出的会话中cell写入的变量合并回原会话
+PARALLEL_WORKER_CODE = dedent("""
+    def __cx_load_value__(path):
+        import os, dill
+
+        with open(path, "rb") as f:
+            value = dill.load(f)
+        os.remove(path)
+        return value
+
+    def __cx_dump_value__(value, path):
+        import os, dill
+
+        with open(f"{path}.tmp", "wb") as f:
+            dill.dump(value, f)
+        os.replace(f"{path}.tmp", path)
+
+    def __cx_export_values__(names, path):
+        # 导出names中存在的全局变量, 不存在的变量在合并时被删除
+        __cx_dump_value__({name: globals()[name] for name in names if name in globals()}, path)
+
+    def __cx_merge_values__(path, names):
+        values = __cx_load_value__(path)
+        for name in names:
+            if name in values:
+                globals()[name] = values[name]
+            else:
+                globals().pop(name, None)
+""")
+
+# fork server(zygote)进程在执行完init_code后运行的服务代码, 每收到一个请求就fork出一个交互式会话
+FORK_SERVER_CODE = dedent("""
+    def __cx_fork_server__(path):
+        import os, sys, json, code, signal, socket
+
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # 由内核回收退出的会话进程
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(128)
+        print("FORK_SERVER_READY", flush=True)
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                msg, fds, _, _ = socket.recv_fds(conn, 65536, 8)
+                if not msg:
+                    continue
+                request = json.loads(msg)
+                env = dict(request.get("env", {}))
+                env.update({name: str(fd) for name, fd in zip(request.get("fd_env", []), fds[3:])})
+                pid = os.fork()
+                if pid == 0:
+                    conn.close()
+                    server.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    os.setsid()
+                    for target, fd in enumerate(fds[:3]):
+                        os.dup2(fd, target)
+                    for fd in fds[:3]:
+                        if fd > 2:
+                            os.close(fd)
+                    os.environ.update(env)
+                    sys.argv = [""]
+                    sys.ps1, sys.ps2 = "", ""
+                    code.InteractiveConsole(globals()).interact(banner="", exitmsg="")
+                    os._exit(0)
+                for fd in fds:
+                    os.close(fd)
+                conn.sendall(json.dumps({"pid": pid}).encode())
+
+    __cx_fork_server__(__import__("sys").argv[1])
+""")
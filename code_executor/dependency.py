@@ -0,0 +1,361 @@
+"""cell之间的静态依赖分析: 由AST得到每个cell写入(def)和读取(use)的全局变量名, 在整个cmd_space上建立依赖图
+
+依赖图以逻辑cell为节点: 由rerun()重新执行的cmd记录带有rerun_of字段, 它在原cell的位置上替换原cell的代码.
+分析是近似的: 条件分支中的赋值视为一定发生, 下标或属性赋值(x[0] = 1, x.a = 1)视为写入x,
+方法调用(x.append(1))视为可能原地修改x, 只在并行replay分层和合并变量时计入; 以参数传入函数后的修改(f(x))不会被识别.
+无法静态分析的cell(语法错误, 使用exec/eval/globals,
+from m import *, 恢复快照的内部命令等)视为读写所有变量.
+"""
+
+import ast
+import bisect
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+# 调用后可能读写任意全局变量的名字, 以__cx_开头的会话内部函数同样如此
+OPAQUE_NAMES = frozenset(("exec", "eval", "globals", "locals", "vars", "load_object", "__import__"))
+
+
+class Cell(NamedTuple):
+    cmd_id: str  # 逻辑cell的cmd_id, 即该cell第一次执行时的cmd_id
+    source: str
+    defs: Optional[FrozenSet[str]]  # cell写入或删除的全局变量, None表示无法分析
+    uses: Optional[FrozenSet[str]]  # cell在写入前读取的全局变量, None表示无法分析
+    lazy: Dict[str, FrozenSet[str]]  # cell定义的函数/类: 其被调用时读取的全局变量
+    mutates: FrozenSet[str] = frozenset()  # 作为方法调用的接收者, 可能被原地修改的全局变量
+
+
+def _bound_names(node: ast.AST) -> List[str]:
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return [alias.asname or alias.name.split(".")[0] for alias in node.names]
+    return [node.name]
+
+
+def _scope_names(node: ast.AST) -> Tuple[Set[str], Set[str]]:
+    """嵌套作用域(函数体, 类体, lambda, 推导式)读取的外层变量, 以及其中声明为global后写入的变量"""
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        body, args = node.body, node.args
+    elif isinstance(node, ast.Lambda):
+        body, args = [node.body], node.args
+    elif isinstance(node, ast.ClassDef):
+        body, args = node.body, None
+    else:
+        body, args = [node], None
+    loads, local, declared = set(), set(), set()
+    if args is not None:
+        local.update(a.arg for a in args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg] if a)
+    for child in (n for stmt in body for n in ast.walk(stmt)):
+        if isinstance(child, ast.Name):
+            (loads if isinstance(child.ctx, ast.Load) else local).add(child.id)
+        elif isinstance(child, ast.arg):
+            local.add(child.arg)
+        elif isinstance(child, ast.Global):
+            declared.update(child.names)
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Import, ast.ImportFrom)):
+            local.update(_bound_names(child))
+        elif isinstance(child, ast.ExceptHandler) and child.name:
+            local.add(child.name)
+    return loads - (local - declared), local & declared
+
+
+class _CellVisitor(ast.NodeVisitor):
+    """按执行顺序遍历cell的顶层语句, 在被写入之前读取的变量才是cell的输入"""
+
+    def __init__(self):
+        self.defs: Set[str] = set()
+        self.uses: Set[str] = set()
+        self.lazy: Dict[str, FrozenSet[str]] = {}
+        self.mutates: Set[str] = set()
+        self.opaque = False
+
+    def read(self, names: Iterable[str]):
+        for name in names:
+            if name in OPAQUE_NAMES or name.startswith("__cx_"):
+                self.opaque = True
+            if name not in self.defs:
+                self.uses.add(name)
+            if name in self.lazy:  # cell内调用了自身定义的函数
+                self.uses.update(self.lazy[name] - self.defs)
+
+    def write(self, names: Iterable[str]):
+        self.defs.update(names)
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Load):
+            self.read([node.id])
+        else:
+            self.write([node.id])
+
+    def _visit_target(self, node: ast.AST, augmented: bool = False):
+        """赋值目标, 下标和属性赋值视为读取并修改其根变量"""
+        if isinstance(node, (ast.Subscript, ast.Attribute)):
+            if isinstance(node, ast.Subscript):
+                self.visit(node.slice)
+            root = node.value
+            while isinstance(root, (ast.Subscript, ast.Attribute)):
+                if isinstance(root, ast.Subscript):
+                    self.visit(root.slice)
+                root = root.value
+            if isinstance(root, ast.Name):
+                self.read([root.id])
+                self.write([root.id])
+            else:
+                self.visit(root)
+        elif isinstance(node, ast.Name) and augmented:
+            self.read([node.id])
+            self.write([node.id])
+        else:
+            self.visit(node)
+
+    def visit_Call(self, node: ast.Call):
+        # x.m(...), x[0].m(...)和x.a.m(...)都可能原地修改x
+        root = node.func
+        while isinstance(root, (ast.Subscript, ast.Attribute)):
+            root = root.value
+        if root is not node.func and isinstance(root, ast.Name):
+            self.mutates.add(root.id)
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node: ast.Subscript):
+        if isinstance(node.ctx, ast.Load):
+            self.generic_visit(node)
+        else:
+            self._visit_target(node)
+
+    visit_Attribute = visit_Subscript
+
+    def visit_Assign(self, node: ast.Assign):
+        self.visit(node.value)
+        for target in node.targets:
+            self._visit_target(target)
+
+    def visit_AugAssign(self, node: ast.AugAssign):
+        self.visit(node.value)
+        self._visit_target(node.target, augmented=True)
+
+    def visit_AnnAssign(self, node: ast.AnnAssign):
+        self.visit(node.annotation)
+        if node.value is not None:
+            self.visit(node.value)
+            self._visit_target(node.target)
+
+    def visit_NamedExpr(self, node: ast.NamedExpr):
+        self.visit(node.value)
+        self._visit_target(node.target)
+
+    def visit_For(self, node: ast.For):
+        self.visit(node.iter)
+        self._visit_target(node.target)
+        for stmt in node.body + node.orelse:
+            self.visit(stmt)
+
+    visit_AsyncFor = visit_For
+
+    def visit_Import(self, node: ast.Import):
+        if any(alias.name == "*" for alias in node.names):
+            self.opaque = True
+        self.write(_bound_names(node))
+
+    visit_ImportFrom = visit_Import
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler):
+        if node.type is not None:
+            self.visit(node.type)
+        if node.name:
+            self.write([node.name])
+        for stmt in node.body:
+            self.visit(stmt)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        # 装饰器, 默认值和注解在定义时求值, 函数体中的读取推迟到被调用时
+        for expr in node.decorator_list + node.args.defaults + node.args.kw_defaults:
+            if expr is not None:
+                self.visit(expr)
+        free, declared = _scope_names(node)
+        self.opaque |= any(name in OPAQUE_NAMES or name.startswith("__cx_") for name in free)
+        self.write([node.name, *declared])
+        self.lazy[node.name] = frozenset(free - {node.name})
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node: ast.ClassDef):
+        # 类体在定义时执行, 方法体中的读取同样计入
+        for expr in node.decorator_list + node.bases + [k.value for k in node.keywords]:
+            self.visit(expr)
+        free, declared = _scope_names(node)
+        self.read(free - {node.name})
+        self.write([node.name, *declared])
+        self.lazy[node.name] = frozenset(free - {node.name})
+
+    def visit_Lambda(self, node: ast.AST):
+        for expr in getattr(getattr(node, "args", None), "defaults", []):
+            self.visit(expr)
+        self.read(_scope_names(node)[0])
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_Lambda
+
+    def visit_MatchAs(self, node: ast.AST):
+        self.generic_visit(node)
+        for name in (getattr(node, "name", None), getattr(node, "rest", None)):
+            if name:
+                self.write([name])
+
+    visit_MatchStar = visit_MatchMapping = visit_MatchAs
+
+
+def analyze(cmd_id: str, source: str) -> Cell:
+    """分析单个cell读写的全局变量"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return Cell(cmd_id, source, None, None, {})
+    visitor = _CellVisitor()
+    for stmt in tree.body:
+        visitor.visit(stmt)
+    if visitor.opaque:
+        return Cell(cmd_id, source, None, None, {})
+    return Cell(
+        cmd_id, source, frozenset(visitor.defs), frozenset(visitor.uses), visitor.lazy, frozenset(visitor.mutates)
+    )
+
+
+def _overlap(a: Optional[FrozenSet[str]], b: Optional[FrozenSet[str]]) -> bool:
+    if a is None or b is None:
+        return True
+    return not a.isdisjoint(b)
+
+
+class DependencyGraph(object):
+    """逻辑cell之间的依赖图
+
+    cell c读取的变量u的reaching definition为c之前最后一个写入u的cell, 即c的父节点;
+    调用之前定义的函数时, 函数体读取的全局变量也算作c的输入.
+    """
+
+    def __init__(self, cells: Iterable[Cell]):
+        self.cells: Dict[str, Cell] = OrderedDict((cell.cmd_id, cell) for cell in cells)
+        self.__ids = list(self.cells)
+        self.__position = {cmd_id: i for i, cmd_id in enumerate(self.__ids)}
+        self.__writers: Dict[str, List[int]] = {}  # 变量名: 写入它的cell的位置
+        self.__opaque: List[int] = []
+        for i, cell in enumerate(self.cells.values()):
+            if cell.defs is None:
+                self.__opaque.append(i)
+            else:
+                for name in cell.defs:
+                    self.__writers.setdefault(name, []).append(i)
+        self.names = frozenset(self.__writers)  # 被某个cell写入过的所有变量
+        # 没有被任何cell写入的接收者来自init_code(如np.arange(3)中的np), 不视为被修改
+        self.__writes = {
+            cmd_id: None if cell.defs is None else cell.defs | (cell.mutates & self.names)
+            for cmd_id, cell in self.cells.items()
+        }
+        self.__uses = {cmd_id: self._effective_uses(cell) for cmd_id, cell in self.cells.items()}
+
+    @classmethod
+    def from_history(cls, history: Mapping[str, Mapping]) -> "DependencyGraph":
+        """由cmd_space构造, rerun_of记录的代码替换其原cell的代码"""
+        sources = OrderedDict()
+        for cmd_id, record in history.items():
+            sources[record.get("rerun_of", cmd_id)] = record["cmd"]
+        return cls(analyze(cmd_id, source) for cmd_id, source in sources.items())
+
+    def with_source(self, cmd_id: str, source: str) -> "DependencyGraph":
+        """把cell cmd_id的代码替换为source后的依赖图"""
+        assert cmd_id in self.cells, f"cell {cmd_id} does not exist!"
+        return DependencyGraph(analyze(c, source) if c == cmd_id else cell for c, cell in self.cells.items())
+
+    def order(self, cmd_ids: Iterable[str]) -> List[str]:
+        """按cell在history中的位置排序"""
+        return sorted(set(cmd_ids), key=self.__position.__getitem__)
+
+    def writer(self, name: str, before: str = None) -> Optional[str]:
+        """在before之前(默认为全部cell中)最后一个写入name的cell"""
+        end = self.__position[before] if before is not None else len(self.cells)
+        candidates = [
+            positions[bisect.bisect_left(positions, end) - 1]
+            for positions in (self.__writers.get(name, []), self.__opaque)
+            if bisect.bisect_left(positions, end) > 0
+        ]
+        return self.__ids[max(candidates)] if candidates else None
+
+    def _effective_uses(self, cell: Cell) -> Optional[FrozenSet[str]]:
+        if cell.uses is None:
+            return None
+        uses, frontier = set(cell.uses), list(cell.uses)
+        while frontier:
+            name = frontier.pop()
+            writer = self.writer(name, before=cell.cmd_id)
+            for free in self.cells[writer].lazy.get(name, ()) if writer is not None else ():
+                if free not in uses:
+                    uses.add(free)
+                    frontier.append(free)
+        return frozenset(uses)
+
+    def uses(self, cmd_id: str) -> Optional[FrozenSet[str]]:
+        """cell读取的全局变量, 包括其调用的函数读取的全局变量"""
+        return self.__uses[cmd_id]
+
+    def writes(self, cmd_id: str) -> Optional[FrozenSet[str]]:
+        """cell写入或可能原地修改的变量, 并行replay时据此分层并把这些变量合并回原会话"""
+        return self.__writes[cmd_id]
+
+    def _read_names(self, cmd_id: str) -> FrozenSet[str]:
+        uses = self.__uses[cmd_id]
+        return self.names if uses is None else uses
+
+    def parents(self, cmd_id: str) -> List[str]:
+        """cell的输入来自的cell"""
+        writers = (self.writer(name, before=cmd_id) for name in self._read_names(cmd_id))
+        return self.order(w for w in writers if w is not None)
+
+    def children(self, cmd_id: str) -> List[str]:
+        """直接读取cell写入的变量的cell"""
+        return [c for c in self.cells if cmd_id in self.parents(c)]
+
+    def affected(self, cmd_id: str) -> List[str]:
+        """cell cmd_id改变后需要在当前会话中按顺序重新执行的cell, 包括其本身
+
+        除了读取了被重新执行的cell所写变量的下游cell, 还包括:
+        之后再次写入这些变量的cell, 以保证最终的值不变;
+        被重新执行的cell的输入已被之后的cell覆盖时, 产生该输入的cell.
+        """
+        assert cmd_id in self.cells, f"cell {cmd_id} does not exist!"
+        selected = {cmd_id}
+        changed = True
+        while changed:
+            changed = False
+            for c, cell in self.cells.items():
+                if c in selected:
+                    continue
+                position = self.__position[c]
+                earlier = [s for s in selected if self.__position[s] < position]
+                flow = any(self.writer(name, before=c) in selected for name in self._read_names(c))
+                output = any(_overlap(self.cells[s].defs, cell.defs) for s in earlier)
+                if flow or output:
+                    selected.add(c)
+                    changed = True
+            for s in list(selected):
+                for name in self._read_names(s):
+                    source = self.writer(name, before=s)
+                    if source is not None and source not in selected and self.writer(name) != source:
+                        selected.add(source)
+                        changed = True
+        return self.order(selected)
+
+    def levels(self, cmd_ids: Iterable[str]) -> List[List[str]]:
+        """把cell分为依次执行的若干层, 同一层的cell之间没有读写冲突, 可以在不同会话中并行执行"""
+        levels: Dict[str, int] = {}
+        for c in self.order(cmd_ids):
+            conflicts = [
+                levels[p]
+                for p in levels
+                if _overlap(self.__writes[p], self.__uses[c])
+                or _overlap(self.__writes[p], self.__writes[c])
+                or _overlap(self.__uses[p], self.__writes[c])
+            ]
+            levels[c] = max(conflicts, default=-1) + 1
+        grouped = [[] for _ in range(max(levels.values(), default=-1) + 1)]
+        for c, level in levels.items():
+            grouped[level].append(c)
+        return grouped
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import atexit
+import signal
+import socket
+import asyncio
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Tuple
+from loguru import logger
+
+from code_executor.constant import FORK_SERVER_CODE
+
+
+class ForkServer(object):
+    """zygote进程: 只执行一次init_code, 之后为每个会话请求fork出一个子进程
+
+    子进程通过写时复制共享zygote中已导入模块(numpy/pandas等)的内存页, 会话启动耗时从秒级降到毫秒级.
+    """
+
+    _shared: Dict[Tuple[str, ...], "ForkServer"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, base_command: List[str]):
+        assert (
+            isinstance(base_command, list) and "-c" in base_command
+        ), "fork server needs a `python -c init_code` command!"
+        idx = base_command.index("-c")
+        self.base_command = base_command
+        self.init_code = base_command[idx + 1] if idx + 1 < len(base_command) else ""
+        self.__flags = [arg for arg in base_command[1:idx] if arg not in ("-i", "-u")]
+        self.__socket_dir = None
+        self.__process = None
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, base_command: List[str]) -> "ForkServer":
+        """获取(必要时启动)与base_command对应的共享fork server"""
+        key = tuple(base_command)
+        with cls._shared_lock:
+            server = cls._shared.get(key)
+            if server is None:
+                server = cls._shared[key] = cls(list(base_command))
+        server.start()
+        return server
+
+    @classmethod
+    def close_all(cls):
+        with cls._shared_lock:
+            servers, cls._shared = list(cls._shared.values()), {}
+        for server in servers:
+            server.close()
+
+    @property
+    def socket_path(self) -> str:
+        return str(Path(self.__socket_dir) / "zygote.sock")
+
+    def is_alive(self) -> bool:
+        return self.__process is not None and self.__process.poll() is None
+
+    def start(self):
+        with self.__lock:
+            if self.is_alive():
+                return
+            self.__socket_dir = tempfile.mkdtemp(prefix="code_executor_zygote_")
+            zygote_command = [self.base_command[0], *self.__flags, "-u", "-c"]
+            zygote_command += [
+                self.init_code + "\n" + FORK_SERVER_CODE,
+                self.socket_path,
+            ]
+            logger.info("Starting fork server ...")
+            self.__process = subprocess.Popen(
+                zygote_command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            ready = self.__process.stdout.readline()
+            assert "FORK_SERVER_READY" in ready, "fork server failed to start!"
+            logger.info(f"Fork server is ready at {self.socket_path}.")
+
+    def close(self):
+        with self.__lock:
+            if self.__process is not None:
+                self.__process.terminate()
+                try:
+                    self.__process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.__process.kill()
+                self.__process.stdout.close()
+                self.__process = None
+            if self.__socket_dir:
+                Path(self.socket_path).unlink(missing_ok=True)
+                os.rmdir(self.__socket_dir)
+                self.__socket_dir = None
+
+    def spawn(self, env: Dict[str, str] = None, pass_fds: Dict[str, int] = None) -> Tuple[int, int, int, int]:
+        """fork一个会话进程, 返回(pid, stdin写端, stdout读端, stderr读端)
+
+        pass_fds中的fd会一并传给会话进程, 其在会话进程中的fd编号通过同名环境变量告知.
+        """
+        pass_fds = pass_fds or {}
+        if not self.is_alive():
+            self.start()
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                conn.connect(self.socket_path)
+                request = json.dumps({"env": env or {}, "fd_env": list(pass_fds)}).encode()
+                socket.send_fds(conn, [request], [stdin_r, stdout_w, stderr_w, *pass_fds.values()])
+                pid = json.loads(conn.recv(4096))["pid"]
+        except Exception:
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (stdin_r, stdout_w, stderr_w):
+                os.close(fd)
+        return pid, stdin_w, stdout_r, stderr_r
+
+    def spawn_process(self, env: Dict[str, str] = None, pass_fds: Dict[str, int] = None) -> "ForkedProcess":
+        pid, stdin, stdout, stderr = self.spawn(env, pass_fds)
+        return ForkedProcess(pid, stdin, stdout, stderr)
+
+    async def async_spawn_process(
+        self, env: Dict[str, str] = None, pass_fds: Dict[str, int] = None
+    ) -> "AsyncForkedProcess":
+        pid, stdin, stdout, stderr = await asyncio.to_thread(self.spawn, env, pass_fds)
+        process = AsyncForkedProcess(pid)
+        await process.connect_pipes(stdin, stdout, stderr)
+        return process
+
+
+atexit.register(ForkServer.close_all)
+
+
+class ForkRequest(object):
+    """运行中的会话fork自身时的宿主进程一端: 监听unix socket, 把新会话的管道交给会话进程并得到新会话的pid"""
+
+    def __init__(self):
+        self.__dir = tempfile.mkdtemp(prefix="code_executor_fork_")
+        self.path = str(Path(self.__dir) / "fork.sock")
+        self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__server.bind(self.path)
+        self.__server.listen(1)
+        stdin_r, self.stdin = os.pipe()
+        self.stdout, stdout_w = os.pipe()
+        self.stderr, stderr_w = os.pipe()
+        self.frame, frame_w = os.pipe()
+        self.__remote_fds = [stdin_r, stdout_w, stderr_w, frame_w]  # 交给新会话的一端
+
+    def serve(self, timeout: float = 30) -> int:
+        """等待会话进程连接, 发送管道并返回新会话的pid"""
+        self.__server.settimeout(timeout)
+        conn, _ = self.__server.accept()
+        with conn:
+            conn.settimeout(timeout)
+            socket.send_fds(conn, [b"fork"], self.__remote_fds)
+            data = b""
+            while chunk := conn.recv(4096):
+                data += chunk
+        for fd in self.__remote_fds:
+            os.close(fd)
+        self.__remote_fds = []
+        if not data:
+            raise RuntimeError("session failed to fork")
+        return json.loads(data)["pid"]
+
+    def close(self, keep_local: bool = True):
+        """keep_local为False时一并关闭宿主进程一端的管道, 用于fork失败时"""
+        self.__server.close()
+        Path(self.path).unlink(missing_ok=True)
+        os.rmdir(self.__dir)
+        for fd in self.__remote_fds + ([] if keep_local else [self.stdin, self.stdout, self.stderr, self.frame]):
+            os.close(fd)
+        self.__remote_fds = []
+
+
+class _ForkedProcessBase(object):
+    """fork出的会话进程不是本进程的子进程, 只能通过信号探测其是否存活, 退出码不可知时记为0"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self._returncode = None
+        self._signal = None
+
+    def poll(self):
+        if self._returncode is None:
+            try:
+                os.kill(self.pid, 0)
+                alive = not self._is_zombie()
+            except ProcessLookupError:
+                alive = False
+            if not alive:
+                self._returncode = -self._signal if self._signal else 0
+        return self._returncode
+
+    def _is_zombie(self) -> bool:
+        # 会话自身fork出的会话由init进程回收, 退出后到被回收前仍可以被kill探测到
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                return f.read().rpartition(")")[2].split()[0] == "Z"
+        except (OSError, IndexError):
+            return False
+
+    def send_signal(self, sig: int):
+        if self.poll() is None:
+            self._signal = sig
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class ForkedProcess(_ForkedProcessBase):
+    """与subprocess.Popen(text=True, bufsize=1)接口一致的fork会话进程"""
+
+    def __init__(self, pid: int, stdin: int, stdout: int, stderr: int):
+        super().__init__(pid)
+        self.stdin = open(stdin, "w", buffering=1)
+        self.stdout = open(stdout, "r")
+        self.stderr = open(stderr, "r")
+
+    def wait(self, timeout: float = None) -> int:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            time.sleep(0.005)
+        try:
+            self.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self._returncode
+
+
+class AsyncForkedProcess(_ForkedProcessBase):
+    """与asyncio.subprocess.Process接口一致的fork会话进程"""
+
+    def __init__(self, pid: int):
+        super().__init__(pid)
+        self.stdin: asyncio.StreamWriter = None
+        self.stdout: asyncio.StreamReader = None
+        self.stderr: asyncio.StreamReader = None
+
+    @property
+    def returncode(self):
+        return self.poll()
+
+    async def connect_pipes(self, stdin: int, stdout: int, stderr: int):
+        loop = asyncio.get_running_loop()
+        readers = []
+        for fd in (stdout, stderr):
+            reader = asyncio.StreamReader()
+            await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader),
+                open(fd, "rb", buffering=0),
+            )
+            readers.append(reader)
+        self.stdout, self.stderr = readers
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, open(stdin, "wb", buffering=0)
+        )
+        self.stdin = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def wait(self) -> int:
+        while self.poll() is None:
+            await asyncio.sleep(0.005)
+        self.stdin.close()
+        return self._returncode
@@ -0,0 +1,213 @@
+import os
+import time
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Callable, Dict, List, Union
+from loguru import logger
+
+from code_executor.pyexe import PyExecutor
+from code_executor.sync_executor import SyncCodeExecutor
+
+
+def session_memory(pid: int) -> int:
+    """会话进程占用的内存字节数, 优先使用PSS, 以免重复计入与fork server共享的页面"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+class SessionManager(object):
+    """托管大量逻辑会话, 只让最近使用的会话常驻内存
+
+    会话闲置超过idle_ttl秒, 常驻会话的总内存超过memory_budget字节或常驻会话数超过max_live时,
+    最久未使用的会话会被休眠: 保存快照和Executor状态后停止解释器进程. 休眠的会话在下一次执行命令时通过load()透明地恢复.
+    内存预算和会话数只淘汰最近使用的会话之外的会话, 以免单个大会话反复休眠和恢复.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        factory: Callable[..., SyncCodeExecutor] = PyExecutor,
+        *,
+        memory_budget: int = None,
+        max_live: int = None,
+        idle_ttl: float = None,
+        check_interval: float = None,
+        lazy_revive: bool = True,
+        **executor_kwargs,
+    ):
+        assert max_live is None or max_live > 0, "max_live should be positive!"
+        self.root = root
+        self.factory = factory
+        self.memory_budget = memory_budget
+        self.max_live = max_live
+        self.idle_ttl = idle_ttl
+        self.lazy_revive = lazy_revive  # 恢复时只安装占位符, 对象在第一次被使用时才反序列化
+        self.executor_kwargs = executor_kwargs
+        self.stats = {
+            "created": 0,
+            "hibernated": 0,
+            "revived": 0,
+            "ttl_evictions": 0,
+            "memory_evictions": 0,
+            "count_evictions": 0,
+            "hibernate_seconds": 0.0,
+            "revive_seconds": 0.0,
+        }
+        self.__live: Dict[str, SyncCodeExecutor] = OrderedDict()  # 按最近使用排序的常驻会话
+        self.__last_used: Dict[str, float] = {}
+        self.__session_locks: Dict[str, threading.Lock] = {}  # 执行命令期间会话不会被休眠
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        Path(root).mkdir(parents=True, exist_ok=True)
+        if check_interval is not None:
+            self.__thread = threading.Thread(target=self._sweep_loop, args=(check_interval,), daemon=True)
+            self.__thread.start()
+
+    def __enter__(self) -> "SessionManager":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def work_dir(self, name: str) -> str:
+        return str(Path(self.root) / name)
+
+    def _session_lock(self, name: str) -> threading.Lock:
+        with self.__lock:
+            return self.__session_locks.setdefault(name, threading.Lock())
+
+    def sessions(self) -> List[str]:
+        """所有逻辑会话, 包括之前的SessionManager休眠在root中的会话"""
+        on_disk = {p.parent.name for p in Path(self.root).glob("*/executor.json")}
+        with self.__lock:
+            return sorted(on_disk | set(self.__live))
+
+    def live_sessions(self) -> List[str]:
+        """常驻内存的会话, 按最近使用排序"""
+        with self.__lock:
+            return list(self.__live)
+
+    def memory_usage(self) -> Dict[str, int]:
+        with self.__lock:
+            live = list(self.__live.items())
+        return {name: session_memory(executor.pid) if executor.pid else 0 for name, executor in live}
+
+    def _acquire(self, name: str) -> SyncCodeExecutor:
+        """在会话锁内调用, 返回常驻的会话, 必要时恢复休眠的会话或创建新会话"""
+        with self.__lock:
+            executor = self.__live.get(name)
+            if executor is not None:
+                self.__live.move_to_end(name)
+                self.__last_used[name] = time.monotonic()
+                return executor
+
+        start = time.perf_counter()
+        work_dir = self.work_dir(name)
+        executor = self.factory(work_dir, True, **self.executor_kwargs)
+        revived = Path(work_dir, "executor.json").exists()
+        if revived:
+            executor = executor.load(self.lazy_revive)
+        executor.warm_up()
+        with self.__lock:
+            self.__live[name] = executor
+            self.__last_used[name] = time.monotonic()
+            if revived:
+                self.stats["revived"] += 1
+                self.stats["revive_seconds"] += time.perf_counter() - start
+            else:
+                self.stats["created"] += 1
+        if revived:
+            logger.info(f"Session {name} revived in {time.perf_counter() - start:.3f}s.")
+        return executor
+
+    def session(self, name: str) -> SyncCodeExecutor:
+        """返回常驻的会话, 返回后该会话仍可能被休眠, 执行命令请使用run()"""
+        with self._session_lock(name):
+            return self._acquire(name)
+
+    def run(self, name: str, cmds: Union[str, List[str]]) -> dict:
+        """在会话name中执行cmd并返回其cmd_space记录, 休眠的会话会先被恢复"""
+        with self._session_lock(name):
+            record = self._acquire(name).submit(cmds).result()
+            with self.__lock:
+                self.__last_used[name] = time.monotonic()
+        self.sweep()
+        return record
+
+    def hibernate(self, name: str, reason: str = None, blocking: bool = False) -> bool:
+        """保存会话的快照和状态后停止其进程, 会话正在执行命令时返回False, blocking为True时等待命令执行完成"""
+        lock = self._session_lock(name)
+        if not lock.acquire(blocking=blocking):
+            return False
+        try:
+            with self.__lock:
+                executor = self.__live.pop(name, None)
+                self.__last_used.pop(name, None)
+            if executor is None:
+                return False
+            start = time.perf_counter()
+            executor.stop_process()  # is_save_obj为True, 会先等待后台快照并保存Executor
+            with self.__lock:
+                self.stats["hibernated"] += 1
+                self.stats["hibernate_seconds"] += time.perf_counter() - start
+                if reason is not None:
+                    self.stats[f"{reason}_evictions"] += 1
+            logger.info(f"Session {name} hibernated" + (f" ({reason})." if reason else "."))
+            return True
+        finally:
+            lock.release()
+
+    def _victims(self) -> List[tuple]:
+        """按最久未使用的顺序选出需要休眠的会话及原因"""
+        now = time.monotonic()
+        with self.__lock:
+            order = list(self.__live)
+            last_used = dict(self.__last_used)
+        victims = []
+        if self.idle_ttl is not None:
+            victims += [(name, "ttl") for name in order if now - last_used.get(name, now) >= self.idle_ttl]
+        candidates = [name for name in order[:-1] if name not in dict(victims)]
+        if self.max_live is not None:
+            excess = len(order) - len(victims) - self.max_live
+            victims += [(name, "count") for name in candidates[: max(0, excess)]]
+            candidates = candidates[max(0, excess) :]
+        if self.memory_budget is not None:
+            usage = self.memory_usage()
+            total = sum(usage.get(name, 0) for name in order if name not in dict(victims))
+            for name in candidates:
+                if total <= self.memory_budget:
+                    break
+                victims.append((name, "memory"))
+                total -= usage.get(name, 0)
+        return victims
+
+    def sweep(self) -> List[str]:
+        """休眠闲置超时或超出内存预算/会话数的会话, 返回被休眠的会话"""
+        return [name for name, reason in self._victims() if self.hibernate(name, reason)]
+
+    def _sweep_loop(self, interval: float):
+        while not self.__stopped.wait(interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning(f"Session sweep failed: {e}")
+
+    def close(self):
+        """休眠所有常驻会话, 正在执行命令的会话在命令完成后休眠, 之后仍可以用相同的root重新托管这些会话"""
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        for name in self.live_sessions():
+            self.hibernate(name, blocking=True)
@@ -0,0 +1,180 @@
+import json
+import struct
+from pathlib import Path
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from typing import Dict, Iterator, Optional
+
+INDEX_ENTRY = struct.Struct("<Q")  # 索引文件中每条记录在日志文件中的起始偏移
+
+
+class CommandRecord(MutableMapping):
+    """单个cmd的执行记录, 常用字段保存在__slots__中, 其余字段(如输出溢出文件)保存在extra中"""
+
+    __slots__ = ("cmd", "stdout", "stderr", "status", "extra")
+    FIELDS = ("cmd", "stdout", "stderr", "status")
+
+    def __init__(self, fields: Mapping = None):
+        self.extra = None
+        self.update(fields or {})
+
+    def __getitem__(self, key: str):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key: str):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class PersistedRecord(CommandRecord):
+    """从日志中读取的已持久化记录, 每次读取得到的都是新对象, 修改不会写回日志, 因此只读"""
+
+    __slots__ = ()
+
+    def __init__(self, fields: Mapping):
+        super().__init__()
+        for key, value in fields.items():
+            super().__setitem__(key, value)
+
+    def __setitem__(self, key: str, value):
+        raise TypeError(f"persisted record is read-only, cannot set {key!r}!")
+
+    def __delitem__(self, key: str):
+        raise TypeError(f"persisted record is read-only, cannot delete {key!r}!")
+
+
+class CommandHistory(Mapping):
+    """cmd_id到CommandRecord的有序映射, cmd_id为从"0"开始连续编号的字符串
+
+    flush()把尚未持久化的记录以JSON行追加到history.log, 并在history.idx中追加每条记录的偏移;
+    已持久化的记录不再常驻内存, 按cmd_id读取时通过索引直接定位到日志中的那一行, 返回只读的PersistedRecord.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path  # 日志和索引文件的路径前缀, 为None时只保存在内存中
+        self.__size = 0
+        self.__persisted = 0  # 已写入日志的记录数
+        self.__records: Dict[int, CommandRecord] = {}  # 尚未持久化的记录
+        if path is not None and Path(self.index_path).exists():
+            self.__size = self.__persisted = Path(self.index_path).stat().st_size // INDEX_ENTRY.size
+
+    @property
+    def log_path(self) -> str:
+        return f"{self.path}.log"
+
+    @property
+    def index_path(self) -> str:
+        return f"{self.path}.idx"
+
+    @classmethod
+    def from_records(cls, records: Mapping) -> "CommandHistory":
+        """由旧版本executor.json中保存的cmd_space构造"""
+        history = cls()
+        for cmd_id, record in records.items():
+            history[cmd_id] = record
+        return history
+
+    def _index(self, cmd_id) -> Optional[int]:
+        try:
+            index = int(cmd_id)
+        except (TypeError, ValueError):
+            return None
+        return index if 0 <= index < self.__size else None
+
+    def _read(self, index: int) -> PersistedRecord:
+        with open(self.index_path, "rb") as f:
+            f.seek(index * INDEX_ENTRY.size)
+            (offset,) = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            return PersistedRecord(json.loads(f.readline()))
+
+    def __getitem__(self, cmd_id: str) -> CommandRecord:
+        index = self._index(cmd_id)
+        if index is None:
+            raise KeyError(cmd_id)
+        if index in self.__records:
+            return self.__records[index]
+        return self._read(index)
+
+    def __setitem__(self, cmd_id: str, record: Mapping):
+        index = int(cmd_id)
+        assert self.__persisted <= index <= self.__size, f"cmd {cmd_id} is persisted or out of order!"
+        self.__records[index] = record if isinstance(record, CommandRecord) else CommandRecord(record)
+        self.__size = max(self.__size, index + 1)
+
+    def __contains__(self, cmd_id) -> bool:
+        return self._index(cmd_id) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(index) for index in range(self.__size))
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+    def to_dict(self) -> "OrderedDict[str, dict]":
+        return OrderedDict((cmd_id, dict(record)) for cmd_id, record in self.items())
+
+    def flush(self, path: str = None, upto: int = None) -> int:
+        """持久化cmd_id小于upto的记录(默认全部), 返回本次写入的记录数
+
+        path与当前路径不同时(如新会话第一次保存), 在path处重新写入全部记录.
+        """
+        if path is not None and path != self.path:
+            self.__records.update({index: CommandRecord(self[str(index)]) for index in range(self.__persisted)})
+            self.path, self.__persisted = path, 0
+            Path(self.log_path).parent.mkdir(parents=True, exist_ok=True)
+            for file_path in (self.log_path, self.index_path):
+                open(file_path, "wb").close()
+        assert self.path is not None, "path should be set before flush!"
+
+        end = self.__size if upto is None else min(upto, self.__size)
+        if end <= self.__persisted:
+            return 0
+        with open(self.log_path, "ab") as log, open(self.index_path, "ab") as index_file:
+            offset = log.tell()
+            for index in range(self.__persisted, end):
+                line = json.dumps(dict(self.__records.pop(index)), ensure_ascii=False).encode() + b"\n"
+                log.write(line)
+                index_file.write(INDEX_ENTRY.pack(offset))
+                offset += len(line)
+        written, self.__persisted = end - self.__persisted, end
+        return written
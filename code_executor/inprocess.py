@@ -0,0 +1,399 @@
+"""在宿主进程内执行cell的低延迟后端, 只用于可信代码
+
+cell以compile/exec在一个持久的命名空间中执行, 没有管道, REPL回显和结束标记的解析; stdout/stderr在内存中捕获.
+与SyncCodeExecutor有相同的run()生成器和cmd_space记录, 以及相同格式的work_dir快照.
+"""
+
+import io
+import ast
+import sys
+import json
+import time
+import pprint
+import shutil
+import tempfile
+import threading
+import linecache
+import traceback
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Union, List, Literal, Iterator, Callable
+from loguru import logger
+
+from code_executor.history import CommandHistory
+from code_executor.metrics import MetricsRegistry
+from code_executor.output import (
+    ConsoleSink,
+    OutputBudget,
+    OutputBuffer,
+    OutputChunk,
+    read_output,
+    iter_output,
+    release_spilled,
+)
+
+# sys.stdout/sys.stderr是进程全局的, 同一时刻只能有一个cell在宿主进程内执行
+_EXEC_LOCK = threading.RLock()
+
+
+# 只在inprocess后端中有意义的参数不写入executor.json, 以便两种后端互相load()同一个work_dir
+_INPROCESS_KWARGS = ("init_code", "code_cache_size")
+
+
+class _Capture(object):
+    """执行cell的线程写入的输出归入当前cmd, 其它线程的输出以及sink自身的输出仍写入原来的流"""
+
+    def __init__(self, on_write: Callable[[str, str], None]):
+        self.on_write = on_write
+        self.owner = threading.get_ident()
+        self.dispatching = False
+
+    def write(self, name: str, text: str) -> bool:
+        """返回输出是否被捕获"""
+        if self.dispatching or threading.get_ident() != self.owner:
+            return False
+        if text:
+            self.dispatching = True
+            try:
+                self.on_write(name, text)
+            finally:
+                self.dispatching = False
+        return True
+
+
+class _CaptureStream(io.TextIOBase):
+    encoding = "utf-8"
+
+    def __init__(self, name: str, original, capture: _Capture):
+        self.name = name
+        self.original = original
+        self.capture = capture
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not self.capture.write(self.name, text):
+            return self.original.write(text)
+        return len(text)
+
+    def flush(self):
+        self.original.flush()
+
+
+class InProcessExecutor(object):
+    def __init__(
+        self,
+        init_code: str = "",
+        *,
+        work_dir: str = None,
+        is_save_obj: bool = False,
+        save_obj_cmd: str = None,
+        load_obj_cmd: str = None,
+        snapshot_compression: int = None,
+        output_limit: int = 1 << 20,
+        output_keep: int = 1 << 15,
+        session_output_limit: int = 1 << 26,
+        echo: bool = True,
+        report_metrics: bool = True,
+        code_cache_size: int = 256,
+    ):
+        # 新建命名空间时执行的代码, 如导入模块和快照运行时
+        self.init_code = init_code
+        self.__namespace = None
+        self.__startup_cmd = ""  # 命名空间初始化后首先执行的代码, 如load()时恢复全局作用域对象
+        self.__output_dir = None  # 未设置work_dir时输出溢出文件所在的临时目录
+        self._cmd_space = CommandHistory()  # cmd_id: {cmd, stddout, stderr}
+        self.work_dir = work_dir
+        self.is_save_obj = is_save_obj
+        self.save_obj_cmd = save_obj_cmd
+        self.load_obj_cmd = load_obj_cmd
+        self.snapshot_compression = snapshot_compression
+        self.output_limit = output_limit
+        self.output_keep = output_keep
+        self.session_output_limit = session_output_limit
+        self.__output_budget = OutputBudget(session_output_limit)
+        self.__retained: List[OutputBuffer] = []  # 输出文本仍保留在cmd_space内存中的缓冲区
+        self.echo = echo
+        self.__sinks: List[Callable[[OutputChunk], None]] = [ConsoleSink()] if echo else []
+        self.report_metrics = report_metrics
+        self.__metrics_hooks: List[Callable[[str, dict], None]] = []
+        if report_metrics:
+            registry = MetricsRegistry.shared()
+            self.__metrics_hooks.append(lambda cmd_id, metrics: registry.observe(metrics, type(self).__name__))
+        # 源码: (语法树, 代码对象), 重复执行的cell跳过解析和编译, 超过code_cache_size个时淘汰最久未使用的条目
+        self.code_cache_size = code_cache_size
+        self.__code_cache = OrderedDict()
+        self.__submit_lock = threading.Lock()
+        if self.is_save_obj:
+            assert self.save_obj_cmd is not None, "save_obj_cmd should be string cmd when is_save_obj is True!"
+            assert self.load_obj_cmd is not None, "load_obj_cmd should be string cmd when is_save_obj is True!"
+            assert self.work_dir is not None, "work_dir should be a path when is_save_obj is True!"
+            Path(self.work_dir).mkdir(parents=True, exist_ok=True)
+        self._executor_save_path = str(Path(self.work_dir) / "executor.json") if self.work_dir else ""
+        self._history_path = str(Path(self.work_dir) / "history") if self.work_dir else ""
+
+    def manage_work_dir(self, cmd: Literal["c", "d"] = "c"):
+        """管理cmd变量的共享文件目录"""
+        if self.is_save_obj:
+            root = Path(self.work_dir)
+            root.mkdir(parents=True, exist_ok=True)
+            current_cmd_id = str(len(self._cmd_space) - 1)
+
+            if cmd == "c":
+                (root / current_cmd_id).mkdir(parents=True, exist_ok=True)
+
+            if cmd == "d":
+                shutil.rmtree(str(root))
+
+    def obj_save_path(self, cmd_id: str) -> str:
+        """每段代码内全局作用域快照的manifest路径, 对象本身按内容哈希保存在work_dir/objects中"""
+        return str(Path(self.work_dir) / cmd_id / "manifest.json")
+
+    def output_path(self, cmd_id: str, stream: str) -> str:
+        """cmd输出超过output_limit时完整输出的溢出文件路径, 未设置work_dir时位于临时目录中, stop_process()时删除"""
+        if self.work_dir:
+            return str(Path(self.work_dir) / "outputs" / f"{cmd_id}.{stream}")
+        if self.__output_dir is None:
+            self.__output_dir = tempfile.mkdtemp(prefix="code_executor_output_")
+        return str(Path(self.__output_dir) / f"{cmd_id}.{stream}")
+
+    def read_output(self, cmd_id: str, stream: str = "stdout", offset: int = 0, size: int = -1) -> str:
+        """按字节偏移读取cmd的完整输出, 未溢出的输出从cmd_space中读取"""
+        record = self._cmd_space[cmd_id]
+        if f"{stream}_file" in record:
+            return read_output(record[f"{stream}_file"], offset, size).decode(errors="replace")
+        data = record.get(stream, "").encode()
+        return data[offset:].decode(errors="replace") if size < 0 else data[offset : offset + size].decode()
+
+    def iter_output(self, cmd_id: str, stream: str = "stdout", chunk_size: int = 1 << 16) -> Iterator[str]:
+        """惰性地逐块读取cmd的完整输出"""
+        record = self._cmd_space[cmd_id]
+        if f"{stream}_file" in record:
+            yield from iter_output(record[f"{stream}_file"], chunk_size)
+        elif record.get(stream):
+            yield record[stream]
+
+    def restore(self, cmd_id: str, lazy: bool = False) -> dict:
+        """把命名空间回退到cmd_id执行完成时的全局作用域, 回退本身作为一条cmd记录到cmd_space中"""
+        assert self.is_save_obj, "restore requires is_save_obj to be True!"
+        assert cmd_id in self._cmd_space, f"cmd {cmd_id} does not exist!"
+        filepath = self.obj_save_path(cmd_id)
+        assert Path(filepath).exists(), f"snapshot of cmd {cmd_id} does not exist!"
+        logger.info(f"Restore namespace to cmd {cmd_id} ...")
+        return self._run(self.load_obj_cmd.format(filepath, lazy, True))
+
+    def load(self, lazy: bool = False) -> "InProcessExecutor":
+        """载入work_dir中的cmd_space和最后一个cmd的全局作用域, 快照可以由任一后端保存"""
+        self._cmd_space = CommandHistory(self._history_path)
+        obj_path = self.obj_save_path(str(len(self._cmd_space) - 1))
+        if Path(obj_path).exists():
+            self.__startup_cmd = self.load_obj_cmd.format(obj_path, lazy, False)
+        return self
+
+    def save_executor(self):
+        """保存cmd_space和Executor的参数"""
+        assert self.work_dir, "work_dir must be set a value, not None."
+        self._cmd_space.flush(self._history_path)
+        for buffer in self.__retained:
+            buffer.release()
+        self.__retained = []
+        executor_state = {
+            k: v for k, v in self.__dict__.items() if "__" not in k and k not in ("_cmd_space",) + _INPROCESS_KWARGS
+        }
+        with open(self._executor_save_path, "w") as f:
+            json.dump(executor_state, f, sort_keys=True, indent=4)
+
+        # 添加一个.gitignore文件
+        with open(str(Path(self.work_dir) / ".gitignore"), "w") as f:
+            f.write("*\n")
+
+    def start_process(self):
+        """新建命名空间并执行init_code, 与会话进程的__main__一样以__main__为模块名"""
+        self.__namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+        for code in (self.init_code, self.__startup_cmd):
+            if code:
+                exec(compile(code, "<init>", "exec"), self.__namespace)
+
+    def is_alive(self) -> bool:
+        return self.__namespace is not None
+
+    def warm_up(self):
+        """新建命名空间并执行init_code, 不占用cmd_space"""
+        if self.__namespace is None:
+            self.start_process()
+
+    def stop_process(self):
+        """丢弃命名空间, 已导入的模块仍留在宿主进程中"""
+        self.__namespace = None
+        self.__code_cache.clear()
+        # 未设置work_dir时溢出的输出文件保存在临时目录中, 随会话一起删除
+        if self.__output_dir is not None:
+            release_spilled(self._cmd_space.values(), self.__output_dir)
+            shutil.rmtree(self.__output_dir, ignore_errors=True)
+            self.__output_dir = None
+        if self.is_save_obj:
+            self.save_executor()
+
+    def add_sink(self, sink: Callable[[OutputChunk], None]):
+        """注册输出sink, 每一段输出都会依次交给已注册的sink处理"""
+        self.__sinks.append(sink)
+
+    def remove_sink(self, sink: Callable[[OutputChunk], None]):
+        self.__sinks.remove(sink)
+
+    def add_metrics_hook(self, hook: Callable[[str, dict], None]):
+        """注册指标hook, 每个cmd完成时以(cmd_id, metrics)调用"""
+        self.__metrics_hooks.append(hook)
+
+    def remove_metrics_hook(self, hook: Callable[[str, dict], None]):
+        self.__metrics_hooks.remove(hook)
+
+    def _compile(self, source: str, filename: str, cache: bool = True):
+        """以交互模式编译源码, 表达式语句的值会被打印; 相同的源码复用第一次编译的结果, 回溯中的文件名也沿用第一次的"""
+        cached = self.__code_cache.get(source) if cache else None
+        if cached is not None:
+            self.__code_cache.move_to_end(source)
+            return cached[0], cached[1], True
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        tree = ast.parse(source, filename)
+        code = compile(ast.Interactive(tree.body), filename, "single")
+        if not cache:
+            return tree, code, False
+        self.__code_cache[source] = (tree, code)
+        while len(self.__code_cache) > self.code_cache_size:
+            self.__code_cache.popitem(last=False)
+        return tree, code, False
+
+    def _exec(self, source: str, filename: str, metrics: dict, cache: bool = True) -> int:
+        """执行源码, 返回非0表示抛出了异常"""
+        try:
+            tree, code, metrics["code_cache_hit"] = self._compile(source, filename, cache)
+            prepare = self.__namespace.get("__cx_prepare__")
+            if prepare is not None:  # 恢复cell中引用到的延迟对象
+                prepare(tree)
+            exec(code, self.__namespace)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except BaseException as e:
+            tb = None if isinstance(e, SyntaxError) else e.__traceback__.tb_next
+            traceback.print_exception(type(e), e, tb)
+            return 1
+        return 0
+
+    def _execute(self, cmd_id: str, source: str, on_output: Callable[[OutputChunk], None] = None) -> dict:
+        """在命名空间中执行源码并在内存中捕获输出, 返回cmd_space记录中的输出, 状态和指标"""
+        buffers = {
+            stream: OutputBuffer(
+                self.output_path(cmd_id, stream), self.output_limit, self.output_keep, self.__output_budget
+            )
+            for stream in ("stdout", "stderr")
+        }
+
+        def on_write(stream: str, text: str):
+            buffers[stream].append(text.encode("utf-8", "backslashreplace"))
+            chunk = OutputChunk.now(cmd_id, stream, text)
+            for sink in ([on_output] if on_output is not None else []) + self.__sinks:
+                try:
+                    sink(chunk)
+                except Exception as e:
+                    logger.warning(f"Output sink {sink} failed: {e}")
+
+        metrics = {}
+        with _EXEC_LOCK:
+            stdout, stderr, capture = sys.stdout, sys.stderr, _Capture(on_write)
+            sys.stdout = _CaptureStream("stdout", stdout, capture)
+            sys.stderr = _CaptureStream("stderr", stderr, capture)
+            try:
+                wall, cpu = time.perf_counter(), time.process_time()
+                status = self._exec(source, f"<cell-{cmd_id}>", metrics)
+                metrics["wall_time"] = time.perf_counter() - wall
+                metrics["cpu_time"] = time.process_time() - cpu
+                if self.is_save_obj:
+                    wall = time.perf_counter()
+                    save_obj_cmd = self.save_obj_cmd.format(self.obj_save_path(cmd_id), self.snapshot_compression)
+                    self._exec(save_obj_cmd, f"<post-{cmd_id}>", {}, cache=False)
+                    metrics["snapshot_time"] = time.perf_counter() - wall
+                    stats = self.__namespace.pop("__cx_snapshot_stats__", None)
+                    if stats is not None:
+                        metrics["snapshot_bytes"], metrics["snapshot_written_bytes"] = stats["bytes"], stats["written"]
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+
+        outputs = {}
+        for stream, buffer in buffers.items():
+            outputs[stream] = buffer.close().strip()
+            if buffer.spilled:
+                outputs[f"{stream}_file"] = buffer.spill_path
+                outputs[f"{stream}_bytes"] = buffer.size
+        metrics["output_bytes"] = sum(buffer.size for buffer in buffers.values())
+        # 输出保留在cmd_space中时继续占用会话的输出额度, 直到记录被持久化
+        self.__retained.extend(buffers.values())
+        return {**outputs, "status": status, "metrics": metrics}
+
+    def submit(self, cmds: Union[str, List[str]], on_output: Callable[[OutputChunk], None] = None) -> Future:
+        """在调用线程中执行cmd, 返回已完成的Future, 以便与SyncCodeExecutor.submit互换使用"""
+        if isinstance(cmds, str):
+            cmds = [cmds]
+        if self.__namespace is None:
+            self.start_process()
+
+        submitted = time.time()
+        full_command = " ".join(cmds) + "\n\n"
+        with self.__submit_lock:
+            cmd_id = str(len(self._cmd_space))
+            # 添加cmd到cmd_space
+            self._cmd_space[cmd_id] = {}
+            self._cmd_space[cmd_id]["cmd"] = full_command
+            self.manage_work_dir()
+            result = self._execute(cmd_id, full_command, on_output)
+            # 持有提交锁时写入结果, 以免记录先被save_executor()持久化
+            record = self._cmd_space[cmd_id]
+            record.update(result)
+
+        metrics = record["metrics"]
+        metrics["queue_time"] = 0.0
+        metrics["total_time"] = time.time() - submitted
+        metrics["status"] = record["status"]
+        for hook in self.__metrics_hooks:
+            try:
+                hook(cmd_id, metrics)
+            except Exception as e:
+                logger.warning(f"Metrics hook {hook} failed: {e}")
+        future = Future()
+        future.set_result(record)
+        return future
+
+    def run_many(self, batch: List[Union[str, List[str]]]) -> List[dict]:
+        """依次执行一批cmd, 按顺序返回它们的cmd_space记录"""
+        return [self.submit(cmds).result() for cmds in batch]
+
+    def stream(self, cmds: Union[str, List[str]]) -> Iterator[OutputChunk]:
+        """执行cmd并逐段产出其输出, cmd在调用线程中执行, 输出在执行完成后产出, 生成器的返回值为cmd_space记录"""
+        chunks = []
+        future = self.submit(cmds, on_output=chunks.append)
+        yield from chunks
+        return future.result()
+
+    def _run(self, cmds):
+        return self.submit(cmds).result()
+
+    def print_cmd_space(self):
+        pprint.pprint(self._cmd_space.to_dict())
+
+    def run(self):
+        while True:
+            # 从外部获取命令（通过yield）
+            cmds = yield
+            if cmds is None:
+                continue
+
+            if isinstance(cmds, str):
+                cmds = [cmds]
+
+            try:
+                self._run(cmds)
+            except Exception as e:
+                logger.error(e)
+                break
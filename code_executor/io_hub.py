@@ -0,0 +1,199 @@
+import os
+import time
+import heapq
+import codecs
+import itertools
+import selectors
+import threading
+from collections import deque
+from typing import Callable, Optional
+from loguru import logger
+
+from code_executor.protocol import READ_CHUNK_SIZE
+
+DRAIN_TIMEOUT = 5.0  # 会话进程退出后等待其输出管道读到EOF的最长秒数
+
+
+class LineReader(object):
+    """把任意切分的字节块还原为文本行, 每得到一行就交给on_line处理"""
+
+    def __init__(self, on_line: Callable[[str], None]):
+        self.on_line = on_line
+        self.__decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.__partial = ""
+
+    def feed(self, data: bytes):
+        *lines, self.__partial = (self.__partial + self.__decoder.decode(data)).split("\n")
+        for line in lines:
+            self.on_line(line)
+
+    def close(self):
+        line = self.__partial + self.__decoder.decode(b"", final=True)
+        self.__partial = ""
+        if line:
+            self.on_line(line)
+
+
+class IOHub(object):
+    """所有SyncCodeExecutor共享的I/O反应器
+
+    一个守护线程通过selector(Linux上为epoll)监听全部会话进程的输出管道, 以非阻塞方式按块读取,
+    并在该线程中调用注册时给出的回调; 因此回调不应阻塞, 否则会拖慢所有会话的输出处理.
+    """
+
+    _shared: Optional["IOHub"] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.__selector = selectors.DefaultSelector()
+        self.__wakeup_r, self.__wakeup_w = os.pipe()  # 其它线程注册fd后唤醒select
+        os.set_blocking(self.__wakeup_r, False)
+        self.__selector.register(self.__wakeup_r, selectors.EVENT_READ)
+        self.__registrations = deque()
+        self.__thread = threading.Thread(target=self._run, name="code-executor-io-hub", daemon=True)
+        self.__thread.start()
+
+    @classmethod
+    def shared(cls) -> "IOHub":
+        """进程内共享的IOHub, 第一次使用时启动"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def __len__(self) -> int:
+        """正在监听的fd数量"""
+        return len(self.__selector.get_map()) - 1
+
+    def register(
+        self, fd: int, on_data: Callable[[bytes], None], on_close: Callable[[], None] = None
+    ) -> threading.Event:
+        """监听fd, 读到数据时调用on_data, 读到EOF后取消监听并调用on_close, 返回的Event在on_close完成后被设置
+
+        fd由调用方负责关闭, 且在返回的Event被设置之前不能关闭.
+        """
+        os.set_blocking(fd, False)
+        closed = threading.Event()
+        self.__registrations.append((fd, (on_data, on_close, closed)))
+        os.write(self.__wakeup_w, b"\0")
+        return closed
+
+    def unregister(self, fd: int, closed: threading.Event):
+        """取消监听fd, 与读到EOF时一样调用on_close并设置closed, closed为register返回的Event
+
+        用于管道写端仍被其它进程(如会话进程派生的后台子进程)持有, 永远读不到EOF的情况.
+        """
+        self.__registrations.append((fd, closed))
+        os.write(self.__wakeup_w, b"\0")
+
+    def _run(self):
+        while True:
+            for key, _ in self.__selector.select():
+                if key.fd == self.__wakeup_r:
+                    self._accept_registrations()
+                    continue
+                on_data, on_close, closed = key.data
+                try:
+                    data = os.read(key.fd, READ_CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b""
+                if data:
+                    self._call(on_data, data)
+                    continue
+                self._close(key.fd)
+
+    def _close(self, fd: int):
+        _, on_close, closed = self.__selector.unregister(fd).data
+        if on_close is not None:
+            self._call(on_close)
+        closed.set()
+
+    def _accept_registrations(self):
+        try:
+            while os.read(self.__wakeup_r, READ_CHUNK_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while self.__registrations:
+            fd, data = self.__registrations.popleft()
+            if not isinstance(data, threading.Event):
+                self.__selector.register(fd, selectors.EVENT_READ, data)
+                continue
+            # 取消监听: fd已读到EOF(或被同一fd号的新注册取代)时不做任何事
+            key = self.__selector.get_map().get(fd)
+            if key is not None and key.data[2] is data:
+                self._close(fd)
+
+    @staticmethod
+    def _call(callback: Callable, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.exception(f"IO hub callback {callback} failed: {e}")
+
+
+class TimerQueue(object):
+    """所有SyncCodeExecutor共享的计时器
+
+    一个守护线程按截止时间的顺序调用到期的回调, 代替每个计时都启动一个threading.Timer线程;
+    回调在该线程中依次执行, 因此应尽快返回, 否则会推迟其它会话的计时.
+    """
+
+    _shared: Optional["TimerQueue"] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.__heap = []  # (截止时间, handle, callback, args)
+        self.__active = set()  # 尚未到期且未被取消的handle
+        self.__handles = itertools.count()
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self._run, name="code-executor-timer", daemon=True)
+        self.__thread.start()
+
+    @classmethod
+    def shared(cls) -> "TimerQueue":
+        """进程内共享的TimerQueue, 第一次使用时启动"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def __len__(self) -> int:
+        """尚未到期的计时数量"""
+        return len(self.__active)
+
+    def call_later(self, delay: float, callback: Callable, *args) -> int:
+        """delay秒后调用callback(*args), 返回可用于cancel()的handle"""
+        with self.__condition:
+            handle = next(self.__handles)
+            heapq.heappush(self.__heap, (time.monotonic() + delay, handle, callback, args))
+            self.__active.add(handle)
+            self.__condition.notify()
+        return handle
+
+    def cancel(self, handle: int):
+        """取消尚未到期的计时, 已到期或已取消时不做任何事"""
+        with self.__condition:
+            self.__active.discard(handle)
+
+    def _run(self):
+        while True:
+            with self.__condition:
+                while True:
+                    while self.__heap and self.__heap[0][1] not in self.__active:
+                        heapq.heappop(self.__heap)
+                    if not self.__heap:
+                        self.__condition.wait()
+                        continue
+                    delay = self.__heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.__condition.wait(delay)
+                _, handle, callback, args = heapq.heappop(self.__heap)
+                self.__active.discard(handle)
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.exception(f"Timer callback {callback} failed: {e}")
@@ -0,0 +1,17 @@
+"""会话进程的资源限制
+
+限制在会话进程创建后通过prlimit设置, 对直接启动和由fork server派生的会话同样有效.
+Linux并不执行RLIMIT_RSS, 因此内存限制以虚拟地址空间(RLIMIT_AS)近似, 其中包含解释器和已导入模块占用的部分.
+"""
+
+import resource
+
+
+def apply_rlimits(pid: int, cpu_limit: int = None, memory_limit: int = None):
+    """cpu_limit为会话进程累计的CPU秒数, 超过时会话进程被内核以SIGXCPU终止;
+    memory_limit为虚拟地址空间的字节数, 超过时会话中的内存分配抛出MemoryError, 会话保持运行
+    """
+    for limit, value in ((resource.RLIMIT_CPU, cpu_limit), (resource.RLIMIT_AS, memory_limit)):
+        if value is not None:
+            assert value > 0, "resource limits should be positive!"
+            resource.prlimit(pid, limit, (value, value))
@@ -0,0 +1,91 @@
+import json
+import threading
+from typing import Dict, Optional
+
+# cmd_space中每条记录的metrics字段, 时间单位为秒, 大小单位为字节
+TIME_METRICS = ("queue_time", "wall_time", "cpu_time", "snapshot_time", "total_time")
+SIZE_METRICS = ("output_bytes", "rss_peak_delta", "snapshot_bytes", "snapshot_written_bytes")
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)  # total_time直方图的上界
+
+
+class MetricsRegistry(object):
+    """按executor类型汇总多个会话的cmd性能指标, 可以导出为JSON或Prometheus文本格式"""
+
+    _shared: Optional["MetricsRegistry"] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__series: Dict[str, dict] = {}  # executor: 汇总值
+
+    @classmethod
+    def shared(cls) -> "MetricsRegistry":
+        """进程内所有executor默认上报的MetricsRegistry"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def observe(self, metrics: dict, executor: str = "default"):
+        """记录一个cmd的指标"""
+        with self.__lock:
+            series = self.__series.setdefault(
+                executor,
+                {"commands": 0, "errors": 0, "metrics": {}, "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1)},
+            )
+            series["commands"] += 1
+            series["errors"] += bool(metrics.get("status"))
+            for name in TIME_METRICS + SIZE_METRICS:
+                value = metrics.get(name)
+                if value is None:
+                    continue
+                summary = series["metrics"].setdefault(name, {"count": 0, "sum": 0, "max": 0})
+                summary["count"] += 1
+                summary["sum"] += value
+                summary["max"] = max(summary["max"], value)
+            if metrics.get("total_time") is not None:
+                index = next((i for i, b in enumerate(LATENCY_BUCKETS) if metrics["total_time"] <= b), -1)
+                series["latency_buckets"][index] += 1
+
+    def reset(self):
+        with self.__lock:
+            self.__series.clear()
+
+    def to_dict(self) -> dict:
+        with self.__lock:
+            return json.loads(json.dumps(self.__series))
+
+    def dump_json(self, path: str = None) -> str:
+        text = json.dumps(self.to_dict(), indent=4, sort_keys=True)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    def dump_prometheus(self) -> str:
+        """Prometheus文本格式, total_time为直方图, 其余指标为summary(_sum/_count)"""
+        series = self.to_dict()
+        lines = [
+            "# HELP code_executor_commands_total Number of executed commands.",
+            "# TYPE code_executor_commands_total counter",
+        ]
+        for executor, s in series.items():
+            lines.append(
+                f'code_executor_commands_total{{executor="{executor}",status="ok"}} {s["commands"] - s["errors"]}'
+            )
+            lines.append(f'code_executor_commands_total{{executor="{executor}",status="error"}} {s["errors"]}')
+
+        for name in TIME_METRICS + SIZE_METRICS:
+            metric = f"code_executor_{name}_seconds" if name in TIME_METRICS else f"code_executor_{name}"
+            kind = "histogram" if name == "total_time" else "summary"
+            lines.append(f"# TYPE {metric} {kind}")
+            for executor, s in series.items():
+                summary = s["metrics"].get(name, {"count": 0, "sum": 0})
+                if name == "total_time":
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), s["latency_buckets"]):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{executor="{executor}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{executor="{executor}"}} {summary["sum"]}')
+                lines.append(f'{metric}_count{{executor="{executor}"}} {summary["count"]}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,159 @@
+import time
+import codecs
+import threading
+from pathlib import Path
+from collections import deque
+from typing import Iterable, Iterator, MutableMapping, NamedTuple, Optional
+
+
+class OutputChunk(NamedTuple):
+    """会话进程的一段输出, cmd_id为None表示不属于任何cmd(如C层面直接写fd的输出)"""
+
+    cmd_id: Optional[str]
+    stream: str  # stdout 或 stderr
+    text: str
+    timestamp: float
+
+    @classmethod
+    def now(cls, cmd_id: Optional[str], stream: str, text: str) -> "OutputChunk":
+        return cls(cmd_id, stream, text, time.time())
+
+
+class ConsoleSink(object):
+    """把输出逐行打印到宿主进程控制台, 每行带STDOUT:/STDERR:前缀"""
+
+    def __call__(self, chunk: OutputChunk):
+        prefix = f"{chunk.stream.upper()}: "
+        for line in chunk.text.splitlines():
+            if line.strip():
+                print(f"{prefix}{line.strip()}")
+
+
+class OutputBudget(object):
+    """一个会话内所有输出缓冲区共享的内存额度, 额度用尽后新的输出直接溢出到磁盘"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.__lock = threading.Lock()
+
+    def reserve(self, size: int) -> bool:
+        with self.__lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size: int):
+        with self.__lock:
+            self.used = max(0, self.used - size)
+
+
+class OutputBuffer(object):
+    """单个cmd单个输出流的缓冲区
+
+    输出以块的形式追加, 总量不超过limit时全部保存在内存中;
+    超过limit或会话额度用尽后, 全部输出写入spill_path, 内存中只保留开头和结尾各keep字节.
+    未溢出的输出在close()之后仍占用会话额度(其文本保留在cmd_space中), 直到溢出或调用release().
+    """
+
+    def __init__(self, spill_path: str, limit: int = 1 << 20, keep: int = 1 << 15, budget: OutputBudget = None):
+        self.spill_path = spill_path
+        self.limit = limit
+        self.keep = keep
+        self.budget = budget
+        self.size = 0
+        self.spilled = False
+        self.__chunks = []
+        self.__reserved = 0  # 从会话额度中占用的字节数
+        self.__head = b""
+        self.__tail = deque()
+        self.__tail_size = 0
+        self.__file = None
+
+    def append(self, data: bytes):
+        if not data:
+            return
+        self.size += len(data)
+        if not self.spilled:
+            if self.size <= self.limit and (self.budget is None or self.budget.reserve(len(data))):
+                self.__reserved += len(data)
+                self.__chunks.append(data)
+                return
+            self._spill()
+        self.__file.write(data)
+        self._keep_tail(data)
+
+    def _spill(self):
+        Path(self.spill_path).parent.mkdir(parents=True, exist_ok=True)
+        self.__file = open(self.spill_path, "wb")
+        data = b"".join(self.__chunks)
+        self.__chunks = []
+        self.release()
+        self.__file.write(data)
+        self.__head = data[: self.keep]
+        self._keep_tail(data)
+        self.spilled = True
+
+    def _keep_tail(self, data: bytes):
+        self.__tail.append(data[-self.keep :])
+        self.__tail_size += len(self.__tail[-1])
+        while self.__tail_size - len(self.__tail[0]) >= self.keep:
+            self.__tail_size -= len(self.__tail.popleft())
+
+    def release(self):
+        """归还占用的会话额度, 在保留的输出文本被丢弃(如cmd记录持久化后不再常驻内存)时调用"""
+        if self.budget is not None and self.__reserved:
+            self.budget.release(self.__reserved)
+        self.__reserved = 0
+
+    def text(self) -> str:
+        """完整输出, 已溢出时为开头和结尾两段并注明被省略的字节数"""
+        if not self.spilled:
+            return b"".join(self.__chunks).decode(errors="replace")
+        tail = b"".join(self.__tail)[-self.keep :]
+        omitted = self.size - len(self.__head) - len(tail)
+        return (
+            self.__head.decode(errors="replace")
+            + f"\n... [{omitted} bytes omitted, full output in {self.spill_path}] ...\n"
+            + tail.decode(errors="replace")
+        )
+
+    def close(self) -> str:
+        """结束写入, 返回text()"""
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        text = self.text()
+        self.__chunks = []
+        return text
+
+
+def read_output(path: str, offset: int = 0, size: int = -1) -> bytes:
+    """按字节偏移读取已溢出到磁盘的输出"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def iter_output(path: str, chunk_size: int = 1 << 16) -> Iterator[str]:
+    """惰性地逐块读取已溢出到磁盘的输出"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield decoder.decode(chunk)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def release_spilled(records: Iterable[MutableMapping], directory: str):
+    """溢出文件所在的临时目录即将被删除, 移除记录中指向其中文件的字段并标记output_released
+
+    此后read_output()/iter_output()只能读到记录中保留的开头和结尾两段.
+    """
+    for record in records:
+        for key in [key for key in record if key.endswith("_file")]:
+            if Path(record[key]).parent == Path(directory):
+                del record[key]
+                record["output_released"] = True
@@ -0,0 +1,154 @@
+import os
+import dill
+import shutil
+import pprint
+import tempfile
+import itertools
+from pathlib import Path
+from concurrent.futures import Future
+from typing import Any, Iterable, List, Optional, Sequence, Tuple, Union
+from loguru import logger
+
+from code_executor.constant import PARALLEL_WORKER_CODE, PyExeConfig
+from code_executor.history import CommandHistory
+from code_executor.pyexe import PyExecutor
+
+
+class ParallelPyExecutor(object):
+    """持有n_workers个PyExecutor会话, 把CPU密集的代码分散到多个解释器中并行执行
+
+    每个并行操作在各worker的cmd_space中各自记录一条cmd, 同时合并为本对象_cmd_space中的一条记录,
+    其中workers字段保存每个worker对应的cmd_id, 输出和状态.
+    """
+
+    def __init__(
+        self,
+        n_workers: int = None,
+        work_dir: str = None,
+        is_save_obj: bool = False,
+        use_fork_server: bool = True,
+        init_code: str = None,
+        **kwargs,
+    ):
+        self.n_workers = n_workers or os.cpu_count()
+        assert self.n_workers > 0, "n_workers should be positive!"
+        self.work_dir = work_dir
+        self.is_save_obj = is_save_obj
+        self.workers = [
+            PyExecutor(
+                str(Path(work_dir) / f"worker_{i}") if work_dir else None, is_save_obj, use_fork_server, **kwargs
+            )
+            for i in range(self.n_workers)
+        ]
+        self._cmd_space = CommandHistory()
+        self.__transfer_dir = tempfile.mkdtemp(prefix="code_executor_parallel_")
+        self.__transfer_ids = itertools.count()
+        for worker in self.workers:
+            worker._execute_internal(PARALLEL_WORKER_CODE)
+        if init_code:
+            self.check(self.broadcast(init_code))
+
+    def __enter__(self) -> "ParallelPyExecutor":
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_process()
+
+    def _transfer_path(self, worker: int) -> str:
+        return str(Path(self.__transfer_dir) / f"{next(self.__transfer_ids)}.{worker}.pkl")
+
+    def _submit_all(self, commands: Sequence[Optional[str]]) -> List[Tuple[int, str, Future]]:
+        """先把命令写入所有worker再等待, 命令为None的worker不参与"""
+        submitted = []
+        for i, (worker, command) in enumerate(zip(self.workers, commands)):
+            if command is not None:
+                submitted.append((i, str(len(worker._cmd_space)), worker.submit(command)))
+        return submitted
+
+    def _merge(self, cmd: str, submitted: List[Tuple[int, str, Future]]) -> dict:
+        """等待各worker执行完成, 把结果合并为_cmd_space中的一条记录"""
+        workers = []
+        for i, cmd_id, future in submitted:
+            record = future.result()
+            workers.append(
+                {"worker": i, "cmd_id": cmd_id, **{k: record.get(k) for k in ("stdout", "stderr", "status")}}
+            )
+        cmd_id = str(len(self._cmd_space))
+        self._cmd_space[cmd_id] = {
+            "cmd": cmd,
+            "stdout": "\n".join(w["stdout"] for w in workers if w["stdout"]),
+            "stderr": "\n".join(w["stderr"] for w in workers if w["stderr"]),
+            "status": max((w["status"] or 0 for w in workers), default=0),
+            "workers": workers,
+        }
+        return self._cmd_space[cmd_id]
+
+    @staticmethod
+    def check(record: dict) -> dict:
+        """任一worker执行出错时抛出RuntimeError"""
+        failed = [w for w in record["workers"] if w["status"]]
+        if failed:
+            details = "\n".join(f"worker {w['worker']} (cmd {w['cmd_id']}): {w['stderr']}" for w in failed)
+            raise RuntimeError(f"{len(failed)} workers failed:\n{details}")
+        return record
+
+    def broadcast(self, cmds: Union[str, List[str]]) -> dict:
+        """在所有worker上并行执行同一段代码, 如共享的初始化代码"""
+        cmd = cmds if isinstance(cmds, str) else " ".join(cmds)
+        return self._merge(cmd, self._submit_all([cmd] * self.n_workers))
+
+    def broadcast_snapshot(self, snapshot_path: str, lazy: bool = False) -> dict:
+        """把某个会话保存的快照(manifest.json)载入所有worker"""
+        return self.check(self.broadcast(PyExeConfig.load_obj_cmd.format(snapshot_path, lazy, False)))
+
+    def scatter(self, var: str, chunks: Sequence[Any]) -> dict:
+        """把chunks[i]赋值给第i个worker中的变量var"""
+        assert len(chunks) == self.n_workers, f"scatter needs {self.n_workers} chunks, got {len(chunks)}!"
+        commands = []
+        for i, chunk in enumerate(chunks):
+            path = self._transfer_path(i)
+            with open(path, "wb") as f:
+                dill.dump(chunk, f)
+            commands.append(f"{var} = __cx_load_value__({path!r})")
+        return self.check(self._merge(f"scatter {var}", self._submit_all(commands)))
+
+    def gather(self, var: str) -> List[Any]:
+        """按worker顺序取回各worker中变量var的值"""
+        paths = [self._transfer_path(i) for i in range(self.n_workers)]
+        self.check(self._merge(f"gather {var}", self._submit_all([f"__cx_dump_value__({var}, {p!r})" for p in paths])))
+        return [self._load_transfer(path) for path in paths]
+
+    def map(self, code_template: str, items: Iterable[Any]) -> List[Any]:
+        """把items按顺序切分给各worker, 对每个元素计算表达式code_template(其中用item引用该元素), 按原顺序返回结果"""
+        items = list(items)
+        commands, paths = [], []
+        for i in range(self.n_workers):
+            chunk = items[len(items) * i // self.n_workers : len(items) * (i + 1) // self.n_workers]
+            if not chunk:
+                commands.append(None)
+                continue
+            in_path, out_path = self._transfer_path(i), self._transfer_path(i)
+            with open(in_path, "wb") as f:
+                dill.dump(chunk, f)
+            commands.append(
+                f"__cx_dump_value__([({code_template}) for item in __cx_load_value__({in_path!r})], {out_path!r})"
+            )
+            paths.append(out_path)
+        self.check(self._merge(f"map {code_template}", self._submit_all(commands)))
+        return [value for path in paths for value in self._load_transfer(path)]
+
+    @staticmethod
+    def _load_transfer(path: str) -> Any:
+        with open(path, "rb") as f:
+            value = dill.load(f)
+        os.remove(path)
+        return value
+
+    def print_cmd_space(self):
+        pprint.pprint(self._cmd_space.to_dict())
+
+    def stop_process(self):
+        for worker in self.workers:
+            worker.stop_process()
+        shutil.rmtree(self.__transfer_dir, ignore_errors=True)
+        logger.info(f"All {self.n_workers} workers terminate successfully!")
@@ -0,0 +1,291 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Callable, Dict
+from loguru import logger
+
+from code_executor.sync_executor import SyncCodeExecutor
+from code_executor.async_executor import AsyncCodeExecutor
+from code_executor.pyexe import PyExecutor, AsyncPyExecutor
+
+
+class ExecutorPool(object):
+    """预先启动并完成初始化的SyncCodeExecutor会话池
+
+    checkout命中空闲的热会话记为hit, 需要现场冷启动会话记为miss.
+    会话在执行max_commands条命令或存活max_age秒后, 归还时会被回收并补充新的热会话.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], SyncCodeExecutor] = PyExecutor,
+        *,
+        min_size: int = 1,
+        max_size: int = 4,
+        max_commands: int = None,
+        max_age: float = None,
+    ):
+        assert 0 <= min_size <= max_size and max_size > 0, "pool size should satisfy 0 <= min_size <= max_size!"
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_commands = max_commands
+        self.max_age = max_age
+        self.stats = {"hits": 0, "misses": 0, "created": 0, "recycled": 0, "unhealthy": 0}
+        self.__idle = deque()
+        self.__started_at: Dict[int, float] = {}  # id(executor): 会话启动时间
+        self.__size = 0  # 空闲 + 已借出的会话数
+        self.__cond = threading.Condition()
+        self.__closed = False
+        self.fill()
+
+    def __enter__(self) -> "ExecutorPool":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _create(self) -> SyncCodeExecutor:
+        executor = self.factory()
+        executor.warm_up()
+        with self.__cond:
+            self.__started_at[id(executor)] = time.monotonic()
+            self.stats["created"] += 1
+        return executor
+
+    def _destroy(self, executor: SyncCodeExecutor):
+        with self.__cond:
+            self.__started_at.pop(id(executor), None)
+            self.__size -= 1
+            self.__cond.notify()
+        executor.stop_process()
+
+    def is_expired(self, executor: SyncCodeExecutor) -> bool:
+        """会话是否达到命令数或存活时间的回收阈值"""
+        if self.max_commands is not None and len(executor._cmd_space) >= self.max_commands:
+            return True
+        started_at = self.__started_at.get(id(executor), time.monotonic())
+        return self.max_age is not None and time.monotonic() - started_at >= self.max_age
+
+    def fill(self):
+        """补充热会话直到空闲会话数不少于min_size"""
+        while True:
+            with self.__cond:
+                if self.__closed or len(self.__idle) >= self.min_size or self.__size >= self.max_size:
+                    return
+                self.__size += 1
+            try:
+                executor = self._create()
+            except Exception:
+                with self.__cond:
+                    self.__size -= 1
+                raise
+            with self.__cond:
+                self.__idle.append(executor)
+                self.__cond.notify()
+
+    def checkout(self, timeout: float = None) -> SyncCodeExecutor:
+        """借出一个热会话, 池满时阻塞等待归还"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__cond:
+            while True:
+                assert not self.__closed, "pool has been closed!"
+                while self.__idle:
+                    executor = self.__idle.popleft()
+                    if executor.is_alive() and not self.is_expired(executor):
+                        self.stats["hits"] += 1
+                        return executor
+                    self.stats["unhealthy" if not executor.is_alive() else "recycled"] += 1
+                    self.__started_at.pop(id(executor), None)
+                    self.__size -= 1
+                    threading.Thread(target=executor.stop_process, daemon=True).start()
+
+                if self.__size < self.max_size:
+                    self.__size += 1
+                    self.stats["misses"] += 1
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("no executor available in pool")
+                self.__cond.wait(remaining)
+
+        try:
+            return self._create()
+        except Exception:
+            with self.__cond:
+                self.__size -= 1
+                self.__cond.notify()
+            raise
+
+    def checkin(self, executor: SyncCodeExecutor):
+        """归还会话, 失效或到期的会话会被回收"""
+        if self.__closed or not executor.is_alive() or self.is_expired(executor):
+            if not self.__closed:
+                self.stats["recycled" if executor.is_alive() else "unhealthy"] += 1
+            self._destroy(executor)
+            self.fill()
+            return
+
+        with self.__cond:
+            self.__idle.append(executor)
+            self.__cond.notify()
+
+    def health_check(self) -> int:
+        """移除空闲队列中失效或到期的会话并补充热会话, 返回移除数量"""
+        with self.__cond:
+            stale = [e for e in self.__idle if not e.is_alive() or self.is_expired(e)]
+            for executor in stale:
+                self.__idle.remove(executor)
+                self.stats["unhealthy" if not executor.is_alive() else "recycled"] += 1
+
+        for executor in stale:
+            self._destroy(executor)
+        if stale:
+            logger.info(f"Pool health check removed {len(stale)} executors.")
+        self.fill()
+        return len(stale)
+
+    def close(self):
+        """停止所有空闲会话, 已借出的会话在归还时停止"""
+        with self.__cond:
+            self.__closed = True
+            idle, self.__idle = list(self.__idle), deque()
+            self.__cond.notify_all()
+        for executor in idle:
+            self._destroy(executor)
+
+
+class AsyncExecutorPool(object):
+    """预先启动并完成初始化的AsyncCodeExecutor会话池, 语义与ExecutorPool一致"""
+
+    def __init__(
+        self,
+        factory: Callable[[], AsyncCodeExecutor] = AsyncPyExecutor,
+        *,
+        min_size: int = 1,
+        max_size: int = 4,
+        max_commands: int = None,
+        max_age: float = None,
+    ):
+        assert 0 <= min_size <= max_size and max_size > 0, "pool size should satisfy 0 <= min_size <= max_size!"
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_commands = max_commands
+        self.max_age = max_age
+        self.stats = {"hits": 0, "misses": 0, "created": 0, "recycled": 0, "unhealthy": 0}
+        self.__idle = deque()
+        self.__started_at: Dict[int, float] = {}
+        self.__size = 0
+        self.__cond = asyncio.Condition()
+        self.__closed = False
+
+    async def __aenter__(self) -> "AsyncExecutorPool":
+        await self.fill()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _create(self) -> AsyncCodeExecutor:
+        executor = self.factory()
+        await executor.warm_up()
+        self.__started_at[id(executor)] = time.monotonic()
+        self.stats["created"] += 1
+        return executor
+
+    async def _destroy(self, executor: AsyncCodeExecutor):
+        self.__started_at.pop(id(executor), None)
+        self.__size -= 1
+        async with self.__cond:
+            self.__cond.notify()
+        await executor.stop_process()
+
+    def is_expired(self, executor: AsyncCodeExecutor) -> bool:
+        """会话是否达到命令数或存活时间的回收阈值"""
+        if self.max_commands is not None and len(executor._cmd_space) >= self.max_commands:
+            return True
+        started_at = self.__started_at.get(id(executor), time.monotonic())
+        return self.max_age is not None and time.monotonic() - started_at >= self.max_age
+
+    async def fill(self):
+        """补充热会话直到空闲会话数不少于min_size"""
+        while not self.__closed and len(self.__idle) < self.min_size and self.__size < self.max_size:
+            self.__size += 1
+            try:
+                executor = await self._create()
+            except Exception:
+                self.__size -= 1
+                raise
+            async with self.__cond:
+                self.__idle.append(executor)
+                self.__cond.notify()
+
+    async def checkout(self, timeout: float = None) -> AsyncCodeExecutor:
+        """借出一个热会话, 池满时等待归还"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        async with self.__cond:
+            while True:
+                assert not self.__closed, "pool has been closed!"
+                while self.__idle:
+                    executor = self.__idle.popleft()
+                    if executor.is_alive() and not self.is_expired(executor):
+                        self.stats["hits"] += 1
+                        return executor
+                    self.stats["unhealthy" if not executor.is_alive() else "recycled"] += 1
+                    self.__started_at.pop(id(executor), None)
+                    self.__size -= 1
+                    asyncio.create_task(executor.stop_process())
+
+                if self.__size < self.max_size:
+                    self.__size += 1
+                    self.stats["misses"] += 1
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("no executor available in pool")
+                try:
+                    await asyncio.wait_for(self.__cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+        try:
+            return await self._create()
+        except Exception:
+            self.__size -= 1
+            raise
+
+    async def checkin(self, executor: AsyncCodeExecutor):
+        """归还会话, 失效或到期的会话会被回收"""
+        if self.__closed or not executor.is_alive() or self.is_expired(executor):
+            if not self.__closed:
+                self.stats["recycled" if executor.is_alive() else "unhealthy"] += 1
+            await self._destroy(executor)
+            await self.fill()
+            return
+
+        async with self.__cond:
+            self.__idle.append(executor)
+            self.__cond.notify()
+
+    async def health_check(self) -> int:
+        """移除空闲队列中失效或到期的会话并补充热会话, 返回移除数量"""
+        stale = [e for e in self.__idle if not e.is_alive() or self.is_expired(e)]
+        for executor in stale:
+            self.__idle.remove(executor)
+            self.stats["unhealthy" if not executor.is_alive() else "recycled"] += 1
+            await self._destroy(executor)
+        if stale:
+            logger.info(f"Pool health check removed {len(stale)} executors.")
+        await self.fill()
+        return len(stale)
+
+    async def close(self):
+        """停止所有空闲会话, 已借出的会话在归还时停止"""
+        self.__closed = True
+        idle, self.__idle = list(self.__idle), deque()
+        for executor in idle:
+            await self._destroy(executor)
@@ -0,0 +1,73 @@
+"""会话进程与执行器之间的分帧结果协议
+
+会话进程把每段代码的输出写入一个专用的fd, 每一帧由定长帧头和负载组成:
+    cmd_id(uint32) | stream(uint8) | status(uint8) | length(uint32) | payload(length字节)
+stream为STREAM_END的帧表示该cmd执行完成, status为非0时表示代码抛出了异常.
+"""
+
+import os
+import codeop
+import struct
+import tempfile
+from typing import List, NamedTuple
+
+FRAME_HEADER = struct.Struct("!IBBI")
+FRAME_FD_ENV = "CODE_EXECUTOR_FRAME_FD"  # 会话进程通过该环境变量获得帧通道的fd
+READ_CHUNK_SIZE = 1 << 16
+
+STREAM_END = 0
+STREAM_STDOUT = 1
+STREAM_STDERR = 2
+STREAM_NAMES = {STREAM_STDOUT: "stdout", STREAM_STDERR: "stderr"}
+
+INTERNAL_CMD_ID_BASE = 0xFFFF0000  # 预热, 刷新快照等内部命令使用的cmd_id起点, 不会出现在cmd_space中
+
+
+def interrupt_path(pid: int) -> str:
+    """中断文件的路径, 执行器写入要中断的cmd_id后向会话进程pid发送SIGINT, 会话只中断正在执行的该cmd"""
+    return os.path.join(tempfile.gettempdir(), f"code_executor_{pid}.interrupt")
+
+
+def is_incomplete(source: str) -> bool:
+    """source是否为不完整的语句(如未闭合的括号)
+
+    行哨兵模式下REPL会把不完整语句之后发送的哨兵当作续行读入, 永远不会输出END_OF_EXECUTION.
+    """
+    try:
+        return codeop.compile_command(source, "<input>", "exec") is None
+    except (SyntaxError, ValueError, OverflowError):
+        return False
+
+
+class Frame(NamedTuple):
+    cmd_id: int
+    stream: int
+    status: int
+    payload: bytes
+
+
+class FrameParser(object):
+    """增量解析任意切分的字节块, 返回其中完整的帧"""
+
+    def __init__(self):
+        self.__buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[Frame]:
+        self.__buffer += data
+        frames, offset = [], 0
+        while len(self.__buffer) - offset >= FRAME_HEADER.size:
+            cmd_id, stream, status, length = FRAME_HEADER.unpack_from(self.__buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+            if len(self.__buffer) < end:
+                break
+            frames.append(
+                Frame(
+                    cmd_id,
+                    stream,
+                    status,
+                    bytes(self.__buffer[offset + FRAME_HEADER.size : end]),
+                )
+            )
+            offset = end
+        del self.__buffer[:offset]
+        return frames
@@ -1,27 +1,344 @@
-from code_executor.constant import PyExeConfig
+import ast
+import json
+from typing import Iterable, List, Sequence, Union
+import numpy as np
+from numpy.lib.format import dtype_to_descr
+from loguru import logger
+
+from code_executor import shared_memory
+from code_executor.constant import PARALLEL_WORKER_CODE, ExeConfig, PyExeConfig
+from code_executor.dependency import DependencyGraph
+from code_executor.inprocess import InProcessExecutor
 from code_executor.sync_executor import SyncCodeExecutor
 from code_executor.async_executor import AsyncCodeExecutor
 
+# 由PyExeConfig决定的参数, load()时从executor.json中读到的同名参数会被忽略
+_CONFIG_KWARGS = (
+    "base_command",
+    "print_cmd",
+    "save_obj_cmd",
+    "load_obj_cmd",
+    "exec_cmd",
+    "bg_save_obj_cmd",
+    "flush_obj_cmd",
+    "fork_cmd",
+)
+
+
+def _check(record: dict, action: str) -> dict:
+    if record["status"]:
+        raise RuntimeError(f"{action} failed:\n{record['stderr']}")
+    return record
+
+
+def _replay_batches(graph: DependencyGraph, cmd_ids: List[str], max_workers: int) -> List[List[str]]:
+    """max_workers为1时逐个按原顺序执行, 否则把依赖图的每一层切分为最多max_workers个cell的批次"""
+    assert max_workers > 0, "max_workers should be positive!"
+    if max_workers == 1:
+        return [[cmd_id] for cmd_id in cmd_ids]
+    return [level[i : i + max_workers] for level in graph.levels(cmd_ids) for i in range(0, len(level), max_workers)]
+
+
+def _replayed(record: dict, cmd_id: str) -> dict:
+    """fork出的会话中执行的cell在原会话cmd_space中的记录"""
+    fields = {k: record[k] for k in ("cmd", "stdout", "stderr", "status", "metrics") if k in record}
+    return {**fields, "rerun_of": cmd_id}
+
 
 class PyExecutor(SyncCodeExecutor):
-    def __init__(self, work_dir: str = None, is_save_obj: bool = False, **kwargs):
+    def __init__(
+        self,
+        work_dir: str = None,
+        is_save_obj: bool = False,
+        use_fork_server: bool = False,
+        init_profile: str = None,
+        **kwargs,
+    ):
+        # init_profile为None时使用PyExeConfig默认的profile, 见constant.INIT_PROFILES
+        config = PyExeConfig if init_profile is None else PyExeConfig.with_profile(init_profile)
         super().__init__(
-            PyExeConfig.session_command,
-            PyExeConfig.print_cmd,
+            config.session_command,
+            config.print_cmd,
             work_dir=work_dir,
             is_save_obj=is_save_obj,
-            save_obj_cmd=PyExeConfig.save_obj_cmd,
-            load_obj_cmd=PyExeConfig.load_obj_cmd,
+            save_obj_cmd=config.save_obj_cmd,
+            load_obj_cmd=config.load_obj_cmd,
+            use_fork_server=use_fork_server,
+            exec_cmd=config.exec_cmd,
+            bg_save_obj_cmd=config.bg_save_obj_cmd,
+            flush_obj_cmd=config.flush_obj_cmd,
+            fork_cmd=config.fork_cmd,
+            **{k: v for k, v in kwargs.items() if k not in _CONFIG_KWARGS},
         )
+        self.init_profile = init_profile
+        self._startup_trace = None  # 最近一次startup_trace()的结果, 随Executor一起保存
+
+    def startup_trace(self) -> dict:
+        """会话init_code中每个模块的导入耗时([模块名, 不含子模块的秒数, 含子模块的秒数]), 总耗时init_seconds,
+        以及延迟导入的模块第一次被使用时的导入耗时lazy
+
+        由fork server派生或fork()得到的会话继承了执行init_code的进程的记录, 此时inherited为True.
+        """
+        record = _check(self._execute_internal("__cx_dump_startup_trace__()"), "startup trace")
+        self._startup_trace = json.loads(record["stdout"])
+        return self._startup_trace
+
+    def put(self, name: str, value: shared_memory.SharedValue):
+        """经由共享内存把numpy数组或字节缓冲区赋值给会话中的变量name, 管道中只传递描述符, 不做序列化
+
+        数据只在宿主进程中复制一次到共享内存, 会话直接映射这块内存; 字节缓冲区在会话中为memoryview.
+        """
+        descriptor, data = shared_memory.describe(value)
+        path, shared = shared_memory.allocate(descriptor)
+        try:
+            shared_memory.describe(shared)[1][:] = data
+            _check(self._execute_internal(shared_memory.attach_cmd(name, path, descriptor)), f"put {name}")
+        finally:
+            shared_memory.remove(path)
+
+    def share(self, name: str, shape: Sequence[int], dtype="float64") -> np.ndarray:
+        """在共享内存中分配数组并绑定到会话中的变量name, 返回的数组与会话中的变量是同一块内存, 双方的修改互相可见"""
+        descriptor = {"descr": dtype_to_descr(np.dtype(dtype)), "shape": tuple(shape)}
+        path, shared = shared_memory.allocate(descriptor)
+        try:
+            _check(self._execute_internal(shared_memory.attach_cmd(name, path, descriptor)), f"share {name}")
+        finally:
+            shared_memory.remove(path)
+        return shared
+
+    def get(self, name: str) -> shared_memory.SharedValue:
+        """经由共享内存取回会话中的numpy数组或字节缓冲区, 会话端复制一次到共享内存, 宿主进程端直接映射"""
+        path = shared_memory.shm_path()
+        try:
+            record = _check(self._execute_internal(shared_memory.export_cmd(name, path)), f"get {name}")
+            return shared_memory.map_shared(path, ast.literal_eval(record["stdout"]))
+        finally:
+            shared_memory.remove(path)
+
+    def dependency_graph(self) -> DependencyGraph:
+        """由cmd_space构造cell之间的依赖图"""
+        return DependencyGraph.from_history(self._cmd_space)
+
+    def rerun(self, cmd_id: str, cmds: Union[str, List[str]] = None, max_workers: int = 1) -> List[dict]:
+        """重新执行cell cmd_id(cmds不为None时先把其代码替换为cmds), 以及依赖图中受其影响的cell, 其余cell不会执行
+
+        返回新的cmd_space记录, 其rerun_of字段为所重新执行的cell; 某个cell执行出错时不再执行之后的cell.
+        """
+        graph = self.dependency_graph()
+        affected = graph.affected(cmd_id)
+        if cmds is not None:
+            graph = graph.with_source(cmd_id, cmds if isinstance(cmds, str) else " ".join(cmds))
+            affected = graph.order(affected + graph.affected(cmd_id))
+        return self._replay(graph, affected, max_workers)
+
+    def replay(self, cmd_ids: Iterable[str] = None, max_workers: int = 1) -> List[dict]:
+        """按依赖顺序在当前会话中重新执行cell(默认为全部cell), 如重启后没有快照时重建全局作用域
+
+        max_workers大于1时, 依赖图同一层中互不冲突的cell在fork出的会话中并行执行, 之后把它们写入的变量合并回当前会话.
+        """
+        graph = self.dependency_graph()
+        return self._replay(graph, graph.order(graph.cells if cmd_ids is None else cmd_ids), max_workers)
+
+    def _replay(self, graph: DependencyGraph, cmd_ids: List[str], max_workers: int) -> List[dict]:
+        batches = _replay_batches(graph, cmd_ids, max_workers)
+        if any(len(batch) > 1 for batch in batches):
+            _check(self._execute_internal(PARALLEL_WORKER_CODE), "replay")
+        records = []
+        for batch in batches:
+            if len(batch) == 1:
+                record = self.submit(graph.cells[batch[0]].source.rstrip("\n")).result()
+                record["rerun_of"] = batch[0]
+                records.append(record)
+            else:
+                records.extend(self._replay_forked(graph, batch))
+            failed = [record["rerun_of"] for record in records[-len(batch) :] if record["status"]]
+            if failed:
+                logger.warning(f"Replay stopped at cell {', '.join(failed)}.")
+                break
+        return records
+
+    def _replay_forked(self, graph: DependencyGraph, batch: List[str]) -> List[dict]:
+        """在fork出的会话中并行执行互不冲突的cell, 再按顺序把各cell写入的变量合并回当前会话"""
+        branches, records = [], []
+        try:
+            for _ in batch:
+                branches.append(self.fork())
+            futures = [branch.submit(graph.cells[c].source.rstrip("\n")) for branch, c in zip(branches, batch)]
+            for branch, cmd_id, future in zip(branches, batch, futures):
+                record = future.result()
+                names = sorted(graph.writes(cmd_id))
+                if names and not record["status"]:
+                    path = shared_memory.shm_path()
+                    try:
+                        export_cmd = f"__cx_export_values__({names!r}, {path!r})"
+                        _check(branch._execute_internal(export_cmd), f"export cell {cmd_id}")
+                        merge_cmd = f"__cx_merge_values__({path!r}, {names!r})"
+                        _check(self._execute_internal(merge_cmd), f"merge cell {cmd_id}")
+                    finally:
+                        shared_memory.remove(path)
+                records.append(self._append_record(_replayed(record, cmd_id)))
+        finally:
+            for branch in branches:
+                branch.stop_process()
+        return records
 
 
 class AsyncPyExecutor(AsyncCodeExecutor):
-    def __init__(self, work_dir: str = None, is_save_obj: bool = False, **kwargs):
+    def __init__(
+        self,
+        work_dir: str = None,
+        is_save_obj: bool = False,
+        use_fork_server: bool = False,
+        init_profile: str = None,
+        **kwargs,
+    ):
+        # init_profile为None时使用PyExeConfig默认的profile, 见constant.INIT_PROFILES
+        config = PyExeConfig if init_profile is None else PyExeConfig.with_profile(init_profile)
         super().__init__(
-            PyExeConfig.session_command,
-            PyExeConfig.print_cmd,
+            config.session_command,
+            config.print_cmd,
             work_dir=work_dir,
             is_save_obj=is_save_obj,
-            save_obj_cmd=PyExeConfig.save_obj_cmd,
-            load_obj_cmd=PyExeConfig.load_obj_cmd,
+            save_obj_cmd=config.save_obj_cmd,
+            load_obj_cmd=config.load_obj_cmd,
+            use_fork_server=use_fork_server,
+            exec_cmd=config.exec_cmd,
+            bg_save_obj_cmd=config.bg_save_obj_cmd,
+            flush_obj_cmd=config.flush_obj_cmd,
+            fork_cmd=config.fork_cmd,
+            **{k: v for k, v in kwargs.items() if k not in _CONFIG_KWARGS},
         )
+        self.init_profile = init_profile
+        self._startup_trace = None  # 最近一次startup_trace()的结果, 随Executor一起保存
+
+    async def startup_trace(self) -> dict:
+        """会话init_code中每个模块的导入耗时([模块名, 不含子模块的秒数, 含子模块的秒数]), 总耗时init_seconds,
+        以及延迟导入的模块第一次被使用时的导入耗时lazy
+
+        由fork server派生或fork()得到的会话继承了执行init_code的进程的记录, 此时inherited为True.
+        """
+        record = _check(await self._execute_internal("__cx_dump_startup_trace__()"), "startup trace")
+        self._startup_trace = json.loads(record["stdout"])
+        return self._startup_trace
+
+    async def put(self, name: str, value: shared_memory.SharedValue):
+        """经由共享内存把numpy数组或字节缓冲区赋值给会话中的变量name, 管道中只传递描述符, 不做序列化
+
+        数据只在宿主进程中复制一次到共享内存, 会话直接映射这块内存; 字节缓冲区在会话中为memoryview.
+        """
+        descriptor, data = shared_memory.describe(value)
+        path, shared = shared_memory.allocate(descriptor)
+        try:
+            shared_memory.describe(shared)[1][:] = data
+            _check(await self._execute_internal(shared_memory.attach_cmd(name, path, descriptor)), f"put {name}")
+        finally:
+            shared_memory.remove(path)
+
+    async def share(self, name: str, shape: Sequence[int], dtype="float64") -> np.ndarray:
+        """在共享内存中分配数组并绑定到会话中的变量name, 返回的数组与会话中的变量是同一块内存, 双方的修改互相可见"""
+        descriptor = {"descr": dtype_to_descr(np.dtype(dtype)), "shape": tuple(shape)}
+        path, shared = shared_memory.allocate(descriptor)
+        try:
+            _check(await self._execute_internal(shared_memory.attach_cmd(name, path, descriptor)), f"share {name}")
+        finally:
+            shared_memory.remove(path)
+        return shared
+
+    async def get(self, name: str) -> shared_memory.SharedValue:
+        """经由共享内存取回会话中的numpy数组或字节缓冲区, 会话端复制一次到共享内存, 宿主进程端直接映射"""
+        path = shared_memory.shm_path()
+        try:
+            record = _check(await self._execute_internal(shared_memory.export_cmd(name, path)), f"get {name}")
+            return shared_memory.map_shared(path, ast.literal_eval(record["stdout"]))
+        finally:
+            shared_memory.remove(path)
+
+    def dependency_graph(self) -> DependencyGraph:
+        """由cmd_space构造cell之间的依赖图"""
+        return DependencyGraph.from_history(self._cmd_space)
+
+    async def rerun(self, cmd_id: str, cmds: Union[str, List[str]] = None, max_workers: int = 1) -> List[dict]:
+        """重新执行cell cmd_id(cmds不为None时先把其代码替换为cmds), 以及依赖图中受其影响的cell, 其余cell不会执行
+
+        返回新的cmd_space记录, 其rerun_of字段为所重新执行的cell; 某个cell执行出错时不再执行之后的cell.
+        """
+        graph = self.dependency_graph()
+        affected = graph.affected(cmd_id)
+        if cmds is not None:
+            graph = graph.with_source(cmd_id, cmds if isinstance(cmds, str) else " ".join(cmds))
+            affected = graph.order(affected + graph.affected(cmd_id))
+        return await self._replay(graph, affected, max_workers)
+
+    async def replay(self, cmd_ids: Iterable[str] = None, max_workers: int = 1) -> List[dict]:
+        """按依赖顺序在当前会话中重新执行cell(默认为全部cell), 如重启后没有快照时重建全局作用域
+
+        max_workers大于1时, 依赖图同一层中互不冲突的cell在fork出的会话中并行执行, 之后把它们写入的变量合并回当前会话.
+        """
+        graph = self.dependency_graph()
+        return await self._replay(graph, graph.order(graph.cells if cmd_ids is None else cmd_ids), max_workers)
+
+    async def _replay(self, graph: DependencyGraph, cmd_ids: List[str], max_workers: int) -> List[dict]:
+        batches = _replay_batches(graph, cmd_ids, max_workers)
+        if any(len(batch) > 1 for batch in batches):
+            _check(await self._execute_internal(PARALLEL_WORKER_CODE), "replay")
+        records = []
+        for batch in batches:
+            if len(batch) == 1:
+                record = await (await self.submit(graph.cells[batch[0]].source.rstrip("\n")))
+                record["rerun_of"] = batch[0]
+                records.append(record)
+            else:
+                records.extend(await self._replay_forked(graph, batch))
+            failed = [record["rerun_of"] for record in records[-len(batch) :] if record["status"]]
+            if failed:
+                logger.warning(f"Replay stopped at cell {', '.join(failed)}.")
+                break
+        return records
+
+    async def _replay_forked(self, graph: DependencyGraph, batch: List[str]) -> List[dict]:
+        """在fork出的会话中并行执行互不冲突的cell, 再按顺序把各cell写入的变量合并回当前会话"""
+        branches, records = [], []
+        try:
+            for _ in batch:
+                branches.append(await self.fork())
+            futures = [await branch.submit(graph.cells[c].source.rstrip("\n")) for branch, c in zip(branches, batch)]
+            for branch, cmd_id, future in zip(branches, batch, futures):
+                record = await future
+                names = sorted(graph.writes(cmd_id))
+                if names and not record["status"]:
+                    path = shared_memory.shm_path()
+                    try:
+                        export_cmd = f"__cx_export_values__({names!r}, {path!r})"
+                        _check(await branch._execute_internal(export_cmd), f"export cell {cmd_id}")
+                        merge_cmd = f"__cx_merge_values__({path!r}, {names!r})"
+                        _check(await self._execute_internal(merge_cmd), f"merge cell {cmd_id}")
+                    finally:
+                        shared_memory.remove(path)
+                records.append(await self._append_record(_replayed(record, cmd_id)))
+        finally:
+            for branch in branches:
+                await branch.stop_process()
+        return records
+
+
+class InProcessPyExecutor(InProcessExecutor):
+    """在宿主进程内执行的PyExecutor, 没有进程隔离, 只用于可信代码"""
+
+    def __init__(self, work_dir: str = None, is_save_obj: bool = False, init_profile: str = None, **kwargs):
+        config = PyExeConfig.with_backend("inprocess")
+        config = config if init_profile is None else config.with_profile(init_profile)
+        super().__init__(
+            config.inprocess_code,
+            work_dir=work_dir,
+            is_save_obj=is_save_obj,
+            save_obj_cmd=config.save_obj_cmd,
+            load_obj_cmd=config.load_obj_cmd,
+            **{k: v for k, v in kwargs.items() if k != "init_code"},
+        )
+        self.init_profile = init_profile
+
+
+def create_py_executor(work_dir: str = None, is_save_obj: bool = False, config: ExeConfig = PyExeConfig, **kwargs):
+    """按config.backend创建Python执行器, config由PyExeConfig.with_profile()/with_backend()得到"""
+    executor = InProcessPyExecutor if config.backend == "inprocess" else PyExecutor
+    return executor(work_dir, is_save_obj, init_profile=config.init_profile, **kwargs)
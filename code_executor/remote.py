@@ -0,0 +1,408 @@
+"""远程执行: WorkerDaemon在本机托管会话, RemoteExecutor通过TCP或Unix socket使用远程会话
+
+消息格式为一行JSON头, 其后紧跟头中size字段指定长度的二进制负载(如打包后的work_dir).
+WorkerDaemon设置了token时, 每条消息的头中需带有相同的token; 未设置token时只允许监听回环地址或Unix socket.
+"""
+
+import io
+import os
+import re
+import hmac
+import json
+import uuid
+import fire
+import socket
+import pprint
+import asyncio
+import tarfile
+import ipaddress
+import threading
+from pathlib import Path
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from loguru import logger
+
+from code_executor.async_executor import AsyncCodeExecutor
+from code_executor.history import CommandHistory
+from code_executor.pyexe import AsyncPyExecutor
+
+Address = Union[str, Tuple[str, int]]  # "host:port", (host, port) 或 Unix socket路径
+
+
+def encode_message(header: dict, payload: bytes = b"") -> bytes:
+    return json.dumps({**header, "size": len(payload)}, ensure_ascii=False).encode() + b"\n" + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[Tuple[dict, bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    header = json.loads(line)
+    return header, await reader.readexactly(header.pop("size", 0))
+
+
+def recv_message(file: io.BufferedReader) -> Optional[Tuple[dict, bytes]]:
+    line = file.readline()
+    if not line:
+        return None
+    header = json.loads(line)
+    size = header.pop("size", 0)
+    payload = file.read(size)
+    if len(payload) < size:
+        raise ConnectionError("connection closed while receiving payload")
+    return header, payload
+
+
+def connect(address: Address) -> socket.socket:
+    """连接WorkerDaemon, 以/开头的字符串视为Unix socket路径"""
+    if isinstance(address, str) and address.startswith("/"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+    if isinstance(address, str):
+        host, port = address.rsplit(":", 1)
+        address = (host, int(port))
+    sock = socket.create_connection(tuple(address))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def pack_dir(path: str) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        tar.add(path, arcname=".")
+    return buffer.getvalue()
+
+
+def unpack_dir(data: bytes, path: str):
+    Path(path).mkdir(parents=True, exist_ok=True)
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+        tar.extractall(path, filter="data")
+
+
+class WorkerDaemon(object):
+    """在本机托管AsyncCodeExecutor会话, 通过TCP或Unix socket对外提供服务
+
+    每个会话的work_dir为root/<会话名>, 会话属于打开它的连接, 连接断开时会话被停止(is_save_obj时会保存).
+    收到的命令会在会话中直接执行, 监听非回环地址时必须设置token, token不符的连接在回复错误后被断开.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        unix_path: str = None,
+        factory: Callable[..., AsyncCodeExecutor] = AsyncPyExecutor,
+        max_sessions: int = None,
+        token: str = None,
+    ):
+        assert token or unix_path or is_loopback(host), f"token is required when listening on {host}!"
+        self.root = root
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.factory = factory
+        self.max_sessions = max_sessions or os.cpu_count()
+        self.token = token
+        self.address: Optional[str] = None
+        self.__sessions: Dict[str, AsyncCodeExecutor] = {}
+        self.__server = None
+        self.__loop = None
+        self.__thread = None
+
+    async def start(self) -> str:
+        Path(self.root).mkdir(parents=True, exist_ok=True)
+        if self.unix_path:
+            self.__server = await asyncio.start_unix_server(self._handle, path=self.unix_path)
+            self.address = self.unix_path
+        else:
+            self.__server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.address = f"{self.host}:{self.__server.sockets[0].getsockname()[1]}"
+        logger.info(f"Worker daemon listening on {self.address}")
+        return self.address
+
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+        for name in list(self.__sessions):
+            await self._close_session(name)
+
+    def start_in_thread(self) -> str:
+        """在后台线程的事件循环中运行, 返回监听地址"""
+        started = Future()
+
+        def serve():
+            self.__loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.__loop)
+            try:
+                started.set_result(self.__loop.run_until_complete(self.start()))
+            except Exception as e:
+                started.set_exception(e)
+                return
+            self.__loop.run_forever()
+
+        self.__thread = threading.Thread(target=serve, name="code-executor-worker-daemon", daemon=True)
+        self.__thread.start()
+        return started.result()
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.close(), self.__loop).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+
+    def stats(self) -> dict:
+        return {
+            "address": self.address,
+            "sessions": len(self.__sessions),
+            "max_sessions": self.max_sessions,
+            "load": os.getloadavg()[0],
+        }
+
+    def _work_dir(self, name: str) -> str:
+        assert re.fullmatch(r"[\w-]+", name), f"invalid session name: {name}"
+        return str(Path(self.root) / name)
+
+    async def _close_session(self, name: str):
+        executor = self.__sessions.pop(name, None)
+        if executor is not None:
+            await executor.stop_process()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        owned: List[str] = []  # 本连接打开的会话
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                header, payload = message
+                if not self._authenticate(header):
+                    logger.warning(f"Rejected unauthenticated request {header.get('op')}")
+                    writer.write(encode_message({"ok": False, "error": "PermissionError: invalid token"}))
+                    await writer.drain()
+                    break
+                try:
+                    response, data = await self._dispatch(header, payload, owned)
+                    response = {"ok": True, **response}
+                except Exception as e:
+                    logger.warning(f"Request {header.get('op')} failed: {e}")
+                    response, data = {"ok": False, "error": f"{type(e).__name__}: {e}"}, b""
+                writer.write(encode_message(response, data))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for name in owned:
+                await self._close_session(name)
+            writer.close()
+
+    def _authenticate(self, header: dict) -> bool:
+        token = str(header.pop("token", ""))
+        return self.token is None or hmac.compare_digest(token.encode(), self.token.encode())
+
+    async def _dispatch(self, header: dict, payload: bytes, owned: List[str]) -> Tuple[dict, bytes]:
+        op, name = header["op"], header.get("name")
+        if op == "stats":
+            return self.stats(), b""
+
+        if op == "open":
+            assert name not in self.__sessions, f"session {name} already exists!"
+            assert len(self.__sessions) < self.max_sessions, "worker daemon is full!"
+            is_save_obj = header.get("is_save_obj", False)
+            work_dir = self._work_dir(name) if is_save_obj or header.get("load") else None
+            executor = self.factory(work_dir, is_save_obj, **header.get("kwargs", {}))
+            if header.get("load"):
+                executor = executor.load()
+            self.__sessions[name] = executor
+            owned.append(name)
+            await executor.warm_up()
+            return {"history": [dict(record) for record in executor._cmd_space.values()]}, b""
+
+        executor = self.__sessions.get(name)
+        if op == "import":
+            assert executor is None, f"session {name} is running!"
+            unpack_dir(payload, self._work_dir(name))
+            return {}, b""
+
+        assert executor is not None, f"session {name} does not exist!"
+        if op == "run":
+            record = await executor._run(header["cmds"])
+            return {"cmd_id": str(len(executor._cmd_space) - 1), "record": dict(record)}, b""
+        if op == "export":
+            assert executor.is_save_obj, "only sessions with is_save_obj can be exported!"
+            await executor.flush_checkpoints()
+            executor.save_executor()
+            return {}, pack_dir(executor.work_dir)
+        if op == "close":
+            await self._close_session(name)
+            owned.remove(name)
+            return {}, b""
+        raise ValueError(f"unknown op: {op}")
+
+
+class RemoteExecutor(object):
+    """WorkerDaemon上的一个会话, run()生成器接口与SyncCodeExecutor一致"""
+
+    def __init__(self, address: Address, name: str = None, is_save_obj: bool = False, token: str = None, **kwargs):
+        self.address = address
+        self.name = name or uuid.uuid4().hex
+        self.is_save_obj = is_save_obj
+        self.token = token  # 与WorkerDaemon的token一致
+        self.kwargs = kwargs  # 创建远程会话时传给WorkerDaemon.factory的参数, 需要可以JSON序列化
+        self._cmd_space = CommandHistory()
+        self.__sock = None
+        self.__file = None
+        self.__lock = threading.Lock()
+
+    def _request(self, header: dict, payload: bytes = b"") -> Tuple[dict, bytes]:
+        with self.__lock:
+            if self.__sock is None:
+                self.__sock = connect(self.address)
+                self.__file = self.__sock.makefile("rb")
+            self.__sock.sendall(encode_message({**header, "name": self.name, "token": self.token}, payload))
+            message = recv_message(self.__file)
+        if message is None:
+            self._disconnect()
+            raise ConnectionError(f"worker daemon {self.address} closed the connection")
+        response, data = message
+        if not response.pop("ok"):
+            raise RuntimeError(response["error"])
+        return response, data
+
+    def _disconnect(self):
+        if self.__sock is not None:
+            self.__file.close()
+            self.__sock.close()
+        self.__sock = self.__file = None
+
+    def start_process(self, load: bool = False):
+        """在远程创建会话, load为True时从WorkerDaemon上的work_dir恢复"""
+        header = {"op": "open", "is_save_obj": self.is_save_obj, "kwargs": self.kwargs, "load": load}
+        response, _ = self._request(header)
+        self._cmd_space = CommandHistory.from_records({str(i): r for i, r in enumerate(response["history"])})
+
+    def is_alive(self) -> bool:
+        return self.__sock is not None
+
+    def export_snapshot(self) -> bytes:
+        """打包远程会话的work_dir(快照, 历史和Executor状态)"""
+        return self._request({"op": "export"})[1]
+
+    def migrate(self, address: Address) -> "RemoteExecutor":
+        """把会话连同快照迁移到另一个WorkerDaemon, 返回新的RemoteExecutor, 当前会话被停止"""
+        data = self.export_snapshot()
+        self.stop_process()
+        target = RemoteExecutor(address, self.name, self.is_save_obj, self.token, **self.kwargs)
+        target._request({"op": "import"}, data)
+        target.start_process(load=True)
+        return target
+
+    def stop_process(self):
+        if self.__sock is not None:
+            try:
+                self._request({"op": "close"})
+            finally:
+                self._disconnect()
+        logger.info(f"Remote session {self.name} terminate successfully!")
+
+    def _run(self, cmds):
+        if self.__sock is None:
+            self.start_process()
+        response, _ = self._request({"op": "run", "cmds": [cmds] if isinstance(cmds, str) else cmds})
+        self._cmd_space[response["cmd_id"]] = response["record"]
+        return self._cmd_space[response["cmd_id"]]
+
+    def print_cmd_space(self):
+        pprint.pprint(self._cmd_space.to_dict())
+
+    def run(self):
+        while True:
+            # 从外部获取命令（通过yield）
+            cmds = yield
+            if cmds is None:
+                continue
+
+            if isinstance(cmds, str):
+                cmds = [cmds]
+
+            try:
+                self._run(cmds)
+            except Exception as e:
+                logger.error(e)
+                break
+
+
+class Scheduler(object):
+    """在多个WorkerDaemon之间放置会话, 新会话总是放到负载最低的worker上"""
+
+    def __init__(self, addresses: List[Address], token: str = None):
+        assert addresses, "addresses should not be empty!"
+        self.addresses = list(addresses)
+        self.token = token
+
+    def query(self, address: Address) -> dict:
+        with connect(address) as sock, sock.makefile("rb") as file:
+            sock.sendall(encode_message({"op": "stats", "token": self.token}))
+            response, _ = recv_message(file)
+        if not response.pop("ok"):
+            raise RuntimeError(response["error"])
+        return response
+
+    def stats(self) -> Dict[str, dict]:
+        """各个可连接的worker的负载, 无法连接的worker会被跳过"""
+        stats = {}
+        for address in self.addresses:
+            try:
+                stats[str(address)] = {**self.query(address), "address": address}
+            except OSError as e:
+                logger.warning(f"Worker daemon {address} is unreachable: {e}")
+        return stats
+
+    def least_loaded(self) -> Address:
+        candidates = [s for s in self.stats().values() if s["sessions"] < s["max_sessions"]]
+        assert candidates, "no worker daemon is available!"
+        best = min(candidates, key=lambda s: (s["sessions"] / s["max_sessions"], s["load"]))
+        return best["address"]
+
+    def open(self, name: str = None, is_save_obj: bool = False, **kwargs) -> RemoteExecutor:
+        """在负载最低的worker上创建会话"""
+        executor = RemoteExecutor(self.least_loaded(), name, is_save_obj, self.token, **kwargs)
+        executor.start_process()
+        return executor
+
+
+def serve(
+    root: str,
+    host: str = "127.0.0.1",
+    port: int = 0,
+    unix_path: str = None,
+    max_sessions: int = None,
+    token: str = None,
+):
+    """命令行启动WorkerDaemon: python -m code_executor.remote --root ./worker --port 8765
+
+    token默认读取环境变量CODE_EXECUTOR_TOKEN, 以免出现在进程的命令行参数中.
+    """
+    token = token or os.environ.get("CODE_EXECUTOR_TOKEN")
+
+    async def main():
+        daemon = WorkerDaemon(root, host, port, unix_path, max_sessions=max_sessions, token=token)
+        print(await daemon.start(), flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await daemon.close()
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    fire.Fire(serve)
@@ -0,0 +1,76 @@
+import os
+import mmap
+import uuid
+import tempfile
+from typing import Optional, Tuple, Union
+import numpy as np
+from numpy.lib.format import descr_to_dtype, dtype_to_descr
+
+# 共享内存文件所在目录, Linux上/dev/shm为内存文件系统
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+SharedValue = Union[np.ndarray, memoryview]
+
+
+def shm_path() -> str:
+    return os.path.join(SHM_DIR, f"code_executor_{os.getpid()}_{uuid.uuid4().hex}")
+
+
+def describe(value) -> Tuple[dict, memoryview]:
+    """返回值的描述符(dtype描述和shape, 字节缓冲区的descr为None)及其连续的字节视图"""
+    if isinstance(value, np.ndarray):
+        assert not value.dtype.hasobject, "object arrays cannot be shared, use a snapshot instead!"
+        value = np.ascontiguousarray(value)
+        data = memoryview(value.reshape(-1).view(np.uint8))
+        return {"descr": dtype_to_descr(value.dtype), "shape": value.shape}, data
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        data = memoryview(value).cast("B")
+        return {"descr": None, "shape": (data.nbytes,)}, data
+    raise TypeError(f"put only supports numpy arrays and bytes-like objects, got {type(value).__name__}!")
+
+
+def nbytes(descriptor: dict) -> int:
+    if descriptor["descr"] is None:
+        return descriptor["shape"][0]
+    return int(np.prod(descriptor["shape"])) * descr_to_dtype(descriptor["descr"]).itemsize
+
+
+def map_shared(path: str, descriptor: dict) -> SharedValue:
+    """把共享内存文件映射为ndarray或memoryview, 不复制数据; 映射在值被回收前一直有效, 文件本身可以随后删除"""
+    size = nbytes(descriptor)
+    if size == 0:
+        buffer: Optional[mmap.mmap] = None
+    else:
+        with open(path, "r+b") as f:
+            buffer = mmap.mmap(f.fileno(), size)
+    if descriptor["descr"] is None:
+        return memoryview(buffer) if buffer is not None else memoryview(bytearray())
+    dtype = descr_to_dtype(descriptor["descr"])
+    if buffer is None:
+        return np.empty(descriptor["shape"], dtype)
+    return np.frombuffer(buffer, dtype).reshape(descriptor["shape"])
+
+
+def allocate(descriptor: dict) -> Tuple[str, SharedValue]:
+    """创建能容纳descriptor所描述的值的共享内存文件, 返回文件路径和其映射"""
+    path = shm_path()
+    with open(path, "wb") as f:
+        f.truncate(nbytes(descriptor))
+    return path, map_shared(path, descriptor)
+
+
+def attach_cmd(name: str, path: str, descriptor: dict) -> str:
+    assert name.isidentifier(), f"{name!r} is not a valid variable name!"
+    return f"__cx_shm_attach__({name!r}, {path!r}, {descriptor!r})\n"
+
+
+def export_cmd(name: str, path: str) -> str:
+    assert name.isidentifier(), f"{name!r} is not a valid variable name!"
+    return f"__cx_shm_export__({name!r}, {path!r})\n"
+
+
+def remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,26 @@
+import json
+from code_executor.benchmark import compare, run_benchmarks
+
+
+def test_quick_benchmarks():
+    results = run_benchmarks(quick=True, snapshot_sizes_mb=(1,), scaling_sessions=(2,))
+    json.dumps(results)
+    assert results["meta"]["params"]["snapshot_sizes_mb"] == (1,)
+    assert set(results["results"]) == {"startup", "latency", "output", "snapshot", "scaling"}
+    # 只检查结果的结构, 耗时之间的大小关系受机器负载影响, 由compare()对照基线检查
+    startup = results["results"]["startup"]
+    for key in ("cold_median_seconds", "warm_median_seconds", "cold_data_science_lazy_median_seconds"):
+        assert startup[key] > 0
+    assert {"init_code_seconds", "import_pandas_seconds"} <= set(startup)
+    latency = results["results"]["latency"]
+    assert latency["round_trip_median_seconds"] > 0 and latency["inprocess_round_trip_median_seconds"] > 0
+    assert results["results"]["snapshot"]["1mb_snapshot_bytes"] >= 1 << 20
+    assert results["results"]["scaling"]["async_2_sessions_cmds_per_second"] > 0
+
+
+def test_compare_regressions(tmp_path):
+    baseline = {"results": {"latency": {"round_trip_median_seconds": 1.0, "pipelined_cmds_per_second": 100}}}
+    current = {"results": {"latency": {"round_trip_median_seconds": 1.1, "pipelined_cmds_per_second": 50}}}
+    assert compare(baseline, current) == ["latency.pipelined_cmds_per_second: 100 -> 50"]
+    assert len(compare(baseline, current, tolerance=0.05)) == 2
+    assert compare(baseline, {"results": {"new": {"x_seconds": 1.0}}}) == []
@@ -0,0 +1,78 @@
+import json
+import pytest
+from code_executor.pyexe import AsyncPyExecutor, PyExecutor
+
+
+def test_cell_cache_hit_and_invalidation(tmp_path):
+    pyer = PyExecutor(str(tmp_path), echo=False, cell_cache=True)
+    pyer._run("a = 2\ndef scale(x):\n    return x * a\n")
+    code = "import os; b = np.arange(scale(3)); print(b.sum())"
+    results = [pyer._run(code) for _ in range(2)]
+    assert [r["metrics"]["cell_cache"] for r in results] == ["miss", "hit"]
+    assert results[1]["stdout"] == "15"
+
+    pyer._run("del b, os")
+    assert pyer._run(code)["metrics"]["cell_cache"] == "hit"
+    assert pyer._run("print(b.tolist(), os.sep)")["stdout"] == "[0, 1, 2, 3, 4, 5] /"
+
+    pyer._run("a = 3")  # 经由函数scale读取的全局变量变化
+    assert pyer._run(code)["stdout"] == "36"
+    pyer._run("b += 1")
+    assert pyer._run("b += 1")["metrics"]["cell_cache"] == "miss"
+    assert pyer._run("print(b[0])")["stdout"] == "2"
+    assert pyer._run("1 / 0")["metrics"]["cell_cache"] == "miss"
+    assert pyer._run("1 / 0")["status"] == 1
+    pyer.stop_process()
+
+    pyer = PyExecutor(str(tmp_path), echo=False, cell_cache=True)  # 缓存持久化在work_dir中
+    pyer._run("a = 2\ndef scale(x):\n    return x * a\n")
+    record = pyer._run(code)
+    assert record["metrics"]["cell_cache"] == "hit" and record["stdout"] == "15"
+    pyer.stop_process()
+
+
+def test_cell_cache_lru_eviction(tmp_path):
+    pyer = PyExecutor(str(tmp_path), echo=False, cell_cache=True, cell_cache_size=2000)  # 约可容纳2个数组
+    pyer._run("x0 = np.full(100, 0)")
+    pyer._run("x1 = np.full(100, 1)")
+    assert pyer._run("x0 = np.full(100, 0)")["metrics"]["cell_cache"] == "hit"
+    pyer._run("x2 = np.full(100, 2)")  # 淘汰最久未使用的x1
+    pyer._run("y = np.zeros(1000)")  # 超过缓存大小, 不会被缓存
+    pyer.stop_process()
+
+    with open(tmp_path / "cell_cache" / "index.json") as f:
+        entries = dict(json.load(f))
+    assert sorted(n for e in entries.values() for n in e["outputs"]) == ["x0", "x2"]
+    objects = [p.name for p in (tmp_path / "cell_cache" / "objects").glob("*/*")]
+    assert sorted(objects) == sorted(k for e in entries.values() for k in e["objects"])
+
+
+@pytest.mark.asyncio
+async def test_async_cell_cache(tmp_path):
+    pyer = AsyncPyExecutor(str(tmp_path), echo=False, cell_cache=True)
+    records = [await pyer._run("import time; time.sleep(0.2); print('done')") for _ in range(2)]
+    assert [r["metrics"]["cell_cache"] for r in records] == ["miss", "hit"]
+    assert records[1]["stdout"] == "done" and records[1]["metrics"]["wall_time"] < 0.1
+    await pyer.stop_process()
+
+
+def test_cell_cache_method_globals_and_hidden_state(tmp_path):
+    pyer = PyExecutor(str(tmp_path), echo=False, cell_cache=True)
+    pyer._run("a = 2\nclass C:\n    def f(self):\n        return a\nc = C()")
+    assert pyer._run("print(c.f())")["stdout"] == "2"
+    pyer._run("a = 3")  # 经由实例的方法读取的全局变量变化
+    record = pyer._run("print(c.f())")
+    assert record["metrics"]["cell_cache"] == "miss" and record["stdout"] == "3"
+
+    # 直接调用随机数或时钟的cell不会被缓存
+    records = [pyer._run("import random; print(random.random())") for _ in range(2)]
+    assert [r["metrics"]["cell_cache"] for r in records] == ["skip", "skip"]
+    assert records[0]["stdout"] != records[1]["stdout"]
+    pyer._run("from time import time as now")
+    assert pyer._run("t = now()")["metrics"]["cell_cache"] == "skip"
+    # 间接依赖隐藏状态时以注释跳过缓存
+    pyer._run("def draw():\n    return np.random.rand()")
+    records = [pyer._run("print(draw())  # cx: nocache") for _ in range(2)]
+    assert [r["metrics"]["cell_cache"] for r in records] == ["skip", "skip"]
+    assert pyer._run("x = np.arange(3).sum()")["metrics"]["cell_cache"] == "miss"
+    pyer.stop_process()
@@ -0,0 +1,93 @@
+import asyncio
+from code_executor.dependency import DependencyGraph, analyze
+from code_executor.pyexe import AsyncPyExecutor, PyExecutor
+
+
+def test_cell_defs_and_uses():
+    assert analyze("0", "x = x + 1")[2:4] == ({"x"}, {"x"})
+    assert analyze("0", "y[0] = z")[2:4] == ({"y"}, {"y", "z"})
+    assert analyze("0", "import numpy as np, os.path")[2:4] == ({"np", "os"}, set())
+    assert analyze("0", "total = 0\nfor i in items: total += i")[2:4] == ({"total", "i"}, {"items"})
+    cell = analyze("0", "def f(n):\n    return n + offset\n")
+    assert cell.defs == {"f"} and cell.uses == set() and cell.lazy == {"f": {"offset"}}
+    assert analyze("0", "exec('a = 1')").defs is None
+    assert analyze("0", "%timeit 1").uses is None
+    assert analyze("0", "lst.append(x)\nnp.arange(3)\nf(y)").mutates == {"lst", "np"}
+
+
+def test_graph_affected_and_levels():
+    sources = ["a = 1", "b = a + 1", "c = 10", "d = b * 2", "def f(): return c", "e = f()", "a = 3", "g = a"]
+    graph = DependencyGraph(analyze(str(i), source) for i, source in enumerate(sources))
+    assert graph.uses("5") == {"f", "c"} and graph.parents("5") == ["2", "4"]
+    assert graph.children("0") == ["1"]
+    # 重新执行0后, 6需要再次写入a; 7读取的a来自6
+    assert graph.affected("0") == ["0", "1", "3", "6", "7"]
+    assert graph.affected("2") == ["2", "5"]
+    # 1读取的a此时已被6覆盖, 需要先重新执行0
+    assert graph.affected("1") == ["0", "1", "3", "6", "7"]
+    # 6覆盖的a仍被1读取, 只能在1之后执行
+    assert graph.levels(graph.cells) == [["0", "2", "4"], ["1", "5"], ["3", "6"], ["7"]]
+
+
+def test_rerun_only_affected_cells():
+    pyer = PyExecutor(echo=False)
+    for code in ["a = 1", "b = a + 1", "import time; c = time.time()", "d = b * 2"]:
+        pyer._run(code)
+    c = pyer._run("print(c)")["stdout"]
+
+    records = pyer.rerun("0", "a = 5")
+    assert [record["rerun_of"] for record in records] == ["0", "1", "3"]
+    assert pyer._run("print(a, b, d)")["stdout"] == "5 6 12"
+    assert pyer._run("print(c)")["stdout"] == c
+    assert pyer.dependency_graph().cells["0"].source.strip() == "a = 5"
+    assert pyer.rerun("4")[0]["stdout"] == c
+    pyer.stop_process()
+
+
+def test_parallel_replay(tmp_path):
+    pyer = PyExecutor(str(tmp_path), True, echo=False)
+    for code in ["x = sum(range(10))", "y = [1, 2]; print('y')", "z = x + len(y)"]:
+        pyer._run(code)
+    pyer._run("del x, y, z")
+
+    records = pyer.replay(["0", "1", "2"], max_workers=2)
+    assert [record["rerun_of"] for record in records] == ["0", "1", "2"]
+    assert records[1]["stdout"] == "y" and all(record["status"] == 0 for record in records)
+    assert pyer._run("print(x, y, z)")["stdout"] == "45 [1, 2] 47"
+    pyer.stop_process()
+    # 合并后的记录同样有快照
+    pyer = PyExecutor(str(tmp_path), True, echo=False).load()
+    assert pyer._run("print(z)")["stdout"] == "47"
+    pyer.stop_process()
+
+
+def test_parallel_replay_keeps_inplace_mutation():
+    sources = ["lst = []", "lst.append(1)", "n = len(lst)", "import numpy as np; a = np.arange(3)"]
+    graph = DependencyGraph(analyze(str(i), source) for i, source in enumerate(sources))
+    # 方法调用视为可能修改接收者, 只有被cell写入过的名字计入
+    assert graph.writes("1") == {"lst"} and graph.writes("3") == {"np", "a"}
+    assert graph.levels(graph.cells) == [["0", "3"], ["1"], ["2"]]
+
+    pyer = PyExecutor(echo=False)
+    for code in sources[:3]:
+        pyer._run(code)
+    pyer._run("del lst, n")
+    records = pyer.replay(["0", "1", "2"], max_workers=2)
+    assert all(record["status"] == 0 for record in records)
+    assert pyer._run("print(lst, n)")["stdout"] == "[1] 1"
+    pyer.stop_process()
+
+
+def test_async_rerun_stops_on_error():
+    async def main():
+        pyer = AsyncPyExecutor(echo=False)
+        for code in ["a = 1", "b = 1 / a", "c = a * 3"]:
+            await pyer._run(code)
+        records = await pyer.rerun("0", "a = 0")
+        assert [record["rerun_of"] for record in records] == ["0", "1"] and records[1]["status"] == 1
+        records = await pyer.rerun("0", "a = 2", max_workers=2)
+        output = (await pyer._run("print(b, c)"))["stdout"]
+        await pyer.stop_process()
+        return [record["rerun_of"] for record in records], output
+
+    assert asyncio.run(main()) == (["0", "1", "2"], "0.5 6")
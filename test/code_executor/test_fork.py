@@ -0,0 +1,49 @@
+import pytest
+from code_executor.pyexe import AsyncPyExecutor, PyExecutor
+
+
+@pytest.mark.parametrize("use_fork_server", [False, True])
+def test_fork_branches_session(use_fork_server):
+    pyer = PyExecutor(use_fork_server=use_fork_server, echo=False)
+    pyer._run("data = np.zeros(1 << 20); x = 1")
+    branch = pyer.fork()
+    assert branch.pid != pyer.pid and list(branch._cmd_space) == ["0"]
+
+    branch._run("x = 2; data[0] = 5")
+    assert branch._run("print(x, data[0])")["stdout"] == "2 5.0"
+    assert pyer._run("print(x, data[0])")["stdout"] == "1 0.0"
+    assert len(branch._cmd_space) == 3 and len(pyer._cmd_space) == 2
+    branch._cmd_space["0"]["stdout"] = "changed"
+    assert pyer._cmd_space["0"]["stdout"] == ""
+
+    branch.stop_process()
+    assert pyer._run("print('alive')")["stdout"] == "alive"
+    pyer.stop_process()
+
+
+def test_fork_with_snapshots(tmp_path):
+    pyer = PyExecutor(str(tmp_path / "main"), True, echo=False)
+    pyer._run("x = 1")
+    unsaved = pyer.fork()
+    assert unsaved.is_save_obj is False
+    unsaved.stop_process()
+    branch = pyer.fork(str(tmp_path / "branch"))
+    branch._run("x += 10")
+    branch.stop_process()
+    pyer.stop_process()
+
+    restored = PyExecutor(str(tmp_path / "branch")).load()
+    assert restored._run("print(x)")["stdout"] == "11"
+    restored.stop_process()
+
+
+@pytest.mark.asyncio
+async def test_async_fork():
+    pyer = AsyncPyExecutor(echo=False)
+    await pyer._run("items = [1, 2]")
+    branch = await pyer.fork()
+    await branch._run("items.append(3)")
+    assert (await branch._run("print(items)"))["stdout"] == "[1, 2, 3]"
+    assert (await pyer._run("print(items)"))["stdout"] == "[1, 2]"
+    await branch.stop_process()
+    await pyer.stop_process()
@@ -0,0 +1,44 @@
+import pytest
+from code_executor.pyexe import PyExecutor, AsyncPyExecutor
+from code_executor.fork_server import ForkServer
+from code_executor.constant import PyExeConfig
+
+
+def test_fork_server_session():
+    pyer = PyExecutor(use_fork_server=True)
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+
+    python_code_gen.send(["a = np.arange(4)"])
+    python_code_gen.send(["print(a.sum())"])
+    assert ForkServer.shared(PyExeConfig.session_command).is_alive()
+    pyer.stop_process()
+    assert pyer._cmd_space["1"]["stdout"] == "6"
+
+
+def test_fork_server_save_and_load(tmp_path):
+    work_dir = str(tmp_path / "pyexe")
+    pyer = PyExecutor(work_dir, True, use_fork_server=True)
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+    python_code_gen.send(["a = 1;b=2;c=3"])
+    pyer.stop_process()
+
+    pyer = PyExecutor(work_dir).load()
+    assert pyer.use_fork_server
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+    python_code_gen.send(["print(2*a + b + c)"])
+    pyer.stop_process()
+    assert pyer._cmd_space["1"]["stdout"] == "7"
+
+
+@pytest.mark.asyncio
+async def test_async_fork_server_session():
+    pyer = AsyncPyExecutor(use_fork_server=True)
+    python_code_gen = pyer.run()
+    await python_code_gen.asend(None)
+
+    await python_code_gen.asend(["print(pd.Series([1, 2]).sum())"])
+    await pyer.stop_process()
+    assert pyer._cmd_space["0"]["stdout"] == "3"
@@ -0,0 +1,48 @@
+import time
+import threading
+from code_executor.hibernation import SessionManager
+
+
+def test_lru_hibernation_and_revival(tmp_path):
+    with SessionManager(str(tmp_path), max_live=2, use_fork_server=True, echo=False) as manager:
+        for name in ("a", "b", "c"):
+            manager.run(name, f"value = np.arange(3) + {ord(name)}")
+        assert manager.live_sessions() == ["b", "c"]
+        assert manager.stats["count_evictions"] == 1 and manager.sessions() == ["a", "b", "c"]
+
+        record = manager.run("a", "print(value.tolist())")  # 透明恢复, b被休眠
+        assert record["stdout"] == "[97, 98, 99]"
+        assert manager.live_sessions() == ["c", "a"] and manager.stats["revived"] == 1
+        assert len(manager.session("a")._cmd_space) == 2
+
+    with SessionManager(str(tmp_path), echo=False) as manager:  # 之前休眠的会话可以被新的SessionManager恢复
+        assert manager.run("b", "print(value[0])")["stdout"] == "98"
+
+
+def test_ttl_and_memory_budget(tmp_path):
+    with SessionManager(str(tmp_path), idle_ttl=0.2, check_interval=0.05, use_fork_server=True, echo=False) as manager:
+        manager.run("idle", "x = 1")
+        time.sleep(0.5)
+        assert manager.live_sessions() == [] and manager.stats["ttl_evictions"] == 1
+        assert manager.run("idle", "print(x)")["stdout"] == "1"
+
+    with SessionManager(str(tmp_path), memory_budget=1, use_fork_server=True, echo=False) as manager:
+        manager.run("first", "big = np.ones(1 << 20)")
+        manager.run("second", "y = 2")
+        assert manager.live_sessions() == ["second"] and manager.stats["memory_evictions"] == 1
+        assert manager.memory_usage()["second"] > 0
+        assert manager.run("first", "print(big.sum())")["stdout"] == "1048576.0"
+
+
+def test_close_waits_for_running_session(tmp_path):
+    manager = SessionManager(str(tmp_path), echo=False)
+    manager.run("busy", "x = 1")
+    thread = threading.Thread(target=manager.run, args=("busy", "import time; time.sleep(0.5); x = 2"))
+    thread.start()
+    time.sleep(0.2)
+    manager.close()  # 等待正在执行的命令完成后再休眠
+    thread.join()
+    assert manager.live_sessions() == [] and manager.stats["hibernated"] == 1
+
+    with SessionManager(str(tmp_path), echo=False) as manager:
+        assert manager.run("busy", "print(x)")["stdout"] == "2"
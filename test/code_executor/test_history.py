@@ -0,0 +1,66 @@
+import json
+import pytest
+from pathlib import Path
+from code_executor.history import CommandHistory, CommandRecord
+from code_executor.pyexe import PyExecutor
+
+
+def test_command_record():
+    record = CommandRecord({"cmd": "a = 1\n\n"})
+    record.update({"stdout": "", "stdout_file": "0.stdout.log"})
+    assert dict(record) == {"cmd": "a = 1\n\n", "stdout": "", "stdout_file": "0.stdout.log"}
+    assert "stderr" not in record and record.get("status") is None
+    assert not hasattr(record, "__dict__")
+
+
+def test_history_append_and_reopen(tmp_path):
+    path = str(tmp_path / "history")
+    history = CommandHistory()
+    for i in range(3):
+        history[str(i)] = {"cmd": f"print({i})", "stdout": str(i)}
+    assert history.flush(path, upto=2) == 2
+    assert history.flush(path) == 1
+    history["3"] = {"cmd": "x", "stdout": "中文"}
+    assert history.flush(path) == 1
+    assert len(Path(f"{path}.log").read_text().splitlines()) == 4
+
+    reopened = CommandHistory(path)
+    assert len(reopened) == 4 and "3" in reopened and "4" not in reopened
+    assert reopened["1"]["stdout"] == "1" and reopened["3"]["stdout"] == "中文"
+    assert list(reopened) == ["0", "1", "2", "3"]
+    # 已持久化的记录只读, 修改不会被静默丢弃
+    with pytest.raises(TypeError, match="read-only"):
+        reopened["1"]["stdout"] = "x"
+    with pytest.raises(TypeError, match="read-only"):
+        reopened["1"].pop("stdout")
+    history["4"] = {"cmd": "y"}
+    history["4"]["stdout"] = "y"
+    assert history["4"]["stdout"] == "y"
+
+
+def test_executor_history_log(tmp_path):
+    work_dir = str(tmp_path / "pyexe")
+    pyer = PyExecutor(work_dir, True, echo=False)
+    pyer.run_many(["a = 1", "print(a)"])
+    pyer.save_executor()
+    pyer.run_many(["print(a + 1)"])
+    pyer.stop_process()
+    assert "_cmd_space" not in json.loads(Path(work_dir, "executor.json").read_text())
+    assert len(Path(work_dir, "history.log").read_text().splitlines()) == 3
+
+    pyer = PyExecutor(work_dir, True, echo=False).load()
+    assert len(pyer._cmd_space) == 3 and pyer._cmd_space["1"]["stdout"] == "1"
+    pyer._run("print(a + 2)")
+    pyer.stop_process()
+    assert pyer._cmd_space["3"]["stdout"] == "3"
+
+
+def test_save_during_completion(tmp_path):
+    # 与cmd完成并发的save_executor()不会持久化尚未写入结果的记录
+    pyer = PyExecutor(str(tmp_path), True, echo=False, init_profile="minimal")
+    futures = [pyer.submit(f"print({i})") for i in range(50)]
+    while not all(future.done() for future in futures):
+        pyer.save_executor()
+    assert [future.result(timeout=30)["stdout"] for future in futures] == [str(i) for i in range(50)]
+    pyer.stop_process()
+    assert [pyer._cmd_space[str(i)]["stdout"] for i in range(50)] == [str(i) for i in range(50)]
@@ -0,0 +1,55 @@
+import asyncio
+import pytest
+from pathlib import Path
+from code_executor.constant import INIT_PROFILES, PyExeConfig
+from code_executor.pyexe import AsyncPyExecutor, PyExecutor
+
+
+def test_with_profile():
+    minimal = PyExeConfig.with_profile("minimal")
+    assert minimal.init_profile == "minimal" and PyExeConfig.init_profile == "data-science"
+    assert minimal.session_command[:-1] == PyExeConfig.session_command[:-1]
+    assert INIT_PROFILES["data-science"] in PyExeConfig.session_command[-1]
+    assert INIT_PROFILES["data-science"] not in minimal.session_command[-1]
+    with pytest.raises(AssertionError):
+        PyExeConfig.with_profile("unknown")
+
+
+def test_minimal_profile_snapshot(tmp_path):
+    pyer = PyExecutor(str(tmp_path), True, init_profile="minimal", echo=False)
+    pyer._run("x = [1, 2, 3]")
+    assert pyer._run("import sys; print('numpy' in sys.modules, 'np' in globals())")["stdout"] == "False False"
+    assert all(not name.startswith("numpy") for name, _, _ in pyer.startup_trace()["modules"])
+    pyer.stop_process()
+
+    pyer = PyExecutor(str(tmp_path), True).load()
+    assert pyer.init_profile == "minimal" and pyer._startup_trace["init_seconds"] >= 0
+    assert pyer._run("print(x)")["stdout"] == "[1, 2, 3]"
+    pyer.stop_process()
+
+
+def test_lazy_profile(tmp_path):
+    pyer = PyExecutor(str(tmp_path), True, init_profile="data-science-lazy", echo=False)
+    assert pyer.startup_trace()["lazy"] == {}
+    assert pyer._run("import sys; print(type(sys.modules['numpy']).__name__)")["stdout"] == "_LazyModule"
+    pyer._run("x = np.arange(4)")
+    assert "numpy" in pyer.startup_trace()["lazy"]
+    assert list(Path(tmp_path, "objects").rglob("*.npy"))  # 数组仍按npy保存
+    assert pyer._run("import matplotlib; print(matplotlib.pyplot is plt)")["stdout"] == "True"
+    pyer.stop_process()
+
+    pyer = PyExecutor(str(tmp_path), True).load()
+    assert pyer._run("print(x.sum())")["stdout"] == "6"
+    pyer.stop_process()
+
+
+def test_startup_trace_inherited_from_fork_server():
+    async def main():
+        pyer = AsyncPyExecutor(use_fork_server=True, echo=False)
+        trace = await pyer.startup_trace()
+        await pyer.stop_process()
+        return trace
+
+    trace = asyncio.run(main())
+    assert trace["inherited"] and trace["init_seconds"] > 0
+    assert "numpy" in [name for name, _, _ in trace["modules"]]
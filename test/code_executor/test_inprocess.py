@@ -0,0 +1,53 @@
+import sys
+from code_executor.constant import INIT_PROFILES, PyExeConfig
+from code_executor.pyexe import InProcessPyExecutor, PyExecutor, create_py_executor
+
+
+def test_backend_config():
+    config = PyExeConfig.with_backend("inprocess").with_profile("minimal")
+    assert config.backend == "inprocess" and PyExeConfig.backend == "subprocess"
+    assert config.session_command[:-1] == PyExeConfig.session_command[:-1]
+    assert INIT_PROFILES["data-science"] not in config.inprocess_code and "def save_object" in config.inprocess_code
+    assert INIT_PROFILES["data-science"] in PyExeConfig.with_backend("inprocess").inprocess_code
+    pyer = create_py_executor(config=config, echo=False)
+    assert isinstance(pyer, InProcessPyExecutor) and pyer.init_profile == "minimal"
+    assert isinstance(create_py_executor(echo=False), PyExecutor)
+
+
+def test_run_and_capture():
+    pyer = InProcessPyExecutor(init_profile="minimal", echo=False)
+    chunks = []
+    pyer.add_sink(chunks.append)
+    stdout = sys.stdout
+    gen = pyer.run()
+    next(gen)
+    gen.send("x = 40")
+    gen.send(["print(x + 2)", "; x"])
+    assert sys.stdout is stdout
+    assert pyer._cmd_space["1"]["stdout"] == "42\n40" and pyer._cmd_space["1"]["status"] == 0
+    assert [(chunk.cmd_id, chunk.stream) for chunk in chunks][0] == ("1", "stdout")
+    record = pyer._run("import sys; print('err', file=sys.stderr); 1 / 0")
+    assert record["status"] == 1 and record["stderr"].startswith("err\nTraceback")
+    assert "ZeroDivisionError" in record["stderr"] and "<cell-2>" in record["stderr"]
+    # 重复执行的cell复用编译结果
+    assert not pyer._run("x += 1")["metrics"]["code_cache_hit"]
+    assert pyer._run("x += 1")["metrics"]["code_cache_hit"]
+    assert pyer._run("print(x)")["stdout"] == "42"
+    pyer.stop_process()
+
+
+def test_snapshot_shared_with_subprocess_backend(tmp_path):
+    pyer = InProcessPyExecutor(str(tmp_path), True, init_profile="minimal", echo=False)
+    pyer._run("class Point:\n    def __init__(self, x):\n        self.x = x\np = Point(3)\nitems = [1, 2]")
+    pyer.stop_process()
+
+    pyer = PyExecutor(str(tmp_path), True, echo=False).load()
+    assert pyer.init_profile == "minimal"
+    assert pyer._run("items.append(p.x); print(items)")["stdout"] == "[1, 2, 3]"
+    pyer.stop_process()
+
+    pyer = InProcessPyExecutor(str(tmp_path), True, init_profile="minimal", echo=False).load()
+    assert len(pyer._cmd_space) == 2 and pyer._run("print(items)")["stdout"] == "[1, 2, 3]"
+    pyer.restore("0")
+    assert pyer._run("print(items)")["stdout"] == "[1, 2]"
+    pyer.stop_process()
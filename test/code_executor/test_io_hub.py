@@ -0,0 +1,82 @@
+import os
+import time
+import signal
+import threading
+from code_executor.io_hub import IOHub, LineReader, TimerQueue
+from code_executor.sync_executor import SyncCodeExecutor
+from code_executor.pyexe import PyExecutor
+
+
+def test_line_reader():
+    lines = []
+    reader = LineReader(lines.append)
+    for chunk in (b"ab", b"c\nd", "é\n".encode()[:1], "é\n".encode()[1:], b"tail"):
+        reader.feed(chunk)
+    reader.close()
+    assert lines == ["abc", "dé", "tail"]
+
+
+def test_io_hub_register():
+    chunks = []
+    r, w = os.pipe()
+    closed = IOHub.shared().register(r, chunks.append, lambda: chunks.append(None))
+    os.write(w, b"hello")
+    os.close(w)
+    assert closed.wait(5)
+    os.close(r)
+    assert b"".join(chunks[:-1]) == b"hello" and chunks[-1] is None
+
+
+def test_io_hub_unregister():
+    chunks = []
+    r, w = os.pipe()
+    closed = IOHub.shared().register(r, chunks.append, lambda: chunks.append(None))
+    IOHub.shared().unregister(r, closed)
+    assert closed.wait(5) and chunks == [None]
+    os.close(r)
+    os.close(w)
+
+
+def test_timer_queue():
+    fired = []
+    timers = TimerQueue.shared()
+    cancelled = timers.call_later(0.05, fired.append, "cancelled")
+    timers.call_later(0.1, fired.append, "late")
+    timers.call_later(0.02, fired.append, "early")
+    timers.cancel(cancelled)
+    time.sleep(0.3)
+    assert fired == ["early", "late"] and len(timers) == 0
+
+
+def test_stop_with_background_child(monkeypatch):
+    # 后台子进程继承了会话的stdout/stderr, 会话退出后管道仍读不到EOF
+    monkeypatch.setattr("code_executor.sync_executor.DRAIN_TIMEOUT", 0.5)
+    pyer = PyExecutor(echo=False, init_profile="minimal")
+    child = pyer._run("import subprocess; print(subprocess.Popen(['sleep', '60']).pid)")["stdout"]
+    started = time.time()
+    pyer.stop_process()
+    os.kill(int(child), signal.SIGKILL)
+    assert time.time() - started < 10 and not pyer.is_alive()
+
+
+def test_many_sessions_fixed_threads():
+    hub, timers = IOHub.shared(), TimerQueue.shared()
+    threads = threading.active_count()
+    executors = [SyncCodeExecutor(echo=False) for _ in range(16)] + [PyExecutor(echo=False) for _ in range(2)]
+    # 超时计时同样不会为每个cmd启动线程
+    futures = [
+        executor.submit(f"echo {i}" if i < 16 else f"print({i})", timeout=30) for i, executor in enumerate(executors)
+    ]
+    assert threading.active_count() == threads
+    assert [future.result()["stdout"] for future in futures] == [str(i) for i in range(18)]
+    assert len(hub) >= 16 * 2 + 2 * 3
+    for executor in executors:
+        executor.stop_process()
+
+
+def test_sentinel_incomplete_statement():
+    executor = SyncCodeExecutor(["python3", "-i", "-q", "-u"], 'print("{}")', echo=False)
+    assert executor._run("a = 1; b = 2")["stderr"] == ""
+    assert executor._run("print(a + b")["stderr"] == "SyntaxError: incomplete input"
+    assert executor._run("print(a + b)")["stdout"] == "3"
+    executor.stop_process()
@@ -0,0 +1,50 @@
+import asyncio
+import json
+from code_executor.metrics import MetricsRegistry
+from code_executor.pyexe import AsyncPyExecutor, PyExecutor
+from code_executor.sync_executor import SyncCodeExecutor
+
+
+def test_command_metrics_and_hooks(tmp_path):
+    pyer = PyExecutor(str(tmp_path), True, echo=False, report_metrics=False)
+    seen = []
+    pyer.add_metrics_hook(lambda cmd_id, metrics: seen.append((cmd_id, metrics)))
+    pyer._run("x = np.ones(1 << 20)")
+    pyer._run("print('a' * 100)")
+    pyer._run("1 / 0")
+
+    metrics = pyer._cmd_space["0"]["metrics"]
+    for name in ("queue_time", "wall_time", "cpu_time", "rss_peak_delta", "total_time", "snapshot_time"):
+        assert metrics[name] >= 0
+    assert metrics["snapshot_bytes"] >= 8 << 20 and metrics["snapshot_written_bytes"] >= 8 << 20
+    assert pyer._cmd_space["1"]["metrics"]["output_bytes"] == 101
+    assert pyer._cmd_space["1"]["metrics"]["snapshot_written_bytes"] == 0
+    assert [cmd_id for cmd_id, _ in seen] == ["0", "1", "2"] and seen[2][1]["status"] == 1
+    pyer.stop_process()
+    assert PyExecutor(str(tmp_path)).load()._cmd_space["1"]["metrics"]["output_bytes"] == 101
+
+
+def test_metrics_registry_across_sessions():
+    registry = MetricsRegistry.shared()
+    registry.reset()
+    bash = SyncCodeExecutor(echo=False)
+    bash._run("echo hello")
+    bash.stop_process()
+
+    async def main():
+        pyer = AsyncPyExecutor(echo=False)
+        await pyer._run("print(1)")
+        await pyer._run("raise ValueError")
+        await pyer.stop_process()
+        return pyer._cmd_space["0"]["metrics"]
+
+    assert asyncio.run(main())["output_bytes"] == 2
+    series = json.loads(registry.dump_json())
+    assert series["SyncCodeExecutor"]["commands"] == 1
+    assert series["SyncCodeExecutor"]["metrics"]["output_bytes"]["sum"] == 6
+    assert series["AsyncPyExecutor"]["commands"] == 2 and series["AsyncPyExecutor"]["errors"] == 1
+
+    text = registry.dump_prometheus()
+    assert 'code_executor_commands_total{executor="AsyncPyExecutor",status="error"} 1' in text
+    assert 'code_executor_total_time_seconds_bucket{executor="AsyncPyExecutor",le="+Inf"} 2' in text
+    assert 'code_executor_output_bytes_count{executor="SyncCodeExecutor"} 1' in text
@@ -0,0 +1,101 @@
+import pytest
+from pathlib import Path
+from code_executor.output import OutputBudget, OutputBuffer
+from code_executor.pyexe import PyExecutor, AsyncPyExecutor
+
+
+def test_output_buffer_spill(tmp_path):
+    budget = OutputBudget(1 << 20)
+    buffer = OutputBuffer(str(tmp_path / "0.stdout.log"), limit=100, keep=10, budget=budget)
+    for i in range(50):
+        buffer.append(f"{i:04d}\n".encode())
+    text = buffer.close()
+    assert buffer.spilled and buffer.size == 250
+    assert text.startswith("0000\n0001") and text.endswith("0048\n0049\n")
+    assert "230 bytes omitted" in text
+    assert (tmp_path / "0.stdout.log").read_bytes() == b"".join(f"{i:04d}\n".encode() for i in range(50))
+    assert budget.used == 0
+
+
+def test_output_buffer_session_budget(tmp_path):
+    budget = OutputBudget(8)
+    first = OutputBuffer(str(tmp_path / "0.stdout.log"), limit=100, keep=2, budget=budget)
+    first.append(b"12345678")
+    second = OutputBuffer(str(tmp_path / "1.stdout.log"), limit=100, keep=2, budget=budget)
+    second.append(b"9")
+    assert not first.spilled and second.spilled
+    assert first.close() == "12345678"
+    # 关闭后保留的文本仍占用额度, 直到被丢弃
+    assert budget.used == 8
+    first.release()
+    assert budget.used == 0
+
+
+def test_executor_spilled_output(tmp_path):
+    pyer = PyExecutor(str(tmp_path), output_limit=1000, output_keep=100)
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+    python_code_gen.send(["for i in range(1000): print(i)"])
+    pyer.stop_process()
+
+    record = pyer._cmd_space["0"]
+    full = "".join(str(i) + "\n" for i in range(1000))
+    assert record["stdout_bytes"] == len(full)
+    assert record["stdout"].startswith("0\n1\n2") and record["stdout"].endswith("998\n999")
+    assert "".join(pyer.iter_output("0", chunk_size=64)) == full
+    assert pyer.read_output("0", offset=len(full) - 4) == "999\n"
+
+
+def test_retained_output_budget(tmp_path):
+    pyer = PyExecutor(echo=False, init_profile="minimal", session_output_limit=100, output_keep=10)
+    assert "stdout_file" not in pyer._run("print('a' * 60)")
+    # 第一个cmd的输出仍保留在cmd_space中, 会话额度不足
+    record = pyer._run("print('b' * 60)")
+    spill_dir = Path(record["stdout_file"]).parent
+    pyer.stop_process()
+    assert not spill_dir.exists()
+
+    # 记录持久化后归还额度
+    pyer = PyExecutor(str(tmp_path), True, echo=False, init_profile="minimal", session_output_limit=100)
+    pyer._run("print('a' * 60)")
+    pyer.save_executor()
+    assert "stdout_file" not in pyer._run("print('b' * 60)")
+    pyer.stop_process()
+
+
+def test_spilled_output_after_stop():
+    # 未设置work_dir时溢出文件随会话删除, 之后只能读到记录中保留的开头和结尾
+    pyer = PyExecutor(echo=False, init_profile="minimal", output_limit=1000, output_keep=100)
+    pyer._run("for i in range(1000): print(i)")
+    assert "".join(pyer.iter_output("0")).endswith("999\n")
+    pyer.stop_process()
+
+    record = pyer._cmd_space["0"]
+    assert "stdout_file" not in record and record["output_released"]
+    assert pyer.read_output("0").startswith("0\n1\n2") and pyer.read_output("0").endswith("998\n999")
+    assert "".join(pyer.iter_output("0")) == record["stdout"]
+
+
+def test_stream_chunks_and_sink():
+    seen = []
+    pyer = PyExecutor(echo=False)
+    pyer.add_sink(seen.append)
+
+    chunks = list(
+        pyer.stream("import sys, time\nfor i in range(3): print(i); time.sleep(0.02)\nprint('e', file=sys.stderr)")
+    )
+    pyer.stop_process()
+    assert "".join(c.text for c in chunks if c.stream == "stdout") == "0\n1\n2\n"
+    assert [c.text for c in chunks if c.stream == "stderr"] == ["e", "\n"]
+    assert all(c.cmd_id == "0" for c in chunks)
+    assert [c.timestamp for c in chunks] == sorted(c.timestamp for c in chunks)
+    assert seen == chunks
+
+
+@pytest.mark.asyncio
+async def test_async_stream_chunks():
+    pyer = AsyncPyExecutor(echo=False)
+    chunks = [chunk async for chunk in pyer.stream(["print('a')", "; print('b')"])]
+    await pyer.stop_process()
+    assert "".join(c.text for c in chunks) == "a\nb\n"
+    assert pyer._cmd_space["0"]["stdout"] == "a\nb"
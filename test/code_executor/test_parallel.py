@@ -0,0 +1,32 @@
+import pytest
+from code_executor.parallel import ParallelPyExecutor
+from code_executor.pyexe import PyExecutor
+
+
+def test_parallel_map_and_history():
+    with ParallelPyExecutor(3, init_code="import os\ndef square(x):\n    return x * x\n", echo=False) as pyer:
+        assert pyer.map("square(item)", range(10)) == [i * i for i in range(10)]
+        assert len(set(pyer.map("os.getpid()", range(3)))) == 3
+        assert pyer.map("item", [1]) == [1]
+
+        # 每个worker都执行了broadcast的代码, 输出按worker顺序合并
+        record = pyer.broadcast("print(os.getpid())")
+        assert record["stdout"].split("\n") == [str(worker.pid) for worker in pyer.workers]
+        assert [w["worker"] for w in record["workers"]] == [0, 1, 2]
+        assert pyer._cmd_space["1"]["cmd"] == "map square(item)"
+
+        with pytest.raises(RuntimeError, match="workers failed"):
+            pyer.map("1 / item", [1, 0])
+
+
+def test_parallel_scatter_gather_and_snapshot(tmp_path):
+    source = PyExecutor(str(tmp_path / "source"), True, echo=False)
+    source._run("weights = np.arange(4)")
+    source.stop_process()
+
+    with ParallelPyExecutor(2, echo=False) as pyer:
+        pyer.scatter("part", [[1, 2], [4]])
+        record = pyer.broadcast("total = sum(part); print(total)")
+        assert record["stdout"] == "3\n4" and pyer.gather("total") == [3, 4]
+        pyer.broadcast_snapshot(source.obj_save_path("0"))
+        assert [int(w.sum()) for w in pyer.gather("weights")] == [6, 6]
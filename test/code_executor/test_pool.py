@@ -0,0 +1,74 @@
+import time
+import asyncio
+import pytest
+from code_executor.sync_executor import SyncCodeExecutor
+from code_executor.async_executor import AsyncCodeExecutor
+from code_executor.pool import ExecutorPool, AsyncExecutorPool
+
+
+def test_pool_checkout_and_recycle():
+    with ExecutorPool(SyncCodeExecutor, min_size=1, max_size=2, max_commands=2) as pool:
+        pyer = pool.checkout()
+        assert pyer.is_alive()
+        assert pool.stats["hits"] == 1
+
+        python_code_gen = pyer.run()
+        next(python_code_gen)
+        python_code_gen.send(["echo hello"])
+        python_code_gen.send(["echo world"])
+        assert pyer._cmd_space["0"]["stdout"] == "hello"
+
+        pool.checkin(pyer)
+        assert not pyer.is_alive()
+        assert pool.stats["recycled"] == 1
+
+        first, second = pool.checkout(), pool.checkout()
+        assert pool.stats["misses"] == 1
+        with pytest.raises(TimeoutError):
+            pool.checkout(timeout=0.1)
+        pool.checkin(first)
+        pool.checkin(second)
+
+
+def test_pool_health_check():
+    with ExecutorPool(SyncCodeExecutor, min_size=1, max_size=1) as pool:
+        pyer = pool.checkout()
+        pool.checkin(pyer)
+        pyer.stop_process()
+        assert pool.health_check() == 1
+        assert pool.checkout() is not pyer
+
+
+@pytest.mark.asyncio
+async def test_async_pool_checkout():
+    async with AsyncExecutorPool(AsyncCodeExecutor, min_size=1, max_size=1) as pool:
+        pyer = await pool.checkout()
+        python_code_gen = pyer.run()
+        await python_code_gen.asend(None)
+        await python_code_gen.asend(["echo hello"])
+        await pool.checkin(pyer)
+        assert await pool.checkout() is pyer
+        assert pool.stats == {"hits": 2, "misses": 0, "created": 1, "recycled": 0, "unhealthy": 0}
+        await pool.checkin(pyer)
+
+
+@pytest.mark.asyncio
+async def test_async_pool_checkout_deadline():
+    async with AsyncExecutorPool(AsyncCodeExecutor, min_size=1, max_size=1) as pool:
+        pyer = await pool.checkout()
+        cond = pool._AsyncExecutorPool__cond
+
+        async def wake():
+            # 没有归还会话的唤醒不应重新开始计时
+            while True:
+                await asyncio.sleep(0.05)
+                async with cond:
+                    cond.notify_all()
+
+        waker = asyncio.create_task(wake())
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            await pool.checkout(timeout=0.2)
+        assert time.monotonic() - start < 1
+        waker.cancel()
+        await pool.checkin(pyer)
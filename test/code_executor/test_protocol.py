@@ -0,0 +1,61 @@
+import gc
+import asyncio
+import pytest
+from code_executor.pyexe import PyExecutor, AsyncPyExecutor
+from code_executor.protocol import FRAME_HEADER, STREAM_END, STREAM_STDOUT, FrameParser
+
+
+def test_frame_parser_split_chunks():
+    data = FRAME_HEADER.pack(3, STREAM_STDOUT, 0, 5) + b"hello" + FRAME_HEADER.pack(3, STREAM_END, 1, 0)
+    parser = FrameParser()
+    frames = [frame for i in range(len(data)) for frame in parser.feed(data[i : i + 1])]
+    assert [(f.cmd_id, f.stream, f.status, f.payload) for f in frames] == [
+        (3, STREAM_STDOUT, 0, b"hello"),
+        (3, STREAM_END, 1, b""),
+    ]
+
+
+def test_framed_exact_completion():
+    pyer = PyExecutor()
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+
+    python_code_gen.send(["print('END_OF_EXECUTION'); print('after')"])
+    python_code_gen.send(["import warnings; warnings.warn('careful'); print('done')"])
+    python_code_gen.send(["print(1 +"])
+    python_code_gen.send(["1/0"])
+    python_code_gen.send(["x = 40; x + 2"])
+    pyer.stop_process()
+    assert pyer._cmd_space["0"]["stdout"] == "END_OF_EXECUTION\nafter"
+    assert pyer._cmd_space["1"]["stdout"] == "done"
+    assert "careful" in pyer._cmd_space["1"]["stderr"]
+    assert pyer._cmd_space["2"]["status"] == 1 and "SyntaxError" in pyer._cmd_space["2"]["stderr"]
+    assert pyer._cmd_space["3"]["status"] == 1 and "ZeroDivisionError" in pyer._cmd_space["3"]["stderr"]
+    assert pyer._cmd_space["4"].pop("metrics")["output_bytes"] == 3
+    assert pyer._cmd_space["4"] == {
+        "cmd": "x = 40; x + 2\n\n",
+        "stdout": "42",
+        "stderr": "",
+        "status": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_async_framed_large_output():
+    pyer = AsyncPyExecutor()
+    python_code_gen = pyer.run()
+    await python_code_gen.asend(None)
+
+    await python_code_gen.asend(["print('x' * 200000)"])
+    await pyer.stop_process()
+    assert pyer._cmd_space["0"]["stdout"] == "x" * 200000
+
+
+@pytest.mark.asyncio
+async def test_async_reader_tasks_survive_gc():
+    # 事件循环只弱引用任务, 读取输出的任务被回收后cmd将永远不会完成
+    pyer = AsyncPyExecutor(echo=False, init_profile="minimal")
+    future = await pyer.submit("import time; time.sleep(0.2); print('done')")
+    gc.collect()
+    assert (await asyncio.wait_for(future, 30))["stdout"] == "done"
+    await pyer.stop_process()
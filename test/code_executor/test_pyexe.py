@@ -69,3 +69,26 @@ async def test_async_load():
     await pyer.stop_process()
     assert len(pyer._cmd_space) == 5
     assert pyer._cmd_space['4']['stdout'] == '7'
+
+
+def test_submit_pipelined():
+    pyer = PyExecutor()
+    futures = [pyer.submit(f"import time; time.sleep(0.05); print({i})") for i in range(5)]
+    assert not futures[-1].done()
+    assert [future.result()["stdout"] for future in futures] == ["0", "1", "2", "3", "4"]
+
+    records = pyer.run_many(["x = 6", ["print(x *", "7)"]])
+    pyer.stop_process()
+    assert records[1] is pyer._cmd_space["6"]
+    assert records[1]["stdout"] == "42"
+
+
+@pytest.mark.asyncio
+async def test_async_submit_pipelined():
+    pyer = AsyncPyExecutor()
+    future = await pyer.submit("import time; time.sleep(0.05); print('slow')")
+    records = await pyer.run_many(["print('fast')", "1/0"])
+    await pyer.stop_process()
+    assert (await future)["stdout"] == "slow"
+    assert [record["status"] for record in records] == [0, 1]
+    assert records[0] is pyer._cmd_space["1"]
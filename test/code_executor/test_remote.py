@@ -0,0 +1,61 @@
+import pytest
+from code_executor.remote import RemoteExecutor, Scheduler, WorkerDaemon
+
+
+@pytest.fixture
+def daemons(tmp_path):
+    daemons = [
+        WorkerDaemon(str(tmp_path / "worker_0"), max_sessions=2),
+        WorkerDaemon(str(tmp_path / "worker_1"), unix_path=str(tmp_path / "worker_1.sock"), max_sessions=2),
+    ]
+    yield [daemon.start_in_thread() for daemon in daemons]
+    for daemon in daemons:
+        daemon.stop_thread()
+
+
+def test_remote_run(daemons):
+    pyer = RemoteExecutor(daemons[1], echo=False)
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+    python_code_gen.send(["a = 1"])
+    python_code_gen.send(["print(a + 1)"])
+    assert pyer._cmd_space["1"]["stdout"] == "2"
+    with pytest.raises(RuntimeError, match="already exists"):
+        RemoteExecutor(daemons[1], pyer.name).start_process()
+    pyer.stop_process()
+
+
+def test_scheduler_and_migrate(daemons):
+    scheduler = Scheduler(daemons)
+    first = scheduler.open(is_save_obj=True, echo=False)
+    second = scheduler.open(echo=False)
+    assert {first.address, second.address} == set(daemons)
+    assert [s["sessions"] for s in scheduler.stats().values()] == [1, 1]
+
+    first._run("x = np.arange(5); y = 'kept'")
+    target = daemons[1] if first.address == daemons[0] else daemons[0]
+    moved = first.migrate(target)
+    assert moved.address == target and len(moved._cmd_space) == 1
+    moved._run("print(x.sum(), y)")
+    assert moved._cmd_space["1"]["stdout"] == "10 kept"
+    moved.stop_process()
+    second.stop_process()
+
+
+def test_daemon_token(tmp_path):
+    # 监听非回环地址时必须设置token
+    with pytest.raises(AssertionError, match="token is required"):
+        WorkerDaemon(str(tmp_path / "worker"), host="0.0.0.0")
+
+    daemon = WorkerDaemon(str(tmp_path / "worker"), token="secret")
+    address = daemon.start_in_thread()
+    try:
+        with pytest.raises(RuntimeError, match="invalid token"):
+            RemoteExecutor(address, echo=False)._run("a = 1")
+        with pytest.raises(RuntimeError, match="invalid token"):
+            Scheduler([address], token="wrong").stats()
+        pyer = Scheduler([address], token="secret").open(echo=False)
+        assert pyer._run("print(1 + 1)")["stdout"] == "2"
+        pyer.stop_process()
+    finally:
+        daemon.stop_thread()
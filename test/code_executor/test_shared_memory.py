@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pytest
+from code_executor.pyexe import AsyncPyExecutor, PyExecutor
+from code_executor.shared_memory import SHM_DIR
+
+
+def _leftover_files():
+    return [name for name in os.listdir(SHM_DIR) if name.startswith(f"code_executor_{os.getpid()}_")]
+
+
+def test_put_get_share():
+    pyer = PyExecutor(echo=False)
+    array = np.arange(12, dtype=np.float32).reshape(3, 4)
+    pyer.put("array", array)
+    pyer.put("raw", b"hello")
+    assert pyer._run("print(array.sum(), array.dtype, bytes(raw))")["stdout"] == "66.0 float32 b'hello'"
+
+    pyer._run("result = array * 2; doubled = bytes(raw) * 2")
+    assert np.array_equal(pyer.get("result"), array * 2)
+    assert bytes(pyer.get("doubled")) == b"hellohello"
+    records = np.zeros(2, dtype=[("x", "<i4"), ("y", "<f8")])
+    pyer.put("records", records)
+    assert pyer.get("records").dtype == records.dtype
+
+    shared = pyer.share("shared", (4,), "int64")
+    shared[:] = [1, 2, 3, 4]
+    pyer._run("shared *= 10")
+    assert shared.tolist() == [10, 20, 30, 40]
+
+    with pytest.raises(RuntimeError, match="get missing failed"):
+        pyer.get("missing")
+    with pytest.raises(TypeError):
+        pyer.put("obj", [1, 2])
+    assert len(pyer._cmd_space) == 3 and _leftover_files() == []
+    pyer.stop_process()
+
+
+@pytest.mark.asyncio
+async def test_async_put_get():
+    pyer = AsyncPyExecutor(echo=False)
+    await pyer.put("x", np.ones((2, 2)))
+    await pyer._run("y = x + 1")
+    assert (await pyer.get("y")).tolist() == [[2.0, 2.0], [2.0, 2.0]]
+    await pyer.stop_process()
@@ -0,0 +1,142 @@
+import time
+import json
+from pathlib import Path
+import pytest
+from code_executor.pyexe import PyExecutor, AsyncPyExecutor
+
+
+def test_incremental_snapshot(tmp_path):
+    work_dir = str(tmp_path / "pyexe")
+    pyer = PyExecutor(work_dir, True, echo=False)
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+
+    python_code_gen.send(["a = np.arange(100000); b = 1"])
+    python_code_gen.send(["b = 2; g = (i for i in range(3))"])
+    manifests = [json.loads(Path(pyer.obj_save_path(cmd_id)).read_text()) for cmd_id in ("0", "1")]
+    assert set(manifests[0]) == {"a", "b"} and set(manifests[1]) == {"a", "b"}
+    assert manifests[0]["a"] == manifests[1]["a"]
+    assert manifests[0]["b"] != manifests[1]["b"]
+    assert "skip g" in pyer._cmd_space["1"]["stderr"]
+    assert len(list((Path(work_dir) / "objects").glob("*/*"))) == 3
+
+    python_code_gen.send(["a = 5"])
+    pyer.load_obj("0")
+    python_code_gen.send(["print(a.sum(), b)"])
+    pyer.stop_process()
+    assert pyer._cmd_space["4"]["stdout"] == "4999950000 1"
+
+
+def test_background_checkpoint(tmp_path):
+    work_dir = str(tmp_path / "pyexe")
+    pyer = PyExecutor(work_dir, True, echo=False, checkpoint_mode="background", max_inflight_checkpoints=1)
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+
+    python_code_gen.send(["class Slow:\n    def __getstate__(self):\n        time.sleep(1); return {}\n"])
+    start = time.monotonic()
+    python_code_gen.send(["import time; s = Slow(); a = 1"])
+    assert time.monotonic() - start < 0.8
+    assert pyer.flush_checkpoints() == 0
+    assert set(json.loads(Path(pyer.obj_save_path("1")).read_text())) >= {"s", "a"}
+
+    python_code_gen.send(["a = 2"])
+    pyer.stop_process()
+    assert (
+        json.loads(Path(pyer.obj_save_path("2")).read_text())["a"]
+        != json.loads(Path(pyer.obj_save_path("1")).read_text())["a"]
+    )
+
+    loaded = PyExecutor(work_dir, True, echo=False).load()
+    assert loaded.checkpoint_mode == "background"
+    loaded._run("print(a)")
+    loaded.stop_process()
+    assert loaded._cmd_space["3"]["stdout"] == "2"
+
+
+@pytest.mark.asyncio
+async def test_async_background_checkpoint(tmp_path):
+    pyer = AsyncPyExecutor(str(tmp_path / "pyexe"), True, echo=False, checkpoint_mode="background")
+    await pyer._run("a = [1, 2, 3]")
+    await pyer._run("b = 1")
+    assert await pyer.flush_checkpoints() == 0
+    assert set(json.loads(Path(pyer.obj_save_path("1")).read_text())) == {"a", "b"}
+    await pyer.stop_process()
+
+
+def test_typed_serializers(tmp_path):
+    work_dir = str(tmp_path / "pyexe")
+    pyer = PyExecutor(work_dir, True, echo=False, snapshot_compression=6)
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+
+    python_code_gen.send(
+        ["a = np.arange(1000000).reshape(1000, 1000).T; df = pd.DataFrame({'x': [1, 2], 'y': ['u', 'v']})"]
+    )
+    python_code_gen.send(["s = 'z' * 100000"])
+    manifest = json.loads(Path(pyer.obj_save_path("1")).read_text())
+    assert manifest["a"].endswith(".npy")
+    assert (Path(work_dir) / "objects" / manifest["s"][:2] / manifest["s"]).stat().st_size < 10000
+
+    python_code_gen.send(["a = None; df = None"])
+    pyer.load_obj("1")
+    python_code_gen.send(["print(type(a.base).__name__, a[1, 0], df.y.tolist(), len(s))"])
+    # 恢复的数组是内存映射上的ndarray视图, 可以被pickle(如发送给其它会话)
+    python_code_gen.send(["import pickle; print(type(a).__name__, pickle.loads(pickle.dumps(a))[1, 0])"])
+    pyer.stop_process()
+    assert pyer._cmd_space["4"]["stdout"] == "memmap 1 ['u', 'v'] 100000"
+    assert pyer._cmd_space["5"]["stdout"] == "ndarray 1"
+
+
+def test_parquet_serializer(tmp_path):
+    # 没有安装pyarrow时DataFrame退回到dill序列化
+    pytest.importorskip("pyarrow")
+    pyer = PyExecutor(str(tmp_path / "pyexe"), True, echo=False)
+    pyer._run("df = pd.DataFrame({'x': [1, 2], 'y': ['u', 'v']})")
+    assert json.loads(Path(pyer.obj_save_path("0")).read_text())["df"].endswith(".parquet")
+    pyer._run("df = None")
+    pyer.load_obj("0")
+    assert pyer._run("print(df.y.tolist())")["stdout"] == "['u', 'v']"
+    pyer.stop_process()
+
+
+def test_parquet_fallback_warns(tmp_path):
+    # 模拟未安装pyarrow: 重建序列化方式后DataFrame退回到dill, 且只提示一次
+    pyer = PyExecutor(str(tmp_path / "pyexe"), True, echo=False)
+    pyer._run(
+        "import sys, importlib.util\n"
+        "_find_spec, importlib.util.find_spec = importlib.util.find_spec, lambda name, *args: None\n"
+        "_pyarrow = {name: sys.modules.pop(name) for name in list(sys.modules) if name.startswith('pyarrow')}\n"
+        "__cx_serializers__[:] = __cx_snapshot_serializers__()\n"
+        "importlib.util.find_spec = _find_spec; sys.modules.update(_pyarrow); del _find_spec, _pyarrow"
+    )
+    result = pyer._run("df = pd.DataFrame({'x': [1, 2]})")
+    assert "pyarrow is not installed" in result["stderr"]
+    assert not json.loads(Path(pyer.obj_save_path("1")).read_text())["df"].endswith(".parquet")
+    assert "pyarrow" not in pyer._run("df2 = df")["stderr"]
+    pyer.stop_process()
+
+
+def test_lazy_load_and_restore(tmp_path):
+    work_dir = str(tmp_path / "pyexe")
+    pyer = PyExecutor(work_dir, True, echo=False)
+    python_code_gen = pyer.run()
+    next(python_code_gen)
+    python_code_gen.send(["a = [1, 2]; b = np.ones(3)"])
+    python_code_gen.send(["def f():\n    return a[-1] + b.sum()\n"])
+    pyer.stop_process()
+
+    pyer = PyExecutor(work_dir, True, echo=False).load(lazy=True)
+    pyer._run("print(type(globals()['a']).__name__, isinstance(globals()['b'], np.ndarray))")
+    pyer._run("print(f(), type(globals()['a']).__name__)")
+    assert pyer._cmd_space["2"]["stdout"] == "__cx_lazy_object__ True"
+    assert pyer._cmd_space["3"]["stdout"] == "5.0 list"
+
+    pyer._run("a = 'changed'; c = 1")
+    pyer.restore("0")
+    pyer._run("print(a, 'c' in globals(), 'f' in globals())")
+    assert pyer._cmd_space["6"]["stdout"] == "[1, 2] False False"
+    pyer.restore("4", lazy=True)
+    pyer._run("print(a, c)")
+    pyer.stop_process()
+    assert pyer._cmd_space["8"]["stdout"] == "changed 1"
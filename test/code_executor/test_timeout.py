@@ -0,0 +1,81 @@
+import asyncio
+import time
+from code_executor.pyexe import AsyncPyExecutor, PyExecutor
+
+UNINTERRUPTIBLE = "import signal, time; signal.signal(signal.SIGINT, signal.SIG_IGN); time.sleep(60)"
+
+
+def test_timeout_interrupts_and_keeps_session():
+    pyer = PyExecutor(echo=False, init_profile="minimal")
+    pyer._run("x = 1")
+    pid, started = pyer.pid, time.time()
+    record = pyer._run("import time\nwhile True: time.sleep(0.01)", timeout=0.5)
+    assert time.time() - started < 5
+    assert record["timed_out"] and record["status"] == 1 and "KeyboardInterrupt" in record["stderr"]
+    assert pyer.pid == pid and pyer._run("print(x)")["stdout"] == "1"
+    # 迟到的中断不会打断之后的cmd
+    assert not pyer.interrupt("1")
+    assert "timed_out" not in pyer._run("time.sleep(0.2); print(x)", timeout=5)
+    pyer.stop_process()
+
+
+def test_interrupt_during_output_keeps_frames():
+    # 中断不会落在帧的写入过程中, 之后的cmd的输出仍能正确解析
+    pyer = PyExecutor(echo=False, init_profile="minimal", output_limit=1 << 16, output_keep=64)
+    for _ in range(5):
+        record = pyer._run("while True: print('x' * 5000)", timeout=0.2)
+        assert record["timed_out"] and "KeyboardInterrupt" in record["stderr"]
+        assert pyer._run("print('ok')")["stdout"] == "ok"
+    pyer.stop_process()
+
+
+def test_interrupt_before_cmd_starts():
+    pyer = PyExecutor(echo=False, init_profile="minimal")
+    pyer.warm_up()
+    running = pyer.submit("import time; time.sleep(0.5); print('first')")
+    queued = pyer.submit("print('second')")
+    # 中断尚未开始执行的cmd, 该cmd开始执行时才抛出KeyboardInterrupt
+    assert pyer.interrupt("1") and not running.done()
+    assert running.result()["stdout"] == "first"
+    assert queued.result()["status"] == 1 and "KeyboardInterrupt" in queued.result()["stderr"]
+    assert pyer._run("print('third')")["stdout"] == "third"
+    pyer.stop_process()
+
+
+def test_uninterruptible_cmd_restores_snapshot(tmp_path):
+    pyer = PyExecutor(str(tmp_path), True, echo=False, init_profile="minimal", timeout=0.5, interrupt_grace=0.5)
+    pyer._run("x = [1, 2]")
+    pid = pyer.pid
+    future = pyer.submit(UNINTERRUPTIBLE)
+    queued = pyer.submit("y = 1")
+    record = future.result(timeout=30)
+    assert record["timed_out"] and "TimeoutError" in record["stderr"]
+    assert isinstance(queued.exception(timeout=30), RuntimeError)
+    # 重启在持有提交锁时完成, 之后的cmd在新会话中执行
+    assert pyer._run("print(x)")["stdout"] == "[1, 2]" and pyer.pid != pid
+    pyer.stop_process()
+
+
+def test_memory_limit():
+    pyer = PyExecutor(echo=False, init_profile="minimal", memory_limit=1 << 30)
+    record = pyer._run("x = bytearray(2 << 30)")
+    assert record["status"] == 1 and "MemoryError" in record["stderr"]
+    assert pyer._run("print('alive')")["stdout"] == "alive"
+    pyer.stop_process()
+
+
+def test_async_timeout():
+    async def main():
+        pyer = AsyncPyExecutor(echo=False, init_profile="minimal", timeout=0.5, interrupt_grace=0.5)
+        await pyer._run("x = 1")
+        interrupted = await pyer._run("import time; time.sleep(60)")
+        killed = await pyer._run(UNINTERRUPTIBLE)
+        # 没有快照时会话以空的全局作用域重启
+        output = (await pyer._run("print('x' in globals())"))["stdout"]
+        await pyer.stop_process()
+        return interrupted, killed, output
+
+    interrupted, killed, output = asyncio.run(main())
+    assert interrupted["timed_out"] and "KeyboardInterrupt" in interrupted["stderr"]
+    assert killed["timed_out"] and "TimeoutError" in killed["stderr"]
+    assert output == "False"